@@ -0,0 +1,89 @@
+import time
+import threading
+from typing import Dict, List
+from database import get_db
+
+MAX_PENDING_WRITES = 2000
+MAX_WRITE_ATTEMPTS = 5
+
+class BulkWrites: # pylint: disable=too-many-instance-attributes
+  """Parallel, retrying Firestore writes for batch jobs.
+  Wraps Firestore's BulkWriter, which chunks writes into batches, commits them
+  in parallel and ramps up to the available write throughput. Writes that fail
+  are retried up to max_attempts times. set and delete block while
+  max_pending writes are in flight, so a fast producer cannot queue an
+  unbounded number of writes in memory.
+  Use as a context manager; on exit all writes are flushed and a summary with
+  writes/sec is logged.
+  """
+
+  def __init__(
+    self,
+    label: str,
+    max_pending: int = MAX_PENDING_WRITES,
+    max_attempts: int = MAX_WRITE_ATTEMPTS
+  ):
+    self.label = label
+    self.max_attempts = max_attempts
+    self.pending = threading.BoundedSemaphore(max_pending)
+    self.lock = threading.Lock()
+    self.started_at = time.monotonic()
+    self.stats = {'queued': 0, 'written': 0, 'retried': 0, 'failed': 0}
+    self.failed_paths: List[str] = []
+    self.writer = get_db().bulk_writer()
+    self.writer.on_write_result(self.on_write_result)
+    self.writer.on_write_error(self.on_write_error)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def set(self, reference, document_data: Dict, merge: bool = False):
+    self.pending.acquire() # pylint: disable=consider-using-with
+    self.record('queued')
+    self.writer.set(reference, document_data, merge=merge)
+
+  def delete(self, reference):
+    self.pending.acquire() # pylint: disable=consider-using-with
+    self.record('queued')
+    self.writer.delete(reference)
+
+  def record(self, stat: str):
+    with self.lock:
+      self.stats[stat] += 1
+
+  def on_write_result(self, reference, result, bulk_writer):
+    # pylint: disable=unused-argument
+    self.record('written')
+    self.pending.release()
+
+  def on_write_error(self, error, bulk_writer) -> bool:
+    # pylint: disable=unused-argument
+    if error.attempts < self.max_attempts:
+      self.record('retried')
+      return True
+    print(f"{self.label}: write to {error.operation.reference.path} failed: {error.message}")
+    with self.lock:
+      self.stats['failed'] += 1
+      self.failed_paths.append(error.operation.reference.path)
+    self.pending.release()
+    return False
+
+  def flush(self):
+    self.writer.flush()
+
+  def close(self):
+    self.writer.close()
+    print(self.summary())
+
+  def summary(self) -> Dict:
+    elapsed_seconds = time.monotonic() - self.started_at
+    return {
+      'metric': 'bulk_writes',
+      'label': self.label,
+      'elapsed_seconds': round(elapsed_seconds, 1),
+      'writes_per_second': round(self.stats['written'] / elapsed_seconds, 1),
+      **self.stats
+    }
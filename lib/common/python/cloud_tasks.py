@@ -1,49 +1,98 @@
 import os
 import json
+import time
+import base64
 import datetime
+import threading
+from functools import lru_cache
 from typing import Dict, Optional
-from google.cloud import tasks_v2
-from google.protobuf import timestamp_pb2
-import google.auth.transport.requests
-import google.oauth2.id_token
 
 REGION = os.getenv('REGION')
 PROJECT_ID = os.getenv('PROJECT_ID')
+# service account Cloud Tasks mints the OIDC token of each task for; without
+# it tasks carry a bearer token fetched here
+SERVICE_ACCOUNT = os.getenv('SERVICE_ACCOUNT')
+ID_TOKEN_REFRESH_MARGIN_SECONDS = 300
 
-auth_req = google.auth.transport.requests.Request()
-client = tasks_v2.CloudTasksClient()
+# the google client libraries are imported on first use because they dominate
+# import time for functions that never create a task
+
+@lru_cache(maxsize=None)
+def get_auth_request():
+  import google.auth.transport.requests # pylint: disable=import-outside-toplevel
+  return google.auth.transport.requests.Request()
+
+@lru_cache(maxsize=None)
+def get_client():
+  from google.cloud import tasks_v2 # pylint: disable=import-outside-toplevel
+  return tasks_v2.CloudTasksClient()
+
+id_token_cache: Dict[str, tuple] = {}
+id_token_lock = threading.Lock()
+
+def get_token_expiry(token: str) -> float:
+  # only the exp claim is read, the token is verified by its receiver
+  payload = token.split('.')[1]
+  payload += '=' * (-len(payload) % 4)
+  return json.loads(base64.urlsafe_b64decode(payload))['exp']
+
+def get_id_token(audience: str, valid_for_seconds: int = 0) -> str:
+  """ID token for an audience, fetched from the metadata server once and
+  reused while it stays valid for valid_for_seconds plus a margin."""
+  with id_token_lock:
+    cached = id_token_cache.get(audience)
+    min_expiry = time.time() + valid_for_seconds + ID_TOKEN_REFRESH_MARGIN_SECONDS
+    if cached and cached[0] > min_expiry:
+      return cached[1]
+  import google.oauth2.id_token # pylint: disable=import-outside-toplevel
+  token = google.oauth2.id_token.fetch_id_token(get_auth_request(), audience)
+  with id_token_lock:
+    id_token_cache[audience] = (get_token_expiry(token), token)
+  return token
 
 def create_http_task(
   queue: str,
   url: str,
   json_payload: Dict,
-  delay_in_seconds: Optional[int] = None
-) -> tasks_v2.Task:
+  delay_in_seconds: Optional[int] = None,
+  task_id: Optional[str] = None
+):
   """Create an HTTP POST task with a JSON payload.
   Args:
     queue: The ID of the queue to add the task to.
     url: The target URL of the task.
     json_payload: The JSON payload to send.
     delay_in_seconds: The delay in seconds before the task should be executed.
+    task_id: Optional task name within the queue. Cloud Tasks creates at most
+      one task per name, so a name can be used to deduplicate tasks.
   Returns:
-    The newly created task.
+    The newly created tasks_v2.Task, or None if a task with task_id exists.
   """
+  # pylint: disable=import-outside-toplevel
+  from google.api_core.exceptions import AlreadyExists
+  from google.cloud import tasks_v2
+  from google.protobuf import timestamp_pb2
 
-  token = google.oauth2.id_token.fetch_id_token(auth_req, url)
-
-  headers = {
-    "Content-type": "application/json",
-    "Authorization": f"Bearer {token}"
-  }
-
-  task = tasks_v2.Task(
-    http_request=tasks_v2.HttpRequest(
-      http_method=tasks_v2.HttpMethod.POST,
-      url=url,
-      body=json.dumps(json_payload).encode(),
-      headers=headers,
-    ),
+  headers = {"Content-type": "application/json"}
+  if not SERVICE_ACCOUNT:
+    # the token must still be valid when the delayed task is dispatched
+    token = get_id_token(audience=url, valid_for_seconds=delay_in_seconds or 0)
+    headers["Authorization"] = f"Bearer {token}"
+  http_request = tasks_v2.HttpRequest(
+    http_method=tasks_v2.HttpMethod.POST,
+    url=url,
+    body=json.dumps(json_payload).encode(),
+    headers=headers,
   )
+  if SERVICE_ACCOUNT:
+    # Cloud Tasks attaches a fresh token when it dispatches the task, so no
+    # token is fetched while creating it
+    http_request.oidc_token = tasks_v2.OidcToken(
+      service_account_email=SERVICE_ACCOUNT,
+      audience=url
+    )
+
+  task = tasks_v2.Task(http_request=http_request)
 
   if delay_in_seconds:
     schedule_time = timestamp_pb2.Timestamp() # pylint: disable=no-member
@@ -52,9 +101,26 @@ def create_http_task(
     )
     task.schedule_time = schedule_time
 
-  return client.create_task(
-    tasks_v2.CreateTaskRequest(
-      parent=client.queue_path(PROJECT_ID, REGION, queue),
-      task=task,
+  client = get_client()
+  if task_id:
+    task.name = client.task_path(PROJECT_ID, REGION, queue, task_id)
+  try:
+    return client.create_task(
+      tasks_v2.CreateTaskRequest(
+        parent=client.queue_path(PROJECT_ID, REGION, queue),
+        task=task,
+      )
     )
-  )
+  except AlreadyExists:
+    return None
+
+def delete_task(queue: str, task_id: str) -> bool:
+  """Delete a named task. Returns False if it does not exist, e.g. because it
+  already ran or was deleted."""
+  from google.api_core.exceptions import NotFound # pylint: disable=import-outside-toplevel
+  client = get_client()
+  try:
+    client.delete_task(name=client.task_path(PROJECT_ID, REGION, queue, task_id))
+  except NotFound:
+    return False
+  return True
@@ -0,0 +1,20 @@
+import os
+from functools import lru_cache
+import yaml
+
+ENV = os.getenv('ENV')
+
+@lru_cache(maxsize=None)
+def load_config(filename: str) -> dict:
+  """Parse a bundled YAML config on first use and keep it for the instance."""
+  with open(filename, 'r', encoding='utf-8') as file:
+    return yaml.safe_load(file)
+
+def get_lobby_channels() -> list:
+  return load_config('channels.yaml')[ENV]['lobby_channels']
+
+def get_party_channels() -> list:
+  return load_config('channels.yaml')[ENV]['party_channels']
+
+def get_guild_map() -> dict:
+  return load_config('guilds.yaml')[ENV]
@@ -1,42 +1,66 @@
 import os
+import time
 import random
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+from datetime import datetime, timedelta
 from typing import Optional, List, Dict
 from enum import Enum
-import yaml
 import requests
-import firebase_admin
-from firebase_admin import firestore
-from pydantic import BaseModel, validator, root_validator
-from utils import now_iso_str, wrap_error_message
-from cloud_tasks import create_http_task
-from messages import delete_message
+from pydantic import BaseModel, Field, PrivateAttr, validator, root_validator
+from utils import now_iso_str, wrap_error_message, parse_timestamp
+from cloud_tasks import create_http_task, delete_task
+from messages import delete_message, delete_messages
+from fanout import fan_out
+from firestore_client import get_db
+from configs import get_lobby_channels, get_guild_map
+from lobby_store import OpenLobbyStore
 
 REGION = os.getenv('REGION')
 PROJECT_ID = os.getenv('PROJECT_ID')
-ENV = os.getenv('ENV')
 GAME_TYPES = ['FFA DM', 'CTF', 'Spy Hunt', 'Zombies', 'Visit Train']
 
-with open('channels.yaml', 'r', encoding='utf-8') as file:
-  channels_config = yaml.safe_load(file)
-
-with open('guilds.yaml', 'r', encoding='utf-8') as file:
-  guilds_config = yaml.safe_load(file)
-
-LOBBY_CHANNELS = channels_config[ENV]['lobby_channels']
-GUILD_MAP = guilds_config[ENV]
-
 class LobbyErrorType(Enum):
   PLAYER_IN_OTHER_LOBBY = 'you are in another open lobby'
   NO_IN_GAME_USERNAME = 'you have not yet set your in-game username using "/lobby set username"'
   NO_ISLAND = 'you have not yet set your island using "/lobby set island"'
   GAME_TYPE_EXISTS = 'an open lobby already exists for game type'
+  LOBBY_BUSY = 'the lobby was too busy, please try again'
 
 class LobbyActionType(Enum):
   CREATE = 'create'
   JOIN = 'join'
-
-app = firebase_admin.initialize_app()
-db = firestore.client()
+  LEAVE = 'leave'
+  CLOSE = 'close'
+
+LOBBY_TRANSACTION_MAX_ATTEMPTS = 5
+ACTIVE_PLAYERS_COLLECTION = 'active_players'
+ACTIVE_GAMES_COLLECTION = 'active_games'
+MIGRATIONS_COLLECTION = 'migrations'
+ACTIVE_REGISTRY_MIGRATION = 'active_registry_backfill'
+PLAYER_CACHE_TTL_SECONDS = 30
+LOBBY_EXPIRY_SECONDS = 1200
+ISLAND_CACHE_MAX_SIZE = 2000
+ISLAND_CACHE_TTL_SECONDS = 3600
+ISLAND_CACHE_NEGATIVE_TTL_SECONDS = 300
+ISLAND_API_TIMEOUT_SECONDS = 5
+
+delayed_close_stats = {
+  'scheduled': 0,
+  'deduplicated': 0,
+  'cancelled': 0,
+  'already_gone': 0
+}
+
+active_registry_backfill = {'done': False, 'lock': threading.Lock()}
+
+lobby_transaction_stats = {
+  'committed': 0,
+  'contention_retries': 0,
+  'exhausted': 0
+}
 
 class Game(BaseModel):
   game_type: str
@@ -67,7 +91,6 @@ class IslandOwner(BaseModel):
 class Island(BaseModel):
   id: str
   name: Optional[str] = None
-  search_tokens: Optional[List[str]] = None
   games: List[Game] = []
   url: Optional[str] = None
   player_count: Optional[int] = None
@@ -77,14 +100,72 @@ class Island(BaseModel):
   class Config:
     validate_assignment = True
 
-  def get_url(self):
-    url = f'https://api.niftyisland.com/api/islands/{self.id}/preview'
-    response = requests.get(url)
-    data = response.json()
-    deep_link_index = data['deeplinkIndex']
-    owner = data['owner']['username']
-    self.name = data['name']
-    self.url = f'https://niftyis.land/{owner}/{deep_link_index}'
+  def get_url(self) -> bool:
+    """Sets name and url from the island metadata, returns False if the
+    island does not exist."""
+    metadata = get_island_metadata(island_id=self.id)
+    if not metadata:
+      return False
+    self.name = metadata['name']
+    self.url = metadata['url']
+    return True
+
+island_cache: OrderedDict = OrderedDict()
+island_cache_lock = threading.Lock()
+island_cache_stats = {
+  'hits': 0,
+  'firestore': 0,
+  'api': 0,
+  'unknown': 0
+}
+
+def fetch_island_metadata(island_id: str) -> Optional[Dict]:
+  url = f'https://api.niftyisland.com/api/islands/{island_id}/preview'
+  response = requests.get(url, timeout=ISLAND_API_TIMEOUT_SECONDS)
+  if response.status_code == 404:
+    return None
+  response.raise_for_status()
+  data = response.json()
+  if 'deeplinkIndex' not in data:
+    return None
+  return {
+    'name': data['name'],
+    'url': f"https://niftyis.land/{data['owner']['username']}/{data['deeplinkIndex']}"
+  }
+
+def get_island_metadata(island_id: str) -> Optional[Dict]:
+  """Name and url of an island, read through an in-memory LRU cache, then
+  the islands collection written by index_islands, then the Nifty API for
+  islands the index does not hold. Unknown islands are cached for a shorter
+  time so repeated lookups of a bad ID do not reach the API. API errors are
+  raised and not cached.
+  """
+  with island_cache_lock:
+    cached = island_cache.get(island_id)
+    if cached and cached[0] > time.monotonic():
+      island_cache.move_to_end(island_id)
+      island_cache_stats['hits'] += 1
+      return cached[1]
+
+  source = 'firestore'
+  doc = get_db().collection('islands').document(island_id).get()
+  island = doc.to_dict() if doc.exists else None
+  metadata = {'name': island['name'], 'url': island['url']} if island else None
+  if not metadata:
+    source = 'api'
+    metadata = fetch_island_metadata(island_id=island_id)
+  if not metadata:
+    source = 'unknown'
+
+  ttl_seconds = ISLAND_CACHE_TTL_SECONDS if metadata else ISLAND_CACHE_NEGATIVE_TTL_SECONDS
+  with island_cache_lock:
+    island_cache[island_id] = (time.monotonic() + ttl_seconds, metadata)
+    island_cache.move_to_end(island_id)
+    while len(island_cache) > ISLAND_CACHE_MAX_SIZE:
+      island_cache.popitem(last=False)
+    island_cache_stats[source] += 1
+  print({'metric': 'island_cache', 'source': source, **island_cache_stats})
+  return metadata
 
 class Player(BaseModel):
   id: str
@@ -93,45 +174,100 @@ class Player(BaseModel):
   guild_name: Optional[str] = None
   username: str = None
   island: Optional[Island] = None
+  _dirty_fields: set = PrivateAttr(default_factory=set)
 
   @root_validator(pre=True)
   def update_guild_name(cls, values):
     guild_id = values.get('guild_id')
     if guild_id:
-      values['guild_name'] = GUILD_MAP.get(guild_id)
+      values['guild_name'] = get_guild_map().get(guild_id)
     return values
 
   class Config:
     validate_assignment = True
 
+  def __setattr__(self, name, value):
+    if name not in self.__fields__:
+      super().__setattr__(name, value)
+      return
+    # track every field that actually changed, including ones derived by
+    # root validators (e.g. guild_name), so save() only writes real changes
+    previous_values = dict(self.__dict__)
+    super().__setattr__(name, value)
+    self._dirty_fields.update(
+      field for field, field_value in self.__dict__.items()
+      if previous_values.get(field) != field_value
+    )
+
   def create(self):
-    db.collection('players').document(self.id).set(self.dict())
+    get_db().collection('players').document(self.id).set(self.dict())
+    self._dirty_fields.clear()
+    cache_player(self)
 
   def update(self):
-    db.collection('players').document(self.id).set(self.dict(), merge=True)
-
-  def set_discord_name(self, discord_name: str):
+    get_db().collection('players').document(self.id).set(self.dict(), merge=True)
+    self._dirty_fields.clear()
+
+  def save(self):
+    if not self._dirty_fields:
+      return
+    get_db().collection('players').document(self.id).set(
+      self.dict(include=set(self._dirty_fields)),
+      merge=True
+    )
+    self._dirty_fields.clear()
+
+  def refresh(self, transaction=None):
+    """Reload the username and island, which another instance may have set
+    since this player was cached."""
+    doc = get_db().collection('players').document(self.id).get(transaction=transaction)
+    if not doc.exists:
+      return
+    data = doc.to_dict()
+    self.username = data.get('username')
+    self.island = data.get('island')
+    self._dirty_fields.difference_update({'username', 'island'})
+    cache_player(self)
+
+  def set_profile(self, discord_name: str, guild_id: str):
     self.discord_name = discord_name
-    self.update()
-
-  def set_guild_id(self, guild_id: str):
     self.guild_id = guild_id
-    self.update()
+    self.save()
+
+  def write_field(self, field: str):
+    # only the changed field is written, the rest of a cached player may be
+    # stale and must not overwrite changes made through another instance
+    get_db().collection('players').document(self.id).set(
+      self.dict(include={field}),
+      merge=True
+    )
+    self._dirty_fields.discard(field)
+    cache_player(self)
 
   def set_username(self, username: str):
     self.username = username
-    self.update()
+    self.write_field('username')
 
   def set_island(self, island: Island):
     self.island = island
-    self.update()
+    self.write_field('island')
+
+player_cache: Dict[str, tuple] = {}
+
+def cache_player(player: Player):
+  player_cache[player.id] = (time.monotonic() + PLAYER_CACHE_TTL_SECONDS, player)
 
 def get_player(player_id: str) -> Optional[Player]:
-  doc_ref = db.collection('players').document(player_id)
+  cached = player_cache.get(player_id)
+  if cached and cached[0] > time.monotonic():
+    return cached[1]
+  doc_ref = get_db().collection('players').document(player_id)
   doc = doc_ref.get()
   if not doc.exists:
     return None
-  return Player(**doc.to_dict())
+  player = Player(**doc.to_dict())
+  cache_player(player)
+  return player
 
 class LobbyMessage(BaseModel):
   message_id: str
@@ -141,8 +277,8 @@ class Lobby(BaseModel):
   id: str
   channel_id: str
   lobby_messages: Optional[List[LobbyMessage]] = []
-  channel_ids: Optional[List[str]] = LOBBY_CHANNELS
-  creation_time: str = now_iso_str()
+  channel_ids: Optional[List[str]] = Field(default_factory=get_lobby_channels)
+  creation_time: str = Field(default_factory=now_iso_str)
   creator: Player
   game: Game
   island: Optional[Island] = None
@@ -152,6 +288,10 @@ class Lobby(BaseModel):
   players: list[Player]
   player_count: Optional[int] = None
   player_ids: Optional[list[str]] = None
+  lobby_message_ids: Optional[list[str]] = None
+  # only set while the lobby is open, so the expiry sweep's range query on it
+  # never matches closed lobbies
+  expires_at: Optional[datetime] = None
 
   @validator('status', always=True, pre=True)
   def validate_status(cls, status, values):
@@ -160,56 +300,105 @@ class Lobby(BaseModel):
         raise ValueError('Invalid status')
     return status
 
+  @root_validator(skip_on_failure=True)
+  def fill_message_index(cls, values):
+    # lobbies created before lobby_message_ids existed only store lobby_messages
+    if values.get('lobby_message_ids') is None:
+      values['lobby_message_ids'] = [
+        message.message_id for message in values.get('lobby_messages') or []
+      ]
+    return values
+
   def update_player_stats(self):
     self.player_count = len(self.players)
     self.player_ids = [player.id for player in self.players]
 
-  def create(self):
+  def update_message_index(self):
+    # flattened copy of lobby_messages so a mirror message can be resolved to
+    # its lobby with a single array_contains query instead of a full scan
+    self.lobby_message_ids = [message.message_id for message in self.lobby_messages]
+
+  def create(self) -> Dict:
+    """Atomically check creation eligibility, write the lobby and register its
+    creator and game type as active.
+    Returns a dict with the eligibility outcome and an error message if denied.
+    """
     self.update_player_stats()
     self.lobby_messages.append(LobbyMessage(
       message_id=self.id,
       channel_id=self.channel_id
     ))
-    db.collection('lobbies').document(self.id).set(self.dict())
+    self.update_message_index()
+    if not self.expires_at:
+      self.expires_at = (
+        parse_timestamp(self.creation_time) + timedelta(seconds=LOBBY_EXPIRY_SECONDS)
+      )
+    return create_lobby(self)
 
-  def update(self):
+  def update(self, transaction=None):
     self.update_player_stats()
-    db.collection('lobbies').document(self.id).set(self.dict(), merge=True)
+    self.update_message_index()
+    if self.status != 'open':
+      self.expires_at = None
+    doc_ref = get_db().collection('lobbies').document(self.id)
+    if transaction:
+      transaction.set(doc_ref, self.dict(), merge=True)
+    else:
+      doc_ref.set(self.dict(), merge=True)
 
-  def close(self):
+  def close(self, cancel_delayed_close: bool = True):
+    closed_lobby = close_lobby(self.id)
+    if closed_lobby:
+      self.lobby_messages = closed_lobby.lobby_messages
     self.status = 'closed'
-    self.update()
-    for message in self.lobby_messages:
-      delete_message(channel_id=message.channel_id, message_id=message.message_id)
+    self.delete_lobby_messages()
+    if cancel_delayed_close:
+      cancel_delayed_close_delete_lobby(lobby_id=self.id)
+
+  def delete_lobby_messages(self):
+    fan_out({
+      message.message_id: partial(
+        delete_message,
+        channel_id=message.channel_id,
+        message_id=message.message_id
+      )
+      for message in self.lobby_messages
+    })
 
   def add_lobby_message(self, message_id: str, channel_id: str):
-    self.lobby_messages.append(LobbyMessage(
-      message_id=message_id,
-      channel_id=channel_id
-    ))
-    self.update()
-
-  def add_player(self, player_id: str):
-    player_to_add = next((player for player in self.players if player.id == player_id), None)
-    if not player_to_add:
-      player = get_player(player_id=player_id)
+    self.add_lobby_messages([LobbyMessage(message_id=message_id, channel_id=channel_id)])
+
+  def add_lobby_messages(self, lobby_messages: List[LobbyMessage]):
+    if not lobby_messages:
+      return
+    self.lobby_messages.extend(lobby_messages)
+    self.update_message_index()
+    # only append to the message fields so concurrent player updates are kept
+    # pylint: disable=no-member,import-outside-toplevel
+    from firebase_admin import firestore
+    get_db().collection('lobbies').document(self.id).update({
+      'lobby_messages': firestore.ArrayUnion([message.dict() for message in lobby_messages]),
+      'lobby_message_ids': firestore.ArrayUnion([message.message_id for message in lobby_messages])
+    })
+
+  def add_player(self, player: Player):
+    if player.id not in [lobby_player.id for lobby_player in self.players]:
       self.players.append(player)
-      self.update()
 
   def remove_player(self, player_id: str):
     player_to_remove = next((player for player in self.players if player.id == player_id), None)
     if player_to_remove:
       self.players.remove(player_to_remove)
-      self.update()
+
+  def is_full(self) -> bool:
+    return len(self.players) >= self.game.min_players
 
   def randomize_players(self):
     random.shuffle(self.players)
-    self.update()
 
   def pick_random_island(self):
     players_with_islands = [player for player in self.players if player.island]
     self.random_island = random.choice(players_with_islands).island
-    self.update()
 
   def get_party_list(
     self,
@@ -241,36 +430,136 @@ class Lobby(BaseModel):
   class Config:
     validate_assignment = True
 
+open_lobby_store = OpenLobbyStore()
+
+def get_open_lobbies_query():
+  return get_db().collection('lobbies').where(
+    field_path='status',
+    op_string='==',
+    value='open'
+  )
+
+def enable_open_lobby_store():
+  """Serve open lobby reads outside of transactions from a snapshot listener.
+  Only sets the store up; the listener starts on the first open lobby read.
+  """
+  open_lobby_store.enable(
+    query_factory=get_open_lobbies_query,
+    parse=lambda doc: Lobby(**doc.to_dict())
+  )
+
 def get_open_lobbies() -> List[Lobby]:
+  lobbies = open_lobby_store.get_open_lobbies()
+  if lobbies is not None:
+    return lobbies
   lobbies = []
-  docs = db.collection('lobbies').where(field_path='status', op_string='==', value='open').stream()
+  docs = get_open_lobbies_query().stream()
   for doc in docs:
     lobbies.append(Lobby(**doc.to_dict()))
   return lobbies
 
-def get_lobby(message_id: str) -> Optional[Lobby]:
-  open_lobbies = get_open_lobbies()
-  return next(
-    (
-      lobby for lobby in open_lobbies
-      if any(message.message_id == message_id for message in lobby.lobby_messages)
-    ),
-    None
-  )
-
-def get_lobby_players(lobbies: List[Lobby], exclusion_lobby: Optional[Lobby] = None) -> List[str]:
-  player_ids = []
-  for lobby in lobbies:
-    if exclusion_lobby and lobby.id == exclusion_lobby.id:
+def get_lobby(message_id: str, transaction=None) -> Optional[Lobby]:
+  if not transaction:
+    lobby = open_lobby_store.get_open_lobby(message_id)
+    if lobby:
+      return lobby
+  docs = get_db().collection('lobbies').where(
+    field_path='lobby_message_ids',
+    op_string='array_contains',
+    value=message_id
+  ).limit(1).stream(transaction=transaction)
+  for doc in docs:
+    return Lobby(**doc.to_dict())
+  return get_unindexed_lobby(message_id=message_id, transaction=transaction)
+
+def get_unindexed_lobby(message_id: str, transaction=None) -> Optional[Lobby]:
+  """Scan open lobbies written before lobby_message_ids existed, the indexed
+  query cannot match them. They are indexed by their next update.
+  """
+  docs = get_open_lobbies_query().stream(transaction=transaction)
+  for doc in docs:
+    data = doc.to_dict()
+    if data.get('lobby_message_ids') is not None:
       continue
-    player_ids.extend(lobby.player_ids)
-  return list(set(player_ids))
-
-def get_lobby_game_types(lobbies: List[Lobby]) -> List[str]:
-  game_types = []
-  for lobby in lobbies:
-    game_types.append(lobby.game.game_type)
-  return list(set(game_types))
+    if any(message.get('message_id') == message_id for message in data.get('lobby_messages') or []):
+      print({'metric': 'unindexed_lobby_lookup', 'lobby_id': doc.id})
+      return Lobby(**data)
+  return None
+
+def get_active_lobby_id(collection: str, key: str, transaction=None) -> Optional[str]:
+  """Look up the open lobby registered for a player ID or game type.
+  Entries left behind by a lobby that is no longer open are treated as free.
+  """
+  registry_doc = get_db().collection(collection).document(key).get(transaction=transaction)
+  if not registry_doc.exists:
+    return None
+  lobby_id = registry_doc.to_dict().get('lobby_id')
+  lobby_doc = get_db().collection('lobbies').document(lobby_id).get(transaction=transaction)
+  if not lobby_doc.exists or lobby_doc.to_dict().get('status') != 'open':
+    return None
+  return lobby_id
+
+def register_active(transaction, collection: str, key: str, lobby_id: str):
+  registry_ref = get_db().collection(collection).document(key)
+  transaction.set(registry_ref, {'lobby_id': lobby_id})
+
+def get_owned_registry_refs(
+  transaction,
+  lobby: Lobby,
+  player_ids: List[str],
+  include_game: bool
+) -> List:
+  """Read the registry entries of player_ids (and the lobby's game type) and
+  return the refs that still point at lobby, a player may already be registered
+  to another lobby. Must run before the transaction's first write.
+  """
+  registry_refs = [
+    get_db().collection(ACTIVE_PLAYERS_COLLECTION).document(player_id)
+    for player_id in player_ids
+  ]
+  if include_game:
+    registry_refs.append(
+      get_db().collection(ACTIVE_GAMES_COLLECTION).document(lobby.game.game_type)
+    )
+  owned_refs = []
+  for registry_ref in registry_refs:
+    registry_doc = registry_ref.get(transaction=transaction)
+    if registry_doc.exists and registry_doc.to_dict().get('lobby_id') == lobby.id:
+      owned_refs.append(registry_ref)
+  return owned_refs
+
+def backfill_lobby_registry_transaction(transaction, lobby_id: str):
+  lobby_doc = get_db().collection('lobbies').document(lobby_id).get(transaction=transaction)
+  if not lobby_doc.exists or lobby_doc.to_dict().get('status') != 'open':
+    return
+  lobby = Lobby(**lobby_doc.to_dict())
+  registry_keys = [(ACTIVE_PLAYERS_COLLECTION, player.id) for player in lobby.players]
+  registry_keys.append((ACTIVE_GAMES_COLLECTION, lobby.game.game_type))
+  missing_keys = [
+    (collection, key) for collection, key in registry_keys
+    if not get_db().collection(collection).document(key).get(transaction=transaction).exists
+  ]
+  for collection, key in missing_keys:
+    register_active(transaction, collection, key, lobby.id)
+
+def ensure_active_registry():
+  """Register the players and game types of lobbies that were opened before
+  the active registry existed. Runs once, the first instance to get here marks
+  the migration done; later calls cost one read per instance.
+  """
+  if active_registry_backfill['done']:
+    return
+  with active_registry_backfill['lock']:
+    if active_registry_backfill['done']:
+      return
+    migration_ref = get_db().collection(MIGRATIONS_COLLECTION).document(ACTIVE_REGISTRY_MIGRATION)
+    if not migration_ref.get().exists:
+      lobby_ids = [doc.id for doc in get_open_lobbies_query().stream()]
+      for lobby_id in lobby_ids:
+        run_lobby_transaction(backfill_lobby_registry_transaction, lobby_id)
+      migration_ref.set({'completed_at': now_iso_str(), 'lobby_count': len(lobby_ids)})
+      print(f'Backfilled the active registry for {len(lobby_ids)} open lobbies')
+    active_registry_backfill['done'] = True
 
 def get_lobby_error_message(
   player: Player,
@@ -283,11 +572,24 @@ def get_lobby_error_message(
   if island:
     message += f' on {island.name}'
   message += f' but were denied because {error_type.value}.'
-  if error_type not in [LobbyErrorType.NO_IN_GAME_USERNAME, LobbyErrorType.NO_ISLAND]:
+  if error_type not in [
+    LobbyErrorType.NO_IN_GAME_USERNAME,
+    LobbyErrorType.NO_ISLAND,
+    LobbyErrorType.LOBBY_BUSY
+  ]:
     message += f' Shame on you, {player.discord_name}! Shame! Shame! Shame!'
   return wrap_error_message(message)
 
-def get_lobby_creation_eligibility(player: Player, game: Game, island: Island) -> Dict:
+def get_lobby_creation_eligibility(
+  player: Player,
+  game: Game,
+  island: Island,
+  transaction=None
+) -> Dict:
+  if not player.username or not player.island:
+    # only deny on a fresh read, the cached player may be stale
+    player.refresh(transaction=transaction)
+
   if not player.username:
     return {
       'eligibility': False,
@@ -312,9 +614,7 @@ def get_lobby_creation_eligibility(player: Player, game: Game, island: Island) -
       )
     }
 
-  open_lobbies = get_open_lobbies()
-  player_ids = get_lobby_players(open_lobbies)
-  if player.id in player_ids:
+  if get_active_lobby_id(ACTIVE_PLAYERS_COLLECTION, player.id, transaction=transaction):
     return {
       'eligibility': False,
       'error_message': get_lobby_error_message(
@@ -326,8 +626,7 @@ def get_lobby_creation_eligibility(player: Player, game: Game, island: Island) -
       )
     }
 
-  game_types = get_lobby_game_types(open_lobbies)
-  if game.game_type in game_types:
+  if get_active_lobby_id(ACTIVE_GAMES_COLLECTION, game.game_type, transaction=transaction):
     return {
       'eligibility': False,
       'error_message': get_lobby_error_message(
@@ -341,7 +640,16 @@ def get_lobby_creation_eligibility(player: Player, game: Game, island: Island) -
 
   return {'eligibility': True}
 
-def get_player_join_eligibility(player: Player, lobby: Lobby) -> Dict:
+def get_player_join_eligibility(
+  player: Player,
+  lobby: Lobby,
+  transaction=None
+) -> Dict:
+  needs_island = lobby.game.game_type == 'Visit Train'
+  if not player.username or (needs_island and not player.island):
+    # only deny on a fresh read, the cached player may be stale
+    player.refresh(transaction=transaction)
+
   if not player.username:
     return {
       'eligibility': False,
@@ -354,7 +662,7 @@ def get_player_join_eligibility(player: Player, lobby: Lobby) -> Dict:
       )
     }
 
-  if lobby.game.game_type == 'Visit Train' and not player.island:
+  if needs_island and not player.island:
     return {
       'eligibility': False,
       'error_message': get_lobby_error_message(
@@ -366,9 +674,12 @@ def get_player_join_eligibility(player: Player, lobby: Lobby) -> Dict:
       )
     }
 
-  open_lobbies = get_open_lobbies()
-  player_ids = get_lobby_players(lobbies=open_lobbies, exclusion_lobby=lobby)
-  if player.id in player_ids:
+  active_lobby_id = get_active_lobby_id(
+    ACTIVE_PLAYERS_COLLECTION,
+    player.id,
+    transaction=transaction
+  )
+  if active_lobby_id and active_lobby_id != lobby.id:
     return {
       'eligibility': False,
       'error_message': get_lobby_error_message(
@@ -382,6 +693,263 @@ def get_player_join_eligibility(player: Player, lobby: Lobby) -> Dict:
 
   return {'eligibility': True}
 
+def record_lobby_transaction(action: LobbyActionType, attempts: int, committed: bool):
+  lobby_transaction_stats['contention_retries'] += max(attempts - 1, 0)
+  if committed:
+    lobby_transaction_stats['committed'] += 1
+  else:
+    lobby_transaction_stats['exhausted'] += 1
+  print({
+    'metric': 'lobby_transaction',
+    'action': action.value,
+    'attempts': attempts,
+    'committed': committed,
+    **lobby_transaction_stats
+  })
+
+class LobbyBusyError(Exception):
+  """A lobby transaction ran out of attempts because of contention."""
+
+class TransactionBodyError(Exception):
+  """Carries a ValueError raised by a transaction function out of the
+  client, which raises ValueError itself once max_attempts are exhausted."""
+
+  def __init__(self, error: ValueError):
+    super().__init__(str(error))
+    self.error = error
+
+def run_lobby_transaction(transaction_function, *args):
+  """Run a lobby transaction function. Raises LobbyBusyError when its
+  attempts are exhausted; errors of the function itself are re-raised as is.
+  """
+  # pylint: disable=import-outside-toplevel,no-member
+  from firebase_admin import firestore
+
+  def run(transaction, *function_args):
+    try:
+      return transaction_function(transaction, *function_args)
+    except ValueError as error:
+      raise TransactionBodyError(error) from error
+
+  transaction = get_db().transaction(max_attempts=LOBBY_TRANSACTION_MAX_ATTEMPTS)
+  try:
+    return firestore.transactional(run)(transaction, *args)
+  except TransactionBodyError as error:
+    raise error.error
+  except ValueError as error:
+    raise LobbyBusyError(str(error)) from error
+
+def create_lobby_transaction(transaction, lobby: Lobby, attempts: List[int]):
+  attempts.append(1)
+  eligibility = get_lobby_creation_eligibility(
+    player=lobby.creator,
+    game=lobby.game,
+    island=lobby.island,
+    transaction=transaction
+  )
+  if not eligibility.get('eligibility', False):
+    return eligibility
+
+  transaction.set(get_db().collection('lobbies').document(lobby.id), lobby.dict())
+  register_active(transaction, ACTIVE_PLAYERS_COLLECTION, lobby.creator.id, lobby.id)
+  register_active(transaction, ACTIVE_GAMES_COLLECTION, lobby.game.game_type, lobby.id)
+  return {'eligibility': True}
+
+def close_lobby_transaction(transaction, lobby_id: str, attempts: List[int]):
+  attempts.append(1)
+  lobby_ref = get_db().collection('lobbies').document(lobby_id)
+  lobby_doc = lobby_ref.get(transaction=transaction)
+  if not lobby_doc.exists:
+    return None
+  lobby = Lobby(**lobby_doc.to_dict())
+  if lobby.status != 'open':
+    # lobbies closed without clearing expires_at only need the field cleared
+    if lobby.expires_at:
+      transaction.update(lobby_ref, {'expires_at': None})
+    return None
+
+  owned_refs = get_owned_registry_refs(
+    transaction,
+    lobby,
+    player_ids=[player.id for player in lobby.players],
+    include_game=True
+  )
+  transaction.update(lobby_ref, {'status': 'closed', 'expires_at': None})
+  for registry_ref in owned_refs:
+    transaction.delete(registry_ref)
+  lobby.status = 'closed'
+  return lobby
+
+def join_lobby_transaction(transaction, message_id: str, player: Player, attempts: List[int]):
+  attempts.append(1)
+  lobby = get_lobby(message_id=message_id, transaction=transaction)
+  if not lobby or lobby.status != 'open':
+    return {'lobby': lobby, 'eligibility': True, 'closed': False}
+
+  eligibility = get_player_join_eligibility(
+    player=player,
+    lobby=lobby,
+    transaction=transaction
+  )
+  if not eligibility.get('eligibility', False):
+    return {'lobby': lobby, **eligibility, 'closed': False}
+
+  lobby.add_player(player)
+  closed = lobby.is_full()
+  owned_refs = []
+  if closed:
+    owned_refs = get_owned_registry_refs(
+      transaction,
+      lobby,
+      player_ids=[lobby_player.id for lobby_player in lobby.players],
+      include_game=True
+    )
+    if lobby.game.game_type == 'Visit Train':
+      lobby.randomize_players()
+    if lobby.randomize_island:
+      lobby.pick_random_island()
+    lobby.status = 'closed'
+  lobby.update(transaction=transaction)
+  if closed:
+    for registry_ref in owned_refs:
+      transaction.delete(registry_ref)
+  else:
+    register_active(transaction, ACTIVE_PLAYERS_COLLECTION, player.id, lobby.id)
+  return {'lobby': lobby, 'eligibility': True, 'closed': closed}
+
+def leave_lobby_transaction(transaction, message_id: str, player_id: str, attempts: List[int]):
+  attempts.append(1)
+  lobby = get_lobby(message_id=message_id, transaction=transaction)
+  if not lobby or lobby.status != 'open':
+    return {'lobby': lobby, 'closed': False}
+
+  if player_id not in [player.id for player in lobby.players]:
+    return {'lobby': lobby, 'closed': False}
+
+  lobby.remove_player(player_id=player_id)
+  closed = len(lobby.players) == 0
+  owned_refs = get_owned_registry_refs(
+    transaction,
+    lobby,
+    player_ids=[player_id],
+    include_game=closed
+  )
+  if closed:
+    lobby.status = 'closed'
+  lobby.update(transaction=transaction)
+  for registry_ref in owned_refs:
+    transaction.delete(registry_ref)
+  return {'lobby': lobby, 'closed': closed}
+
+def create_lobby(lobby: Lobby) -> Dict:
+  attempts = []
+  try:
+    ensure_active_registry()
+    result = run_lobby_transaction(create_lobby_transaction, lobby, attempts)
+  except LobbyBusyError:
+    record_lobby_transaction(LobbyActionType.CREATE, len(attempts), committed=False)
+    return {
+      'eligibility': False,
+      'error_message': get_lobby_error_message(
+        player=lobby.creator,
+        game=lobby.game,
+        island=lobby.island,
+        error_type=LobbyErrorType.LOBBY_BUSY,
+        action=LobbyActionType.CREATE
+      )
+    }
+  record_lobby_transaction(LobbyActionType.CREATE, len(attempts), committed=True)
+  return result
+
+def close_lobby(lobby_id: str) -> Optional[Lobby]:
+  """Close a lobby and release its registry entries. Returns the closed lobby,
+  or None when it does not exist or was no longer open."""
+  attempts = []
+  try:
+    lobby = run_lobby_transaction(close_lobby_transaction, lobby_id, attempts)
+  except LobbyBusyError:
+    record_lobby_transaction(LobbyActionType.CLOSE, len(attempts), committed=False)
+    raise
+  record_lobby_transaction(LobbyActionType.CLOSE, len(attempts), committed=True)
+  return lobby
+
+def get_expired_lobbies(expired_before: datetime, limit: int) -> List[Lobby]:
+  """Lobbies whose expires_at is before expired_before. Closing a lobby
+  clears expires_at, so this range query only reads expired open lobbies.
+  """
+  docs = get_db().collection('lobbies').where(
+    field_path='expires_at',
+    op_string='<',
+    value=expired_before
+  ).limit(limit).stream()
+  return [Lobby(**doc.to_dict()) for doc in docs]
+
+def close_lobbies(lobbies: List[Lobby]) -> List[Lobby]:
+  """Close lobbies, each in its own transaction, and delete the messages of
+  the ones this call closed with one bulk delete per channel. The passed
+  lobbies may be stale, a lobby closed by a join or leave in the meantime
+  is left alone. Returns the lobbies that were closed.
+  """
+  closed_lobbies = [
+    lobby for lobby in fan_out({
+      lobby.id: partial(close_lobby, lobby_id=lobby.id) for lobby in lobbies
+    })['results'].values()
+    if lobby
+  ]
+  fan_out({
+    lobby.id: partial(cancel_delayed_close_delete_lobby, lobby_id=lobby.id)
+    for lobby in closed_lobbies
+  })
+
+  channel_message_ids = {}
+  for lobby in closed_lobbies:
+    for message in lobby.lobby_messages:
+      channel_message_ids.setdefault(message.channel_id, []).append(message.message_id)
+  fan_out({
+    channel_id: partial(delete_messages, channel_id=channel_id, message_ids=message_ids)
+    for channel_id, message_ids in channel_message_ids.items()
+  })
+  return closed_lobbies
+
+def join_lobby(message_id: str, player: Player) -> Dict:
+  """Atomically check eligibility, add the player and close the lobby once full.
+  Returns a dict with the resulting lobby, the eligibility outcome and whether
+  the lobby was closed by this join. Lobby messages are not deleted here.
+  """
+  attempts = []
+  try:
+    ensure_active_registry()
+    result = run_lobby_transaction(join_lobby_transaction, message_id, player, attempts)
+  except LobbyBusyError:
+    record_lobby_transaction(LobbyActionType.JOIN, len(attempts), committed=False)
+    lobby = get_lobby(message_id=message_id)
+    if not lobby:
+      raise
+    return {
+      'lobby': lobby,
+      'eligibility': False,
+      'error_message': get_lobby_error_message(
+        player=player,
+        game=lobby.game,
+        island=lobby.island,
+        error_type=LobbyErrorType.LOBBY_BUSY,
+        action=LobbyActionType.JOIN
+      ),
+      'closed': False
+    }
+  record_lobby_transaction(LobbyActionType.JOIN, len(attempts), committed=True)
+  return result
+
+def leave_lobby(message_id: str, player_id: str) -> Dict:
+  attempts = []
+  try:
+    result = run_lobby_transaction(leave_lobby_transaction, message_id, player_id, attempts)
+  except LobbyBusyError:
+    record_lobby_transaction(LobbyActionType.LEAVE, len(attempts), committed=False)
+    raise
+  record_lobby_transaction(LobbyActionType.LEAVE, len(attempts), committed=True)
+  return result
+
 def delayed_close_delete_lobby(
   channel_id: str,
   lobby_id: str,
@@ -389,9 +957,36 @@ def delayed_close_delete_lobby(
   only_if_open: Optional[bool] = False
 ):
   url=f'https://{REGION}-{PROJECT_ID}.cloudfunctions.net/close_delete_lobby'
-  create_http_task(
+  task = create_http_task(
     queue='delayed-task-queue',
     url=url,
     json_payload={'channel_id': channel_id, 'lobby_id': lobby_id, 'only_if_open': only_if_open},
-    delay_in_seconds=delay_in_seconds
+    delay_in_seconds=delay_in_seconds,
+    task_id=get_close_task_id(lobby_id)
   )
+  record_delayed_close('scheduled' if task else 'deduplicated', lobby_id)
+
+def get_close_task_id(lobby_id: str) -> str:
+  # Cloud Tasks recommends a hashed prefix over sequential task names
+  prefix = hashlib.sha1(lobby_id.encode()).hexdigest()[:8]
+  return f'{prefix}-close-lobby-{lobby_id}'
+
+def cancel_delayed_close_delete_lobby(lobby_id: str):
+  """Delete the delayed close task of a lobby that closed early, so it does
+  not invoke close_delete_lobby for nothing. Failures are only logged, the
+  task is harmless when it fires for a closed lobby."""
+  try:
+    deleted = delete_task(queue='delayed-task-queue', task_id=get_close_task_id(lobby_id))
+  except Exception as error:
+    print(f"Failed to cancel delayed close of lobby {lobby_id}: {error}")
+    return
+  record_delayed_close('cancelled' if deleted else 'already_gone', lobby_id)
+
+def record_delayed_close(outcome: str, lobby_id: str):
+  delayed_close_stats[outcome] += 1
+  print({
+    'metric': 'delayed_close_task',
+    'outcome': outcome,
+    'lobby_id': lobby_id,
+    **delayed_close_stats
+  })
@@ -1,28 +1,18 @@
 import os
 from enum import Enum
-import yaml
-import requests
+from functools import partial
 from nacl.exceptions import BadSignatureError
 from nacl.signing import VerifyKey
-from database import Lobby
-from messages import delayed_delete_ephemeral_message
+from database import Lobby, LobbyMessage
+from messages import send_message, edit_message
+from ephemeral_deletions import delayed_delete_ephemeral_message
+from fanout import fan_out
 from interactions import Interaction
+from discord_api import discord_client
+from configs import get_party_channels
 
-BOT_TOKEN = os.getenv('BOT_TOKEN')
 BOT_PUBLIC_KEY = os.getenv('BOT_PUBLIC_KEY')
 BOT_APP_ID = os.getenv('BOT_APP_ID')
-ENV = os.getenv('ENV')
-BASE_URL = 'https://discord.com/api/v10'
-
-with open('channels.yaml', 'r', encoding='utf-8') as file:
-  channels_config = yaml.safe_load(file)
-
-PARTY_CHANNELS = channels_config[ENV]['party_channels']
-
-headers = {
-  'Authorization': f'Bot {BOT_TOKEN}',
-  'Content-Type': 'application/json'
-}
 
 class DiscordErrorType(Enum):
   INVALID_SIGNATURE = 'Invalid signature'
@@ -31,6 +21,7 @@ class DiscordErrorType(Enum):
   INVALID_COMMAND = 'Invalid command'
   INVALID_SUBCOMMAND_GROUP = 'Invalid subcommand group'
   INVALID_SUBCOMMAND = 'Invalid or umapped subcommand'
+  UNKNOWN_ISLAND = 'Island not found'
 
 def validate_request(request):
   verify_key = VerifyKey(bytes.fromhex(BOT_PUBLIC_KEY))
@@ -45,11 +36,10 @@ def validate_request(request):
   return True
 
 def bot_followup_response(interaction: Interaction, ephemeral: bool, json: dict):
-  url = f'{BASE_URL}/webhooks/{BOT_APP_ID}/{interaction.token}'
+  path = f'/webhooks/{BOT_APP_ID}/{interaction.token}'
   if ephemeral:
     json['flags'] = 64
-  reply_response = requests.post(url, json=json, headers=headers)
-  reply_response.raise_for_status()
+  reply_response = discord_client.post(path, json=json)
   reply_response_json = reply_response.json()
   message_id = reply_response_json['id']
   if ephemeral:
@@ -101,9 +91,8 @@ def bot_lobby_response(interaction: Interaction, lobby: Lobby):
     'flags': 4 # supress embeds
   }
   # respond to interaction
-  url = f'{BASE_URL}/webhooks/{BOT_APP_ID}/{interaction.token}/messages/@original'
-  reply_response = requests.patch(url, json=json)
-  reply_response.raise_for_status()
+  path = f'/webhooks/{BOT_APP_ID}/{interaction.token}/messages/@original'
+  discord_client.patch(path, auth=False, json=json)
   # mirror lobby state to other lobby channels
   if len(lobby.lobby_messages) == 1:
     # create message
@@ -111,22 +100,29 @@ def bot_lobby_response(interaction: Interaction, lobby: Lobby):
       channel_id for channel_id
       in lobby.channel_ids if channel_id != interaction.channel.id
     ]
-    for channel_id in other_channels:
-      url = f'{BASE_URL}/channels/{channel_id}/messages'
-      reply_response = requests.post(url, json=json, headers=headers)
-      reply_response.raise_for_status()
-      message_id = reply_response.json()['id']
-      lobby.add_lobby_message(message_id=message_id, channel_id=channel_id)
+    fanout = fan_out({
+      channel_id: partial(send_message, channel_id=channel_id, payload=json)
+      for channel_id in other_channels
+    })
+    lobby.add_lobby_messages([
+      LobbyMessage(message_id=message_id, channel_id=channel_id)
+      for channel_id, message_id in fanout['results'].items()
+    ])
   else:
     # update message
     other_lobby_messages = [
       message for message
       in lobby.lobby_messages if message.channel_id != interaction.channel.id
     ]
-    for message in other_lobby_messages:
-      url = f'{BASE_URL}/channels/{message.channel_id}/messages/{message.message_id}'
-      reply_response = requests.patch(url, json=json, headers=headers)
-      reply_response.raise_for_status()
+    fan_out({
+      message.channel_id: partial(
+        edit_message,
+        channel_id=message.channel_id,
+        message_id=message.message_id,
+        payload=json
+      )
+      for message in other_lobby_messages
+    })
 
 def bot_party_notification(lobby: Lobby):
   dice = ''
@@ -168,7 +164,7 @@ def bot_party_notification(lobby: Lobby):
     'components': components,
     'flags': 4 # supress embeds
   }
-  for party_channel in PARTY_CHANNELS:
-    url = f'{BASE_URL}/channels/{party_channel}/messages'
-    reply_response = requests.post(url, json=json, headers=headers)
-    reply_response.raise_for_status()
+  fan_out({
+    party_channel: partial(send_message, channel_id=party_channel, payload=json)
+    for party_channel in get_party_channels()
+  })
@@ -0,0 +1,206 @@
+import os
+import re
+import time
+import threading
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+# overridable so local stand-ins (e.g. the load test) can serve the API
+BASE_URL = os.getenv('DISCORD_API_BASE_URL', 'https://discord.com/api/v10')
+REQUEST_TIMEOUT_SECONDS = 10
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+MAJOR_PARAMETERS = ['channels', 'guilds', 'webhooks']
+TOKEN_PARAMETERS = ['webhooks', 'interactions']
+MAX_TRACKED_BUCKETS = 1000
+# requests with these methods may take effect twice when retried after Discord
+# received them, so they are only retried when they were never sent
+NON_IDEMPOTENT_METHODS = ['POST']
+SNOWFLAKE_PATTERN = re.compile(r'^\d{15,25}$')
+
+def get_route(method: str, path: str) -> tuple:
+  """Split a request path into a route key and its major parameter.
+  Discord shares rate limits between requests to the same route that have the
+  same major parameter (channel, guild or webhook ID + token). Every other
+  snowflake in the path is replaced with a placeholder.
+  Returns:
+    A (route, major_parameter) tuple.
+  """
+  segments = path.strip('/').split('/')
+  route_segments = []
+  major_parameter = ''
+  for i, segment in enumerate(segments):
+    previous = segments[i - 1] if i > 0 else None
+    if previous in MAJOR_PARAMETERS and not major_parameter:
+      major_parameter = segment
+      if previous == 'webhooks' and i + 1 < len(segments):
+        major_parameter += f'/{segments[i + 1]}'
+      route_segments.append(f':{previous}')
+    elif i > 1 and segments[i - 2] in TOKEN_PARAMETERS:
+      route_segments.append(':token')
+    elif SNOWFLAKE_PATTERN.match(segment):
+      route_segments.append(':id')
+    else:
+      route_segments.append(segment)
+  return f"{method.upper()} /{'/'.join(route_segments)}", major_parameter
+
+def is_unsent(error: requests.RequestException) -> bool:
+  """Whether a request failed before reaching Discord, i.e. the connection
+  could not be established. Read timeouts and dropped connections may happen
+  after Discord received the request."""
+  if isinstance(error, requests.ConnectTimeout):
+    return True
+  reason = getattr(error.args[0], 'reason', None) if error.args else None
+  # NewConnectionError (refused or unresolvable hosts) subclasses it
+  return isinstance(reason, ConnectTimeoutError)
+
+class DiscordClient: # pylint: disable=too-many-instance-attributes
+  """Discord REST client shared by all modules.
+  Keeps connections alive through a pooled session, tracks per-route rate limit
+  buckets from the X-RateLimit-* headers and waits for a bucket (or the global
+  limit) to reset instead of sending requests that would be rejected with 429.
+  429s, 5xx responses and connection errors are retried up to max_retries.
+  Non-idempotent requests (POST unless the caller says otherwise) are only
+  retried on 429s and on connection errors that mean they were never sent.
+  """
+
+  def __init__(
+    self,
+    token: Optional[str] = BOT_TOKEN,
+    base_url: str = BASE_URL,
+    timeout: float = REQUEST_TIMEOUT_SECONDS,
+    max_retries: int = MAX_RETRIES
+  ):
+    self.token = token
+    self.base_url = base_url
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.session = requests.Session()
+    self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    self.lock = threading.Lock()
+    self.route_buckets = {}
+    self.buckets = {}
+    self.global_reset_at = 0.0
+
+  def get_bucket_key(self, route: str, major_parameter: str) -> str:
+    bucket_hash = self.route_buckets.get(route, route)
+    return f'{bucket_hash}:{major_parameter}'
+
+  def acquire(self, route: str, major_parameter: str):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        wait_seconds = self.global_reset_at - now
+        bucket = self.buckets.get(self.get_bucket_key(route, major_parameter))
+        if bucket and bucket['reset_at'] <= now:
+          bucket = None
+        if bucket and bucket['remaining'] <= 0:
+          wait_seconds = max(wait_seconds, bucket['reset_at'] - now)
+        if wait_seconds <= 0:
+          if bucket:
+            # reserve a slot so concurrent callers do not overrun the bucket
+            bucket['remaining'] -= 1
+          return
+      time.sleep(wait_seconds)
+
+  def update_limits(self, route: str, major_parameter: str, response: requests.Response):
+    response_headers = response.headers
+    now = time.monotonic()
+    with self.lock:
+      if len(self.buckets) > MAX_TRACKED_BUCKETS:
+        self.buckets = {
+          key: bucket for key, bucket in self.buckets.items() if bucket['reset_at'] > now
+        }
+      bucket_hash = response_headers.get('X-RateLimit-Bucket')
+      if bucket_hash:
+        self.route_buckets[route] = bucket_hash
+      remaining = response_headers.get('X-RateLimit-Remaining')
+      reset_after = response_headers.get('X-RateLimit-Reset-After')
+      if remaining is not None and reset_after is not None:
+        self.buckets[self.get_bucket_key(route, major_parameter)] = {
+          'remaining': int(remaining),
+          'reset_at': now + float(reset_after)
+        }
+      if response.status_code == 429:
+        retry_after = get_retry_after(response)
+        is_global = (
+          response_headers.get('X-RateLimit-Global') == 'true' or
+          response_headers.get('X-RateLimit-Scope') == 'global'
+        )
+        if is_global:
+          self.global_reset_at = max(self.global_reset_at, now + retry_after)
+        else:
+          self.buckets[self.get_bucket_key(route, major_parameter)] = {
+            'remaining': 0,
+            'reset_at': now + retry_after
+          }
+
+  def request(
+    self,
+    method: str,
+    path: str,
+    auth: bool = True,
+    idempotent: Optional[bool] = None,
+    **kwargs
+  ) -> requests.Response:
+    route, major_parameter = get_route(method, path)
+    if idempotent is None:
+      idempotent = method.upper() not in NON_IDEMPOTENT_METHODS
+    request_headers = kwargs.pop('headers', {})
+    if auth and self.token:
+      request_headers['Authorization'] = f'Bot {self.token}'
+
+    for attempt in range(self.max_retries + 1):
+      is_last_attempt = attempt == self.max_retries
+      self.acquire(route, major_parameter)
+      try:
+        response = self.session.request(
+          method,
+          f'{self.base_url}{path}',
+          headers=request_headers,
+          timeout=self.timeout,
+          **kwargs
+        )
+      except (requests.ConnectionError, requests.Timeout) as error:
+        if is_last_attempt or not (idempotent or is_unsent(error)):
+          raise
+        print(f"Discord request {route} failed: {error}. Retrying")
+        time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+        continue
+
+      self.update_limits(route, major_parameter, response)
+      if response.status_code == 429 and not is_last_attempt:
+        print(f"Discord rate limited {route} for {get_retry_after(response)}s")
+        continue
+      if response.status_code >= 500 and idempotent and not is_last_attempt:
+        time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+        continue
+      response.raise_for_status()
+      return response
+    return response
+
+  def get(self, path: str, **kwargs) -> requests.Response:
+    return self.request('GET', path, **kwargs)
+
+  def post(self, path: str, **kwargs) -> requests.Response:
+    return self.request('POST', path, **kwargs)
+
+  def patch(self, path: str, **kwargs) -> requests.Response:
+    return self.request('PATCH', path, **kwargs)
+
+  def put(self, path: str, **kwargs) -> requests.Response:
+    return self.request('PUT', path, **kwargs)
+
+  def delete(self, path: str, **kwargs) -> requests.Response:
+    return self.request('DELETE', path, **kwargs)
+
+def get_retry_after(response: requests.Response) -> float:
+  try:
+    return float(response.json().get('retry_after', 1))
+  except ValueError:
+    return float(response.headers.get('Retry-After', 1))
+
+discord_client = DiscordClient()
@@ -0,0 +1,159 @@
+import os
+import time
+import random
+import hashlib
+import threading
+from functools import partial
+from typing import Dict, List, Optional
+import requests
+from cloud_tasks import create_http_task
+from firestore_client import get_db
+from interactions import Interaction
+from discord_api import discord_client
+from fanout import fan_out
+
+REGION = os.getenv('REGION')
+PROJECT_ID = os.getenv('PROJECT_ID')
+BOT_APP_ID = os.getenv('BOT_APP_ID')
+BUCKET_COLLECTION = 'ephemeral_deletions'
+BUCKET_SECONDS = 5
+# items are added to a bucket at least their delay before it ends, so the
+# grace only has to cover clock skew between instances
+BUCKET_GRACE_SECONDS = 2
+# every item of a bucket is written to one of its shard documents, Firestore
+# sustains about one write per second on a single document
+BUCKET_SHARDS = 10
+
+scheduled_buckets = set()
+scheduled_buckets_lock = threading.Lock()
+
+def get_bucket(due_at: float) -> int:
+  return int(due_at // BUCKET_SECONDS)
+
+def get_bucket_doc_ids(bucket: int) -> List[str]:
+  # the unsharded document holds items queued before buckets were sharded
+  return [str(bucket)] + [f'{bucket}-{shard}' for shard in range(BUCKET_SHARDS)]
+
+def get_bucket_task_id(bucket: int) -> str:
+  # Cloud Tasks recommends a hashed prefix over sequential task names
+  prefix = hashlib.sha1(str(bucket).encode()).hexdigest()[:8]
+  return f'{prefix}-ephemeral-{bucket}'
+
+def schedule_bucket(bucket: int):
+  """Create the bucket's task once. Instances remember the buckets they
+  scheduled, and the named task deduplicates across instances."""
+  with scheduled_buckets_lock:
+    if bucket in scheduled_buckets:
+      return
+    scheduled_buckets.add(bucket)
+    # only buckets that can still receive items are worth remembering
+    current_bucket = get_bucket(time.time())
+    scheduled_buckets.difference_update(
+      [scheduled for scheduled in scheduled_buckets if scheduled < current_bucket]
+    )
+  delay_in_seconds = (bucket + 1) * BUCKET_SECONDS + BUCKET_GRACE_SECONDS - time.time()
+  try:
+    create_http_task(
+      queue='delayed-task-queue',
+      url=f'https://{REGION}-{PROJECT_ID}.cloudfunctions.net/delete_ephemeral_message',
+      json_payload={'bucket': bucket},
+      delay_in_seconds=max(int(delay_in_seconds) + 1, 1),
+      task_id=get_bucket_task_id(bucket)
+    )
+  except Exception:
+    with scheduled_buckets_lock:
+      scheduled_buckets.discard(bucket)
+    raise
+
+def delayed_delete_ephemeral_message(
+  interaction: Interaction,
+  delay_in_seconds: int,
+  message_id: Optional[str] = None
+):
+  """Queue an ephemeral message for deletion after delay_in_seconds.
+  Deletions due in the same BUCKET_SECONDS window are collected in the
+  bucket's shard documents and deleted by a single delete_ephemeral_message
+  task.
+  """
+  # pylint: disable=import-outside-toplevel,no-member
+  from firebase_admin import firestore
+  bucket = get_bucket(time.time() + delay_in_seconds)
+  shard = random.randrange(BUCKET_SHARDS)
+  get_db().collection(BUCKET_COLLECTION).document(f'{bucket}-{shard}').set({
+    'items': firestore.ArrayUnion([{
+      'token': interaction.token,
+      'message_id': message_id or '@original'
+    }])
+  }, merge=True)
+  schedule_bucket(bucket)
+
+def delete_ephemeral_message(token: str, message_id: str) -> str:
+  try:
+    discord_client.delete(f'/webhooks/{BOT_APP_ID}/{token}/messages/{message_id}', auth=False)
+  except requests.HTTPError as error:
+    if error.response is not None and error.response.status_code == 404:
+      return 'gone'
+    raise
+  return 'deleted'
+
+def clear_bucket_shard(snapshot, done_items: List[Dict], failed_items: List[Dict]):
+  # pylint: disable=import-outside-toplevel,no-member
+  from firebase_admin import firestore
+  doc_ref = snapshot.reference
+  if not failed_items:
+    try:
+      # only delete the document if no item was added after it was read
+      doc_ref.delete(option=get_db().write_option(last_update_time=snapshot.update_time))
+    except Exception:
+      doc_ref.update({'items': firestore.ArrayRemove(done_items)})
+  elif done_items:
+    doc_ref.update({'items': firestore.ArrayRemove(done_items)})
+
+def delete_bucket(bucket: int) -> Dict:
+  """Delete every message queued in a bucket. A failing item does not stop
+  the others and stays in its shard so a retry of the task only repeats it.
+  Returns the bucket metrics.
+  """
+  collection = get_db().collection(BUCKET_COLLECTION)
+  read_outcome = fan_out({
+    doc_id: collection.document(doc_id).get for doc_id in get_bucket_doc_ids(bucket)
+  })
+  snapshots = [snapshot for snapshot in read_outcome['results'].values() if snapshot.exists]
+  items = [
+    (snapshot.id, item)
+    for snapshot in snapshots
+    for item in snapshot.to_dict().get('items', [])
+  ]
+  outcome = fan_out({
+    i: partial(delete_ephemeral_message, token=item['token'], message_id=item['message_id'])
+    for i, (_, item) in enumerate(items)
+  })
+
+  clear_outcome = fan_out({
+    snapshot.id: partial(
+      clear_bucket_shard,
+      snapshot=snapshot,
+      done_items=[
+        item for i, (doc_id, item) in enumerate(items)
+        if doc_id == snapshot.id and i in outcome['results']
+      ],
+      failed_items=[
+        item for i, (doc_id, item) in enumerate(items)
+        if doc_id == snapshot.id and i in outcome['errors']
+      ]
+    )
+    for snapshot in snapshots
+  })
+
+  results = list(outcome['results'].values())
+  return {
+    'metric': 'ephemeral_deletions',
+    'bucket': bucket,
+    'items': len(items),
+    'deleted': results.count('deleted'),
+    'gone': results.count('gone'),
+    'failed': len(outcome['errors']),
+    # shards that could not be read or cleared, the task is retried for them
+    'failed_shards': len(read_outcome['errors']) + len(clear_outcome['errors']),
+    'lag_seconds': round(time.time() - (bucket + 1) * BUCKET_SECONDS, 1)
+  }
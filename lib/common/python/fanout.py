@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+FANOUT_MAX_WORKERS = 8
+
+# worker threads are only started on first submit, so this is cheap at import
+executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='fanout')
+
+def fan_out(operations: Dict[Hashable, Callable[[], Any]]) -> Dict:
+  """Run independent operations (typically one per channel) concurrently.
+  Args:
+    operations: A mapping of key (e.g. channel ID) to a zero-argument callable.
+  Returns:
+    A dict with 'results' and 'errors', each keyed like operations. A failing
+    operation is logged and recorded in 'errors' without affecting the others.
+  """
+  futures = {key: executor.submit(operation) for key, operation in operations.items()}
+  results = {}
+  errors = {}
+  for key, future in futures.items():
+    try:
+      results[key] = future.result()
+    except Exception as error:
+      print(f"Fan-out operation {key} failed: {error}")
+      errors[key] = error
+  return {'results': results, 'errors': errors}
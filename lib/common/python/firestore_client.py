@@ -0,0 +1,19 @@
+import threading
+from functools import lru_cache
+
+db_init_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def get_db():
+  # firebase is imported and initialized on first use so functions that never
+  # touch Firestore do not pay for it on cold start. lru_cache does not
+  # serialize concurrent first calls and a second initialize_app() raises, so
+  # the app is initialized under a lock and reused when it already exists
+  import firebase_admin # pylint: disable=import-outside-toplevel
+  from firebase_admin import firestore # pylint: disable=import-outside-toplevel
+  with db_init_lock:
+    try:
+      app = firebase_admin.get_app()
+    except ValueError:
+      app = firebase_admin.initialize_app()
+  return firestore.client(app)
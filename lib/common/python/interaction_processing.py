@@ -0,0 +1,134 @@
+import os
+from flask import abort
+from discord import (
+  bot_lobby_response,
+  bot_party_notification,
+  bot_followup_response,
+)
+from database import (
+  get_player,
+  get_lobby,
+  join_lobby,
+  leave_lobby,
+  enable_open_lobby_store,
+  cancel_delayed_close_delete_lobby,
+  Player
+)
+from subcommand import handle_subcommand, Subcommand
+from interactions import Interaction, ResponseType, RequestType
+from cloud_tasks import create_http_task
+
+REGION = os.getenv('REGION')
+PROJECT_ID = os.getenv('PROJECT_ID')
+OPEN_LOBBY_STORE = os.getenv('OPEN_LOBBY_STORE', 'true') == 'true'
+
+if OPEN_LOBBY_STORE:
+  enable_open_lobby_store()
+
+def is_ephemeral_command(data: dict) -> bool:
+  # only lobby creation posts a public message, every other command replies
+  # with an ephemeral followup
+  return data['data']['options'][0]['name'] != 'create'
+
+def get_deferred_response_type(data: dict) -> int:
+  if data['type'] == RequestType.MESSAGE_COMPONENT.value:
+    return ResponseType.DEFERRED_UPDATE_MESSAGE.value
+  return ResponseType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value
+
+def delayed_process_interaction(interaction: Interaction, data: dict):
+  url=f'https://{REGION}-{PROJECT_ID}.cloudfunctions.net/process_interaction'
+  create_http_task(
+    queue='delayed-task-queue',
+    url=url,
+    json_payload={
+      'data': data,
+      'ephemeral': interaction.ephemeral
+    }
+  )
+
+def process_interaction(interaction: Interaction, data: dict):
+  # pylint: disable=too-many-statements
+  player = None
+  if 'member' in data:
+    player_id = data['member']['user']['id']
+    player = get_player(player_id=player_id)
+    if not player:
+      player = Player(
+        id=data['member']['user']['id'],
+        discord_name=data['member']['user']['global_name'],
+        guild_id=data['guild_id']
+      )
+      player.create()
+    else:
+      player.set_profile(
+        discord_name=data['member']['user']['global_name'],
+        guild_id=data['guild_id']
+      )
+
+  if data['type'] in [
+    RequestType.APPLICATION_COMMAND.value,
+    RequestType.APPLICATION_COMMAND_AUTOCOMPLETE.value
+  ]:
+    subcommand_group = data['data']['options'][0]
+
+    subcommand_data = {
+      'interaction': interaction,
+      'command': data['data']['name'],
+      'subcommand_group': subcommand_group['name'],
+      'subcommand': subcommand_group['options'][0]['name'],
+      'subcommand_options': subcommand_group['options'][0]['options'],
+      'param1': subcommand_group['options'][0]['options'][0]['value']
+    }
+
+    if len(subcommand_group['options'][0]['options']) > 1:
+      subcommand_data['param2'] = subcommand_group['options'][0]['options'][1]['value']
+
+    subcommand = Subcommand(**subcommand_data)
+    print(subcommand.dict())
+    handle_subcommand(subcommand=subcommand, player=player)
+
+  elif data['type'] == RequestType.MESSAGE_COMPONENT.value:
+    interaction.ack(response_type=ResponseType.DEFERRED_UPDATE_MESSAGE.value)
+
+    if player:
+      custom_id = data['data']['custom_id']
+
+      if custom_id == 'join_lobby':
+        result = join_lobby(message_id=interaction.message_id, player=player)
+        lobby = result.get('lobby')
+        is_eligible = result.get('eligibility', False)
+        error_message = result.get('error_message', 'Lobby joining not allowed')
+
+        if not is_eligible:
+          bot_followup_response(
+            interaction=interaction,
+            ephemeral=True,
+            json={'content': error_message}
+          )
+          abort(400, 'Lobby joining not allowed')
+
+        if result.get('closed', False):
+          lobby.delete_lobby_messages()
+          bot_party_notification(lobby=lobby)
+          cancel_delayed_close_delete_lobby(lobby_id=lobby.id)
+          return
+
+      elif custom_id == 'leave_lobby':
+        result = leave_lobby(message_id=interaction.message_id, player_id=player.id)
+        lobby = result.get('lobby')
+
+        if result.get('closed', False):
+          lobby.delete_lobby_messages()
+          cancel_delayed_close_delete_lobby(lobby_id=lobby.id)
+          return
+
+      else:
+        lobby = get_lobby(message_id=interaction.message_id)
+
+      if not lobby:
+        return
+
+      bot_lobby_response(interaction=interaction,lobby=lobby)
+
+  else:
+    raise ValueError('Invalid request type')
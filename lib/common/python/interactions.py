@@ -1,11 +1,10 @@
 import os
 from enum import Enum
 from typing import Optional
-import requests
-from pydantic import BaseModel
+from pydantic import BaseModel, root_validator
+from discord_api import discord_client
 
 BOT_APP_ID = os.getenv('BOT_APP_ID')
-BASE_URL = 'https://discord.com/api/v10'
 
 class RequestType(Enum):
   PING = 1
@@ -20,11 +19,19 @@ class ResponseType(Enum):
   APPLICATION_COMMAND_AUTOCOMPLETE_RESULT = 8
 
 def get_message_id(interaction_token: str) -> str:
-  url = f'{BASE_URL}/webhooks/{BOT_APP_ID}/{interaction_token}/messages/@original'
-  initial_response = requests.get(url)
+  path = f'/webhooks/{BOT_APP_ID}/{interaction_token}/messages/@original'
+  initial_response = discord_client.get(path, auth=False)
   initial_response_json = initial_response.json()
   return initial_response_json['id']
 
+def get_response_message_id(callback_response: dict) -> Optional[str]:
+  interaction = callback_response.get('interaction') or {}
+  message_id = interaction.get('response_message_id')
+  if not message_id:
+    message = (callback_response.get('resource') or {}).get('message') or {}
+    message_id = message.get('id')
+  return message_id
+
 class Channel(BaseModel):
   id: str
   name: str
@@ -35,18 +42,62 @@ class Interaction(BaseModel):
   token: str
   channel: Channel
   acked: Optional[bool] = False
+  ephemeral: Optional[bool] = False
   message_id: Optional[str] = None
 
+  @root_validator(pre=True)
+  def set_component_message_id(cls, values):
+    # component interactions carry the message they are attached to, which is
+    # the message a deferred update acts on, so no lookup is needed later
+    message = values.get('message')
+    if not values.get('message_id') and isinstance(message, dict):
+      values['message_id'] = message.get('id')
+    return values
+
   def get_message_id(self):
-    url = f'{BASE_URL}/webhooks/{BOT_APP_ID}/{self.token}/messages/@original'
+    path = f'/webhooks/{BOT_APP_ID}/{self.token}/messages/@original'
     if not self.acked:
       raise ValueError('Interaction must be acknowledged before getting message ID')
-    initial_response = requests.get(url)
+    initial_response = discord_client.get(path, auth=False)
     initial_response_json = initial_response.json()
     self.message_id = initial_response_json['id']
 
+  def delete_original(self):
+    path = f'/webhooks/{BOT_APP_ID}/{self.token}/messages/@original'
+    discord_client.delete(path, auth=False)
+
+  def deferred_response(self, response_type, ephemeral=False) -> dict:
+    """Build a deferred acknowledgement to return as the HTTP response body.
+    The interaction is marked as acknowledged, so later ack calls made while
+    processing it only resolve the message ID instead of POSTing a callback.
+    """
+    response = {'type': response_type}
+    if ephemeral:
+      response['data'] = {'flags': 64}
+    self.acked = True
+    self.ephemeral = ephemeral
+    return response
+
   def ack(self, response_type, ephemeral=False, payload=None):
-    url = f'{BASE_URL}/interactions/{self.id}/{self.token}/callback'
+    if self.acked:
+      if (
+        ephemeral and not self.ephemeral and
+        response_type == ResponseType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value
+      ):
+        # a public deferred message cannot become ephemeral, so remove it and
+        # let the ephemeral followup be sent as a new message
+        self.delete_original()
+        self.ephemeral = True
+      elif (
+        not ephemeral and not self.message_id and
+        response_type == ResponseType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value
+      ):
+        # the inline response carries no message ID, so look up the deferred
+        # message that lobby creation edits
+        self.get_message_id()
+      return
+
+    path = f'/interactions/{self.id}/{self.token}/callback'
 
     if payload is None:
       payload = {}
@@ -62,11 +113,20 @@ class Interaction(BaseModel):
     if ephemeral:
       json_data['data']['flags'] = 64
 
-    reply_response = requests.post(url, json=json_data)
-    reply_response.raise_for_status()
+    needs_message_id = (
+      response_type != ResponseType.APPLICATION_COMMAND_AUTOCOMPLETE_RESULT.value and
+      not self.message_id
+    )
+    # with_response makes Discord return the ID of the message created by the
+    # callback, saving a separate GET of @original
+    params = {'with_response': 'true'} if needs_message_id else None
+    reply_response = discord_client.post(path, auth=False, params=params, json=json_data)
     self.acked = True
-    if response_type != ResponseType.APPLICATION_COMMAND_AUTOCOMPLETE_RESULT.value:
-      self.get_message_id()
+    self.ephemeral = ephemeral
+    if needs_message_id:
+      self.message_id = get_response_message_id(reply_response.json())
+      if not self.message_id:
+        self.get_message_id()
 
   def ack_application_command(self, ephemeral=False):
     self.ack(
@@ -0,0 +1,88 @@
+from urllib.parse import quote
+from database import get_db
+from island_search import island_search_loader, SEARCH_RESULT_LIMIT, MAX_TOKEN_LENGTH
+
+PREFIX_COLLECTION = 'island_prefixes'
+PREFIX_RESULT_LIMIT = SEARCH_RESULT_LIMIT
+MAX_PREFIX_LENGTH = MAX_TOKEN_LENGTH
+
+def get_top_10_islands():
+  try:
+    top_10_doc = get_db().collection('top_10_islands').document('latest').get()
+    if not top_10_doc.exists:
+      print("No top 10 islands document found")
+      return []
+    islands = top_10_doc.to_dict().get('islands', [])
+    return islands
+  except Exception as error:
+    print(f"Error fetching top 10 islands: {error}")
+    return []
+
+def get_prefix_document_id(prefix: str) -> str:
+  # document IDs cannot contain "/" or be "." or "..", so percent-encode them
+  return quote(prefix, safe='').replace('.', '%2E')
+
+def normalize_query(query: str) -> str:
+  return ' '.join(query.lower().split())
+
+def matches_query(island: dict, query: str) -> bool:
+  name = normalize_query(island['name'])
+  return name.startswith(query) or f' {query}' in name
+
+def get_prefix_islands(query: str) -> list[dict]:
+  """Read the islands materialized by index_islands for a search prefix.
+  Queries longer than MAX_PREFIX_LENGTH read the document of their leading
+  characters and keep the islands that match the whole query.
+  """
+  query = normalize_query(query)
+  try:
+    prefix_doc = get_db().collection(PREFIX_COLLECTION).document(
+      get_prefix_document_id(query[:MAX_PREFIX_LENGTH].rstrip())
+    ).get()
+    if not prefix_doc.exists:
+      return []
+    islands = prefix_doc.to_dict().get('islands', [])
+    if len(query) > MAX_PREFIX_LENGTH:
+      islands = [island for island in islands if matches_query(island, query)]
+    return islands
+  except Exception as error:
+    print(f"Error reading islands for prefix {query}: {error}")
+    return []
+
+def format_choices(
+  islands: list[dict],
+  include_owner: bool = True,
+  include_player_count: bool = False,
+  include_favorited_count: bool = False,
+  include_self: bool = True
+):
+  choices = []
+  for island in islands:
+    name = island['name']
+    if include_owner:
+      name += f" | 👤 {island['owner']['nickname']}"
+    if include_player_count:
+      name += f" | 🟢 {island['player_count']} online"
+    if include_favorited_count:
+      name += f" | ⭐ {island['favorited_count']} favorited"
+    choices.append({
+      'name': name,
+      'value': island['id']
+    })
+  if include_self:
+    choices.insert(0, {"name": "🏠 My Island", "value": "my"})
+  return choices
+
+def generate_island_choices(query:str)->list[dict]:
+  if not query or query == "":
+    islands = get_top_10_islands()
+    choices = format_choices(islands, include_player_count=True)
+    return choices
+  search_index = island_search_loader.get_index()
+  if search_index:
+    islands = search_index.search(query)
+  else:
+    # the in-memory index is still loading on this instance
+    islands = get_prefix_islands(query)
+  choices = format_choices(islands, include_player_count=False, include_favorited_count=True)
+  return choices
@@ -0,0 +1,195 @@
+import time
+import heapq
+import bisect
+import threading
+from typing import Dict, List, Optional
+from database import get_db
+
+SEARCH_RESULT_LIMIT = 24 # Discord allows 25 choices and "My Island" takes one
+MAX_SUFFIX_LENGTH = 64
+MAX_TOKEN_LENGTH = 20
+TYPO_MIN_QUERY_LENGTH = 4
+TYPO_MIN_SIMILARITY = 0.5
+SNAPSHOT_COLLECTION = 'island_search_snapshots'
+SNAPSHOT_CHUNK_SIZE = 2000
+SNAPSHOT_REFRESH_SECONDS = 300
+
+def normalize(text: str) -> str:
+  return ' '.join(text.lower().split())
+
+def get_trigrams(text: str) -> set:
+  padded = f'  {text} '
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def generate_search_tokens(name: str) -> List[str]:
+  """Prefixes of each word followed by the next word, capped at
+  MAX_TOKEN_LENGTH characters and without duplicates. This matches the same
+  queries as the previous adjacent word pair tokens up to that length.
+  """
+  words = normalize(name).split(' ')
+  tokens = set()
+  for i in range(len(words)):
+    token_string = ' '.join(words[i:i + 2])[:MAX_TOKEN_LENGTH]
+    tokens.update(token_string[:j + 1].rstrip() for j in range(len(token_string)))
+  tokens.discard('')
+  return sorted(tokens)
+
+def compact_island(island: Dict) -> list:
+  owner = island.get('owner') or {}
+  return [
+    island['id'],
+    island['name'],
+    owner.get('nickname') or owner.get('username'),
+    island.get('favorited_count') or 0,
+    island.get('player_count') or 0
+  ]
+
+def expand_island(compact: list) -> Dict:
+  island_id, name, owner_nickname, favorited_count, player_count = compact
+  return {
+    'id': island_id,
+    'name': name,
+    'owner': {'nickname': owner_nickname},
+    'favorited_count': favorited_count,
+    'player_count': player_count
+  }
+
+class IslandSearchIndex:
+  """In-memory island search ranked by favorited count.
+  Every word-start suffix of an island name is kept in a sorted array, so a
+  query matches at least the islands generate_search_tokens would and is
+  answered with two binary searches. When a query of TYPO_MIN_QUERY_LENGTH or
+  more characters has too few prefix matches, islands sharing most of its
+  trigrams are added after them.
+  """
+
+  def __init__(self, islands: List[Dict], version: Optional[str] = None):
+    self.version = version
+    # position in self.islands is the rank, so lower is better
+    self.islands = sorted(islands, key=lambda island: island['favorited_count'], reverse=True)
+    suffixes = []
+    self.trigram_postings = {}
+    for rank, island in enumerate(self.islands):
+      name = normalize(island['name'])
+      words = name.split(' ')
+      offset = 0
+      for word in words:
+        suffixes.append((name[offset:offset + MAX_SUFFIX_LENGTH], rank))
+        offset += len(word) + 1
+      for trigram in get_trigrams(name):
+        self.trigram_postings.setdefault(trigram, []).append(rank)
+    suffixes.sort()
+    self.suffix_keys = [suffix for suffix, _ in suffixes]
+    self.suffix_ranks = [rank for _, rank in suffixes]
+
+  def prefix_ranks(self, query: str) -> set:
+    start = bisect.bisect_left(self.suffix_keys, query)
+    end = bisect.bisect_left(self.suffix_keys, query + '\uffff', lo=start)
+    return set(self.suffix_ranks[start:end])
+
+  def typo_ranks(self, query: str, exclude: set, limit: int) -> List[int]:
+    query_trigrams = get_trigrams(query)
+    shared_counts = {}
+    for trigram in query_trigrams:
+      for rank in self.trigram_postings.get(trigram, []):
+        shared_counts[rank] = shared_counts.get(rank, 0) + 1
+    min_shared = len(query_trigrams) * TYPO_MIN_SIMILARITY
+    candidates = [
+      (-shared, rank) for rank, shared in shared_counts.items()
+      if shared >= min_shared and rank not in exclude
+    ]
+    return [rank for _, rank in heapq.nsmallest(limit, candidates)]
+
+  def search(self, query: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Dict]:
+    query = normalize(query)[:MAX_SUFFIX_LENGTH]
+    if not query:
+      return self.islands[:limit]
+    ranks = heapq.nsmallest(limit, self.prefix_ranks(query))
+    if len(ranks) < limit and len(query) >= TYPO_MIN_QUERY_LENGTH:
+      ranks += self.typo_ranks(query, exclude=set(ranks), limit=limit - len(ranks))
+    return [self.islands[rank] for rank in ranks]
+
+def write_search_snapshot(islands: List[Dict], version: str):
+  """Store a compact copy of the indexed islands for IslandSearchIndex.
+  Chunks are written under the new version before the latest pointer is
+  moved to it, so readers never see a partial snapshot.
+  """
+  snapshots_ref = get_db().collection(SNAPSHOT_COLLECTION)
+  latest_ref = snapshots_ref.document('latest')
+  latest_doc = latest_ref.get()
+  previous = latest_doc.to_dict() if latest_doc.exists else None
+
+  compact_islands = [compact_island(island) for island in islands]
+  chunks = [
+    compact_islands[i:i + SNAPSHOT_CHUNK_SIZE]
+    for i in range(0, len(compact_islands), SNAPSHOT_CHUNK_SIZE)
+  ]
+  chunks_ref = snapshots_ref.document(version).collection('chunks')
+  for i, chunk in enumerate(chunks):
+    # Firestore does not allow nested arrays, so each island is a map entry
+    chunks_ref.document(str(i)).set({
+      'islands': {str(j): island for j, island in enumerate(chunk)}
+    })
+  latest_ref.set({'version': version, 'chunk_count': len(chunks), 'island_count': len(islands)})
+  print(f"Wrote island search snapshot {version} with {len(islands)} islands")
+
+  if previous and previous.get('version') != version:
+    previous_chunks_ref = snapshots_ref.document(previous['version']).collection('chunks')
+    for i in range(previous.get('chunk_count', 0)):
+      previous_chunks_ref.document(str(i)).delete()
+
+def read_search_snapshot(known_version: Optional[str] = None) -> Optional[IslandSearchIndex]:
+  """Returns a new index, or None if there is no snapshot or it is unchanged."""
+  snapshots_ref = get_db().collection(SNAPSHOT_COLLECTION)
+  latest_doc = snapshots_ref.document('latest').get()
+  if not latest_doc.exists:
+    return None
+  latest = latest_doc.to_dict()
+  if latest['version'] == known_version:
+    return None
+  chunks_ref = snapshots_ref.document(latest['version']).collection('chunks')
+  islands = []
+  for i in range(latest['chunk_count']):
+    chunk = chunks_ref.document(str(i)).get().to_dict()['islands']
+    islands.extend(expand_island(chunk[str(j)]) for j in range(len(chunk)))
+  return IslandSearchIndex(islands=islands, version=latest['version'])
+
+class IslandSearchLoader:
+  """Keeps the instance's IslandSearchIndex in step with the latest snapshot.
+  get_index never blocks on Firestore: a missing or stale index is refreshed
+  in a background thread and the current one (or None) is returned meanwhile.
+  """
+
+  def __init__(self, refresh_seconds: int = SNAPSHOT_REFRESH_SECONDS):
+    self.refresh_seconds = refresh_seconds
+    self.lock = threading.Lock()
+    self.index = None
+    self.checked_at = None
+    self.refreshing = False
+
+  def refresh(self):
+    try:
+      known_version = self.index.version if self.index else None
+      index = read_search_snapshot(known_version=known_version)
+      if index:
+        self.index = index
+        print(f"Loaded island search snapshot {index.version} with {len(index.islands)} islands")
+    except Exception as error:
+      print(f"Error loading island search snapshot: {error}")
+    finally:
+      with self.lock:
+        self.checked_at = time.monotonic()
+        self.refreshing = False
+
+  def get_index(self) -> Optional[IslandSearchIndex]:
+    with self.lock:
+      is_stale = (
+        self.checked_at is None or
+        time.monotonic() - self.checked_at > self.refresh_seconds
+      )
+      if is_stale and not self.refreshing:
+        self.refreshing = True
+        threading.Thread(target=self.refresh, name='island-search-refresh', daemon=True).start()
+    return self.index
+
+island_search_loader = IslandSearchLoader()
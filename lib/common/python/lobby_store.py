@@ -0,0 +1,148 @@
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+# gen2 throttles CPU outside of requests, so a listener can fall behind while
+# it still looks active. Older snapshots are not served; snapshots only arrive
+# on changes, so a quiet store falls back too, costing only the query it saves
+SNAPSHOT_MAX_AGE_SECONDS = 5
+
+class OpenLobbyStore: # pylint: disable=too-many-instance-attributes
+  """Per-instance copy of the open lobbies, kept current by a Firestore
+  on_snapshot listener on the open lobbies query.
+  The listener is started on first use once the store is enabled. Until the
+  first snapshot arrives, whenever the listener is no longer active, or when
+  the last snapshot is older than max_snapshot_age_seconds, the lookups
+  return None so callers fall back to querying Firestore directly.
+  Lobbies are returned as deep copies because callers mutate them.
+  """
+
+  def __init__(self, max_snapshot_age_seconds: float = SNAPSHOT_MAX_AGE_SECONDS):
+    self.max_snapshot_age_seconds = max_snapshot_age_seconds
+    self.lock = threading.Lock()
+    self.start_lock = threading.Lock()
+    self.enabled = False
+    self.query_factory = None
+    self.parse = None
+    self.watch = None
+    self.synced = False
+    self.lobbies = {}
+    self.message_index = {}
+    self.stats = {
+      'snapshots': 0,
+      'hits': 0,
+      'fallbacks': 0,
+      'stale_fallbacks': 0,
+      'restarts': 0,
+      'last_snapshot_at': None,
+      'read_time': None
+    }
+
+  def enable(self, query_factory: Callable[[], Any], parse: Callable[[Any], Any]):
+    """Args:
+      query_factory: Builds the Firestore query for open lobbies.
+      parse: Turns a document snapshot into a Lobby.
+    """
+    self.query_factory = query_factory
+    self.parse = parse
+    self.enabled = True
+
+  def start(self):
+    with self.start_lock:
+      if self.watch is not None and self.watch.is_active:
+        return
+      if self.watch is not None:
+        self.stats['restarts'] += 1
+        try:
+          # unsubscribing joins the listener thread, so it must not hold self.lock
+          self.watch.unsubscribe()
+        except Exception as error:
+          print(f"Failed to stop open lobby listener: {error}")
+      with self.lock:
+        self.synced = False
+        self.lobbies = {}
+        self.message_index = {}
+      self.watch = self.query_factory().on_snapshot(self.on_snapshot)
+
+  def is_live(self) -> bool:
+    if not self.enabled:
+      return False
+    if self.watch is None or not self.watch.is_active:
+      self.start()
+      return False
+    if not self.synced:
+      return False
+    snapshot_age_seconds = time.time() - self.stats['last_snapshot_at']
+    if snapshot_age_seconds > self.max_snapshot_age_seconds:
+      self.stats['stale_fallbacks'] += 1
+      print({
+        'metric': 'open_lobby_store_stale',
+        'snapshot_age_seconds': round(snapshot_age_seconds, 1),
+        'stale_fallbacks': self.stats['stale_fallbacks']
+      })
+      return False
+    return True
+
+  def on_snapshot(self, docs, changes, read_time):
+    # pylint: disable=unused-argument
+    with self.lock:
+      for change in changes:
+        doc = change.document
+        self.remove(doc.id)
+        if change.type.name != 'REMOVED':
+          try:
+            self.add(doc.id, self.parse(doc))
+          except Exception as error:
+            print(f"Failed to parse open lobby {doc.id}: {error}")
+      self.synced = True
+      self.stats['snapshots'] += 1
+      self.stats['last_snapshot_at'] = time.time()
+      self.stats['read_time'] = str(read_time)
+    print({'metric': 'open_lobby_store', **self.get_stats()})
+
+  def add(self, lobby_id: str, lobby):
+    self.lobbies[lobby_id] = lobby
+    for message_id in lobby.lobby_message_ids or [lobby_id]:
+      self.message_index[message_id] = lobby_id
+
+  def remove(self, lobby_id: str):
+    lobby = self.lobbies.pop(lobby_id, None)
+    if lobby:
+      for message_id in lobby.lobby_message_ids or [lobby_id]:
+        self.message_index.pop(message_id, None)
+
+  def record_lookup(self, hit: bool):
+    self.stats['hits' if hit else 'fallbacks'] += 1
+
+  def get_open_lobbies(self) -> Optional[List]:
+    if not self.is_live():
+      self.record_lookup(hit=False)
+      return None
+    with self.lock:
+      lobbies = [lobby.copy(deep=True) for lobby in self.lobbies.values()]
+    self.record_lookup(hit=True)
+    return lobbies
+
+  def get_open_lobby(self, message_id: str):
+    """Returns the open lobby for a message, or None when the message does not
+    belong to an open lobby or the store is not live. Closed lobbies are never
+    held here, so a miss must be resolved with a direct query.
+    """
+    if not self.is_live():
+      self.record_lookup(hit=False)
+      return None
+    with self.lock:
+      lobby_id = self.message_index.get(message_id)
+      lobby = self.lobbies.get(lobby_id) if lobby_id else None
+      lobby = lobby.copy(deep=True) if lobby else None
+    self.record_lookup(hit=lobby is not None)
+    return lobby
+
+  def get_stats(self) -> Dict:
+    last_snapshot_at = self.stats['last_snapshot_at']
+    return {
+      **self.stats,
+      'live': self.synced and self.watch is not None and self.watch.is_active,
+      'open_lobbies': len(self.lobbies),
+      'snapshot_age_seconds': time.time() - last_snapshot_at if last_snapshot_at else None
+    }
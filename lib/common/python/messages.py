@@ -1,72 +1,108 @@
-import os
-from typing import Optional
+from typing import Optional, List
 import requests
-from cloud_tasks import create_http_task
-from interactions import Interaction
-
-REGION = os.getenv('REGION')
-PROJECT_ID = os.getenv('PROJECT_ID')
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-BASE_URL = 'https://discord.com/api/v10/channels'
-
-headers = {
-  'Authorization': f'Bot {BOT_TOKEN}',
-  'Content-Type': 'application/json'
-}
-
-def get_messages(channel_id):
-  url = f'{BASE_URL}/{channel_id}/messages'
-  params = {'limit': 100}
-  response = requests.get(url, params=params, headers=headers)
-  response.raise_for_status()
+from discord_api import discord_client
+from utils import calc_snowflake_age_seconds
+
+MESSAGES_PAGE_SIZE = 100
+BULK_DELETE_MAX_MESSAGES = 100
+# Discord rejects bulk deletes containing messages older than 14 days; keep a
+# margin for messages that cross the limit while the request is in flight
+BULK_DELETE_MAX_AGE_SECONDS = 14 * 24 * 3600 - 600
+
+def get_messages(channel_id, after: Optional[str] = None, before: Optional[str] = None):
+  params = {'limit': MESSAGES_PAGE_SIZE}
+  if after:
+    params['after'] = after
+  if before:
+    params['before'] = before
+  response = discord_client.get(f'/channels/{channel_id}/messages', params=params)
   messages = response.json()
   return messages
 
+def get_messages_after(channel_id, after: str, max_pages: int) -> List[dict]:
+  """All messages newer than the after message ID, oldest pages first."""
+  messages = []
+  for _ in range(max_pages):
+    page = get_messages(channel_id=channel_id, after=after)
+    messages.extend(page)
+    if len(page) < MESSAGES_PAGE_SIZE:
+      break
+    after = max(page, key=lambda message: int(message['id']))['id']
+  return messages
+
+def get_messages_before(channel_id, max_pages: int, before: Optional[str] = None) -> List[dict]:
+  """Messages older than the before message ID (or the newest messages),
+  newest pages first."""
+  messages = []
+  for _ in range(max_pages):
+    page = get_messages(channel_id=channel_id, before=before)
+    messages.extend(page)
+    if len(page) < MESSAGES_PAGE_SIZE:
+      break
+    before = min(page, key=lambda message: int(message['id']))['id']
+  return messages
+
+def get_pinned_messages(channel_id) -> List[dict]:
+  response = discord_client.get(f'/channels/{channel_id}/pins')
+  return response.json()
+
+def get_pinned_message_ids(channel_id) -> List[str]:
+  return [message['id'] for message in get_pinned_messages(channel_id)]
+
 def delete_message(channel_id, message_id):
-  url = f'{BASE_URL}/{channel_id}/messages/{message_id}'
-  response = requests.delete(url, headers=headers)
-  response.raise_for_status()
+  discord_client.delete(f'/channels/{channel_id}/messages/{message_id}')
+
+def delete_message_if_exists(channel_id, message_id):
+  try:
+    delete_message(channel_id=channel_id, message_id=message_id)
+  except requests.HTTPError as error:
+    if error.response is None or error.response.status_code != 404:
+      raise
 
 def bulk_delete_messages(channel_id, messages):
-  url = f'{BASE_URL}/{channel_id}/messages/bulk-delete'
   payload = {"messages": messages}
-  response = requests.post(url, headers=headers, json=payload)
-  response.raise_for_status()
-
-def delayed_delete_ephemeral_message(
-  interaction: Interaction,
-  delay_in_seconds: int,
-  message_id: Optional[str] = None
-):
-  url=f'https://{REGION}-{PROJECT_ID}.cloudfunctions.net/delete_ephemeral_message'
-  create_http_task(
-    queue='delayed-task-queue',
-    url=url,
-    json_payload={
-      'interaction': interaction.dict(),
-      'message_id': message_id
-    },
-    delay_in_seconds=delay_in_seconds
+  discord_client.post(
+    f'/channels/{channel_id}/messages/bulk-delete',
+    idempotent=True,
+    json=payload
   )
 
+def delete_messages(channel_id, message_ids: List[str]):
+  """Delete messages with as few requests as Discord's bulk delete limits
+  allow: up to 100 messages per request and none older than 14 days. Older
+  messages and a single leftover message are deleted one by one, ignoring
+  messages that are already gone.
+  """
+  recent_ids = []
+  for message_id in message_ids:
+    if calc_snowflake_age_seconds(message_id) < BULK_DELETE_MAX_AGE_SECONDS:
+      recent_ids.append(message_id)
+    else:
+      delete_message_if_exists(channel_id=channel_id, message_id=message_id)
+  for i in range(0, len(recent_ids), BULK_DELETE_MAX_MESSAGES):
+    chunk = recent_ids[i:i + BULK_DELETE_MAX_MESSAGES]
+    if len(chunk) == 1:
+      delete_message_if_exists(channel_id=channel_id, message_id=chunk[0])
+    else:
+      bulk_delete_messages(channel_id=channel_id, messages=chunk)
+
+def edit_message(channel_id, message_id, payload):
+  discord_client.patch(f'/channels/{channel_id}/messages/{message_id}', json=payload)
+
 def update_message(channel_id, message_id, content):
-  url = f"{BASE_URL}/{channel_id}/messages/{message_id}"
-  payload = {"content": content}
-  response = requests.patch(url, headers=headers, json=payload)
-  response.raise_for_status()
+  edit_message(channel_id, message_id, {"content": content})
 
-def create_message(channel_id, content) -> str:
-  url = f"{BASE_URL}/{channel_id}/messages"
-  payload = {"content": content}
-  response = requests.post(url, headers=headers, json=payload)
-  response.raise_for_status()
+def send_message(channel_id, payload) -> str:
+  response = discord_client.post(f'/channels/{channel_id}/messages', json=payload)
   return response.json()['id']
 
+def create_message(channel_id, content) -> str:
+  return send_message(channel_id, {"content": content})
+
 def pin_message(channel_id, message_id):
-  url = f"{BASE_URL}/{channel_id}/pins/{message_id}"
-  response = requests.put(url, headers=headers)
-  response.raise_for_status()
+  discord_client.put(f'/channels/{channel_id}/pins/{message_id}')
 
-def create_pinned_message(channel_id, content):
+def create_pinned_message(channel_id, content) -> str:
   new_message_id = create_message(channel_id, content)
   pin_message(channel_id, new_message_id)
+  return new_message_id
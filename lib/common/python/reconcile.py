@@ -0,0 +1,18 @@
+import json
+import hashlib
+from typing import Dict, Optional
+from database import get_db
+
+APPLIED_STATE_COLLECTION = 'applied_state'
+
+def get_state_hash(state) -> str:
+  """Stable hash of a JSON serializable desired state, independent of key order."""
+  serialized = json.dumps(state, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def get_applied_state(key: str) -> Optional[Dict]:
+  doc = get_db().collection(APPLIED_STATE_COLLECTION).document(key).get()
+  return doc.to_dict() if doc.exists else None
+
+def set_applied_state(key: str, state: Dict):
+  get_db().collection(APPLIED_STATE_COLLECTION).document(key).set(state)
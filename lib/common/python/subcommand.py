@@ -1,6 +1,4 @@
-import os
 from typing import Optional
-import yaml
 from discord import (
   bot_lobby_response,
   bot_followup_response,
@@ -10,6 +8,7 @@ from database import (
   get_lobby_creation_eligibility,
   delayed_close_delete_lobby,
   GAME_TYPES,
+  LOBBY_EXPIRY_SECONDS,
   Game,
   Island,
   Player,
@@ -20,13 +19,7 @@ from pydantic import BaseModel, validator
 from utils import now_iso_str, wrap_error_message, wrap_success_message
 from interactions import Interaction, ResponseType, RequestType
 from island_choices import generate_island_choices
-
-ENV = os.getenv('ENV')
-
-with open('channels.yaml', 'r', encoding='utf-8') as file:
-  channels_config = yaml.safe_load(file)
-
-LOBBY_CHANNELS = channels_config[ENV]['lobby_channels']
+from configs import get_lobby_channels
 
 subcommand_game_type_map = {
   'ctf': 'CTF',
@@ -62,7 +55,7 @@ class Subcommand(BaseModel):
 
   @validator('interaction', always=True, pre=True)
   def validate_channel_id(cls, interaction):
-    if interaction.channel.id not in LOBBY_CHANNELS:
+    if interaction.channel.id not in get_lobby_channels():
       handle_subcommand_error(interaction, DiscordErrorType.INVALID_CHANNEL)
     return interaction
 
@@ -134,6 +127,15 @@ class Subcommand(BaseModel):
       query = values.get('subcommand_options')[0]['value']
     return query
 
+def deny_lobby_creation(interaction: Interaction, error_message: str):
+  interaction.ack_application_command(ephemeral=True)
+  bot_followup_response(
+    interaction=interaction,
+    ephemeral=True,
+    json={'content': error_message}
+  )
+  abort(400, 'Lobby creation not allowed')
+
 def handle_subcommand(subcommand: Subcommand, player: Player):
   if subcommand.interaction.request_type == RequestType.APPLICATION_COMMAND_AUTOCOMPLETE:
     choices = generate_island_choices(query=subcommand.query)
@@ -143,7 +145,8 @@ def handle_subcommand(subcommand: Subcommand, player: Player):
     island = None
     if subcommand.island_id and subcommand.island_id not in ['my', 'random']:
       island = Island(id=subcommand.island_id)
-      island.get_url()
+      if not island.get_url():
+        handle_subcommand_error(subcommand.interaction, DiscordErrorType.UNKNOWN_ISLAND)
 
     if subcommand.island_id == 'my':
       island = player.island
@@ -158,13 +161,7 @@ def handle_subcommand(subcommand: Subcommand, player: Player):
     error_message = eligibility.get('error_message', 'Lobby creation not allowed')
 
     if not is_eligible:
-      subcommand.interaction.ack_application_command(ephemeral=True)
-      bot_followup_response(
-        interaction=subcommand.interaction,
-        ephemeral=True,
-        json={'content': error_message}
-      )
-      abort(400, 'Lobby creation not allowed')
+      deny_lobby_creation(interaction=subcommand.interaction, error_message=error_message)
 
     subcommand.interaction.ack_application_command()
 
@@ -179,11 +176,18 @@ def handle_subcommand(subcommand: Subcommand, player: Player):
       status='open',
       players=[player]
     )
-    lobby.create()
+    # the eligibility above is re-checked atomically with the write, so a
+    # concurrent create or join between the two is still rejected
+    creation = lobby.create()
+    if not creation.get('eligibility', False):
+      deny_lobby_creation(
+        interaction=subcommand.interaction,
+        error_message=creation.get('error_message', 'Lobby creation not allowed')
+      )
     delayed_close_delete_lobby(
       channel_id=lobby.channel_id,
       lobby_id=lobby.id,
-      delay_in_seconds=1200,
+      delay_in_seconds=LOBBY_EXPIRY_SECONDS,
       only_if_open=True
     )
     bot_lobby_response(
@@ -203,7 +207,8 @@ def handle_subcommand(subcommand: Subcommand, player: Player):
   if subcommand.subcommand_group == 'set' and subcommand.subcommand == 'island':
     subcommand.interaction.ack_application_command(ephemeral=True)
     island = Island(id=subcommand.island_id)
-    island.get_url()
+    if not island.get_url():
+      handle_subcommand_error(subcommand.interaction, DiscordErrorType.UNKNOWN_ISLAND)
     player.set_island(island)
     bot_followup_response(
       interaction=subcommand.interaction,
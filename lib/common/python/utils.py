@@ -1,12 +1,31 @@
-import pandas as pd
+from datetime import datetime, timezone
+
+DISCORD_EPOCH_MS = 1420070400000
+
+def parse_timestamp(timestamp) -> datetime:
+  if isinstance(timestamp, datetime):
+    parsed = timestamp
+  else:
+    # fromisoformat in python 3.10 does not accept a trailing Z
+    parsed = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+  if parsed.tzinfo is None:
+    parsed = parsed.replace(tzinfo=timezone.utc)
+  return parsed
 
 def calc_age_seconds(timestamp):
-  timestamp = pd.Timestamp(timestamp)
-  now = pd.Timestamp.now(tz='UTC')
-  return (now - timestamp).total_seconds()
+  now = datetime.now(timezone.utc)
+  return (now - parse_timestamp(timestamp)).total_seconds()
+
+def get_snowflake_timestamp(snowflake) -> datetime:
+  # the top 42 bits of a Discord ID are milliseconds since the Discord epoch
+  milliseconds = (int(snowflake) >> 22) + DISCORD_EPOCH_MS
+  return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc)
+
+def calc_snowflake_age_seconds(snowflake):
+  return calc_age_seconds(get_snowflake_timestamp(snowflake))
 
 def now_iso_str():
-  now = pd.Timestamp.now(tz='UTC')
+  now = datetime.now(timezone.utc)
   return now.isoformat()
 
 def wrap_error_message(message: str):
@@ -1,54 +1,226 @@
-import os
-import yaml
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
 import functions_framework
-from database import get_lobby
-from messages import get_messages, delete_message, bulk_delete_messages
-from utils import calc_age_seconds
+from pydantic import BaseModel, validator, ValidationError
+from configs import get_lobby_channels
+from database import get_db, get_open_lobbies
+from messages import (
+  get_messages_after,
+  get_messages_before,
+  get_pinned_message_ids,
+  delete_messages
+)
+from utils import calc_snowflake_age_seconds
+from fanout import fan_out
 
-ENV = os.getenv('ENV')
+CURSOR_COLLECTION = 'cleanup_cursors'
+INCREMENTAL_MAX_PAGES = 10
+DEEP_SWEEP_MAX_PAGES = 50
+# incremental runs skip a channel while a deep sweep holds it, the hold
+# expires on its own if the deep sweep dies
+DEEP_SWEEP_LEASE_SECONDS = 300
+CURSOR_TRANSACTION_MAX_ATTEMPTS = 5
 
-with open('channels.yaml', 'r', encoding='utf-8') as file:
-  channels_config = yaml.safe_load(file)
+# bot messages are only deleted once they are old enough, so until then they
+# are kept in the cursor as pending with one of these kinds
+PENDING_MAX_AGE_SECONDS = {
+  # failed bot commands
+  'empty': 300,
+  # lobby messages, normally deleted when the lobby closes
+  'lobby': 3600,
+  # any other bot message
+  'content': 3600
+}
 
-LOBBY_CHANNELS = channels_config[ENV]['lobby_channels']
+class CleanupRequest(BaseModel):
+  mode: Optional[str] = 'incremental'
+
+  @validator('mode')
+  def validate_mode(cls, mode):
+    if mode not in ['incremental', 'deep']:
+      raise ValueError('Invalid mode')
+    return mode
+
+class ChannelCursor(BaseModel):
+  """Cleanup progress of a channel.
+  last_message_id is the newest message already processed, so the next run
+  only fetches messages after it. pending maps bot message IDs that are not
+  yet old enough to delete to their kind. version is bumped by every write,
+  so a run only writes the cursor if nobody else did since it was read.
+  deep_sweep_until is set while a deep sweep holds the channel.
+  """
+  last_message_id: Optional[str] = None
+  pending: Dict[str, str] = {}
+  version: int = 0
+  deep_sweep_until: Optional[datetime] = None
+
+  def is_held_by_deep_sweep(self) -> bool:
+    return bool(self.deep_sweep_until) and self.deep_sweep_until > datetime.now(timezone.utc)
+
+def get_cursor_ref(channel: str):
+  return get_db().collection(CURSOR_COLLECTION).document(channel)
+
+def read_cursor(channel: str, transaction=None) -> ChannelCursor:
+  doc = get_cursor_ref(channel).get(transaction=transaction)
+  return ChannelCursor(**doc.to_dict()) if doc.exists else ChannelCursor()
+
+def run_cursor_transaction(transaction_function, *args):
+  # pylint: disable=import-outside-toplevel,no-member
+  from firebase_admin import firestore
+  transaction = get_db().transaction(max_attempts=CURSOR_TRANSACTION_MAX_ATTEMPTS)
+  return firestore.transactional(transaction_function)(transaction, *args)
+
+def hold_cursor_transaction(transaction, channel: str) -> ChannelCursor:
+  cursor = read_cursor(channel, transaction=transaction)
+  cursor.deep_sweep_until = datetime.now(timezone.utc) + timedelta(seconds=DEEP_SWEEP_LEASE_SECONDS)
+  cursor.version += 1
+  transaction.set(get_cursor_ref(channel), cursor.dict())
+  return cursor
+
+def write_cursor_transaction(transaction, channel: str, cursor: ChannelCursor) -> bool:
+  if read_cursor(channel, transaction=transaction).version != cursor.version:
+    return False
+  transaction.set(get_cursor_ref(channel), {**cursor.dict(), 'version': cursor.version + 1})
+  return True
+
+def write_cursor(channel: str, cursor: ChannelCursor):
+  """Write the cursor unless another run wrote it since it was read, that run's
+  cursor wins and this run's messages are seen again by the next one."""
+  if not run_cursor_transaction(write_cursor_transaction, channel, cursor):
+    print({'metric': 'cleanup_cursor_conflict', 'channel': channel})
+
+def get_pending_kind(message: dict, open_lobby_ids: dict) -> str:
+  if not message.get('content'):
+    return 'empty'
+  if message['id'] in open_lobby_ids:
+    return 'lobby'
+  return 'content'
+
+def scan_channel(channel: str, open_lobby_ids: dict, deep: bool) -> dict:
+  """Find the messages to delete and the open lobbies to close in a channel.
+  Incremental scans only fetch messages newer than the cursor; deep scans
+  page through the channel history and rebuild the cursor from it, holding
+  the channel so incremental scans skip it meanwhile.
+  """
+  if deep:
+    cursor = run_cursor_transaction(hold_cursor_transaction, channel)
+    # released by the cursor write at the end of the sweep
+    cursor.deep_sweep_until = None
+  else:
+    cursor = read_cursor(channel)
+    if cursor.is_held_by_deep_sweep():
+      return {
+        'cursor': cursor,
+        'messages_to_delete': [],
+        'lobbies_to_close': set(),
+        'skipped': True
+      }
+
+  if deep or not cursor.last_message_id:
+    max_pages = DEEP_SWEEP_MAX_PAGES if deep else 1
+    messages = get_messages_before(channel_id=channel, max_pages=max_pages)
+    cursor.pending = {}
+  else:
+    messages = get_messages_after(
+      channel_id=channel,
+      after=cursor.last_message_id,
+      max_pages=INCREMENTAL_MAX_PAGES
+    )
+
+  messages_to_delete = []
+  lobbies_to_close = set()
+  fetched_ids = set()
+  for message in messages:
+    message_id = message['id']
+    fetched_ids.add(message_id)
+    if not cursor.last_message_id or int(message_id) > int(cursor.last_message_id):
+      cursor.last_message_id = message_id
+    if message.get('pinned', False):
+      continue
+    ## non-bot messages
+    if not message['author'].get('bot', False):
+      messages_to_delete.append(message_id)
+      continue
+    cursor.pending[message_id] = get_pending_kind(message, open_lobby_ids)
+
+  due_ids = [
+    message_id for message_id, kind in cursor.pending.items()
+    if calc_snowflake_age_seconds(message_id) > PENDING_MAX_AGE_SECONDS[kind]
+  ]
+  # pending messages fetched in earlier runs may have been pinned since
+  pinned_ids = set()
+  if any(message_id not in fetched_ids for message_id in due_ids):
+    pinned_ids = set(get_pinned_message_ids(channel_id=channel))
+  for message_id in due_ids:
+    kind = cursor.pending.pop(message_id)
+    if message_id in pinned_ids:
+      continue
+    lobby_id = open_lobby_ids.get(message_id)
+    if lobby_id:
+      # lobby messages older than 1 hour. Should be handled by other logic;
+      # closing the lobby deletes its messages in every channel
+      lobbies_to_close.add(lobby_id)
+    elif kind != 'lobby':
+      # lobby messages of lobbies that are no longer open were deleted on close
+      messages_to_delete.append(message_id)
+
+  return {
+    'cursor': cursor,
+    'messages_to_delete': messages_to_delete,
+    'lobbies_to_close': lobbies_to_close,
+    'skipped': False
+  }
+
+def clean_channel(channel: str, scan: dict):
+  if scan['skipped']:
+    return
+  delete_messages(channel_id=channel, message_ids=scan['messages_to_delete'])
+  # the cursor only moves on once the deletes went through, so a failed run
+  # is retried from the same position
+  write_cursor(channel, scan['cursor'])
 
 @functions_framework.http
 def handler(request):
-  # pylint: disable=unused-argument
-  for channel in LOBBY_CHANNELS:
-    messages_to_delete = []
-    messages = get_messages(channel_id=channel)
-    for message in messages:
-      message_id = message.get('id')
-      is_bot = message['author'].get('bot', False)
-      is_pinned = message.get('pinned', False)
-      content = message.get('content')
-      age_seconds = calc_age_seconds(message['timestamp'])
-
-      if not is_pinned:
-        ## non-bot messages
-        if not is_bot:
-          messages_to_delete.append(message_id)
-          continue
-
-        ## failed bot commands older than 5 minutes
-        if (not content or content == '') and age_seconds > 300:
-          messages_to_delete.append(message_id)
-          continue
-
-        ## lobby messages older than 1 hour. Should be handled by other logic
-        if is_bot and content and content != '' and age_seconds > 3600:
-          try:
-            lobby = get_lobby(message_id)
-            lobby.close()
-          except:
-            print(f"Failed to close lobby {message_id}")
-          messages_to_delete.append(message_id)
-
-    if len(messages_to_delete) == 1:
-      delete_message(channel_id=channel, message_id=messages_to_delete[0])
-
-    if len(messages_to_delete) > 1:
-      bulk_delete_messages(channel_id=channel, messages=messages_to_delete)
+  request_json = request.get_json(silent=True) or {}
+  try:
+    cleanup_request = CleanupRequest(**request_json)
+  except ValidationError as validation_error:
+    return f'Problem parsing input. {validation_error}', 400
+  deep = cleanup_request.mode == 'deep'
+
+  open_lobbies = {lobby.id: lobby for lobby in get_open_lobbies()}
+  open_lobby_ids = {
+    message_id: lobby.id
+    for lobby in open_lobbies.values()
+    for message_id in lobby.lobby_message_ids or [lobby.id]
+  }
+
+  scans = fan_out({
+    channel: partial(scan_channel, channel=channel, open_lobby_ids=open_lobby_ids, deep=deep)
+    for channel in get_lobby_channels()
+  })['results']
+
+  # lobbies are closed here rather than in the channel scans because closing
+  # fans out its own message deletes
+  for lobby_id in set().union(*[scan['lobbies_to_close'] for scan in scans.values()]):
+    try:
+      open_lobbies[lobby_id].close()
+    except Exception as error:
+      print(f"Failed to close lobby {lobby_id}: {error}")
+
+  fan_out({
+    channel: partial(clean_channel, channel=channel, scan=scan)
+    for channel, scan in scans.items()
+  })
 
+  print({
+    'metric': 'cleanup_channel',
+    'mode': cleanup_request.mode,
+    'channels': len(scans),
+    'skipped_channels': sum(scan['skipped'] for scan in scans.values()),
+    'deleted': sum(len(scan['messages_to_delete']) for scan in scans.values()),
+    'closed_lobbies': sum(len(scan['lobbies_to_close']) for scan in scans.values()),
+    'pending': sum(len(scan['cursor'].pending) for scan in scans.values())
+  })
   return "OK", 200
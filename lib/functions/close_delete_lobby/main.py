@@ -17,9 +17,12 @@ def handler(request):
     return f'Problem parsing input. {validation_error}', 400
 
   lobby = get_lobby(message_id=config.lobby_id)
-
-  if config.only_if_open and lobby.status != 'open':
+  if not lobby or (config.only_if_open and lobby.status != 'open'):
+    # lobbies that close early cancel this task, so this should be rare
+    print({'metric': 'delayed_close_task', 'outcome': 'fired_noop', 'lobby_id': config.lobby_id})
     return "OK", 200
 
-  lobby.close()
+  # this is the delayed close task itself, there is nothing to cancel
+  lobby.close(cancel_delayed_close=False)
+  print({'metric': 'delayed_close_task', 'outcome': 'fired', 'lobby_id': config.lobby_id})
   return "OK", 200
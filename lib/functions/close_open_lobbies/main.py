@@ -1,24 +1,39 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 import functions_framework
-from database import get_open_lobbies
+from database import get_expired_lobbies, close_lobbies, LOBBY_EXPIRY_SECONDS
 from pydantic import BaseModel, ValidationError
-from utils import calc_age_seconds
+
+SWEEP_BATCH_LIMIT = 500
 
 class CloseOpenLobbiesRequest(BaseModel):
-  age_threshold_seconds: int
+  # lobbies older than this are closed; defaults to their stored expiry
+  age_threshold_seconds: Optional[int] = LOBBY_EXPIRY_SECONDS
 
 @functions_framework.http
 def handler(request):
-  request_json = request.get_json(silent=True)
+  request_json = request.get_json(silent=True) or {}
   try:
     config = CloseOpenLobbiesRequest(**request_json)
   except ValidationError as validation_error:
     return f'Problem parsing input. {validation_error}', 400
 
-  lobbies = get_open_lobbies()
-
-  for lobby in lobbies:
-    age_seconds = calc_age_seconds(lobby.creation_time)
-    if age_seconds > config.age_threshold_seconds:
-      lobby.close()
+  # expires_at is creation_time + LOBBY_EXPIRY_SECONDS, so shift the cutoff
+  # to close lobbies created more than age_threshold_seconds ago
+  expired_before = datetime.now(timezone.utc) + timedelta(
+    seconds=LOBBY_EXPIRY_SECONDS - config.age_threshold_seconds
+  )
+  closed_count = 0
+  while True:
+    lobbies = get_expired_lobbies(expired_before=expired_before, limit=SWEEP_BATCH_LIMIT)
+    if not lobbies:
+      break
+    closed = close_lobbies(lobbies)
+    closed_count += len(closed)
+    # lobbies that failed to close are read again by the next query, so a
+    # batch that closes nothing would be repeated forever
+    if not closed or len(lobbies) < SWEEP_BATCH_LIMIT:
+      break
 
+  print({'metric': 'close_open_lobbies', 'closed': closed_count})
   return "OK", 200
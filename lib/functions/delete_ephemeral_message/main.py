@@ -1,19 +1,22 @@
 import os
 from typing import Optional
-import requests
 import functions_framework
 from pydantic import ValidationError, BaseModel
-from discord import Interaction
+from interactions import Interaction
+from discord_api import discord_client
+from ephemeral_deletions import delete_bucket
 
 class DeleteEphemeralMessageConfig(BaseModel):
-  interaction: Interaction
+  bucket: Optional[int] = None
+  # single message tasks created before deletions were bucketed
+  interaction: Optional[Interaction] = None
   message_id: Optional[str] = None
 
   class Config:
     validate_assignment = True
 
 BOT_APP_ID = os.getenv('BOT_APP_ID')
-BASE_URL = f'https://discord.com/api/v10/webhooks/{BOT_APP_ID}'
+WEBHOOK_PATH = f'/webhooks/{BOT_APP_ID}'
 
 @functions_framework.http
 def handler(request):
@@ -23,13 +26,26 @@ def handler(request):
   except ValidationError as validation_error:
     return f'Problem parsing input. {validation_error}', 400
 
+  if config.bucket is not None:
+    metrics = delete_bucket(config.bucket)
+    print(metrics)
+    if metrics['failed'] or metrics['failed_shards']:
+      # Cloud Tasks retries the task, which only repeats the failed items
+      return "Some deletions failed", 500
+    return "OK", 200
+
+  if not config.interaction:
+    return 'Problem parsing input. bucket or interaction is required', 400
+
   if config.message_id:
-    response = requests.delete(
-      url=f'{BASE_URL}/{config.interaction.token}/messages/{config.message_id}'
+    discord_client.delete(
+      f'{WEBHOOK_PATH}/{config.interaction.token}/messages/{config.message_id}',
+      auth=False
     )
   else:
-    response = requests.delete(url=f'{BASE_URL}/{config.interaction.token}/messages/@original')
-
-  response.raise_for_status()
+    discord_client.delete(
+      f'{WEBHOOK_PATH}/{config.interaction.token}/messages/@original',
+      auth=False
+    )
 
   return "OK", 200
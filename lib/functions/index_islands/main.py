@@ -1,16 +1,48 @@
+import json
+import time
+import heapq
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from firebase_admin import firestore
 from flask import jsonify
 import functions_framework
 from pydantic import BaseModel, validator, ValidationError
-from database import Island
+from database import Island, get_db
 from utils import now_iso_str
+from bulk_writer import BulkWrites
+from island_search import (
+  write_search_snapshot,
+  generate_search_tokens,
+  compact_island,
+  expand_island
+)
+from island_choices import (
+  get_prefix_document_id,
+  PREFIX_COLLECTION,
+  PREFIX_RESULT_LIMIT
+)
+
+MANIFEST_COLLECTION = 'island_index_manifest'
+MANIFEST_CHUNK_SIZE = 5000
+# prefix document IDs are short, so more of them fit in a 1 MiB chunk
+PREFIX_MANIFEST_COLLECTION = 'island_prefix_manifest'
+PREFIX_MANIFEST_CHUNK_SIZE = 10000
+# live values that change on nearly every run and are not read from the
+# stored islands, so they do not count as a change on their own
+VOLATILE_ISLAND_FIELDS = ['player_count']
+# a run that indexes fewer islands than this share of the previous run is
+# treated as incomplete, so an upstream outage cannot delist the catalogue
+MIN_INDEXED_SHARE = 0.9
 
 ISLANDS_ENDPOINT = 'https://api.niftyisland.com/api/v2/islands'
+ISLANDS_PAGE_SIZE = 500
+FETCH_MAX_WORKERS = 8
+FETCH_MAX_RETRIES = 3
+FETCH_BACKOFF_SECONDS = 1
+FETCH_TIMEOUT_SECONDS = 30
 
-db = firestore.client()
-collection_ref = db.collection('islands')
-top_10_collection_ref = db.collection('top_10_islands')
+session = requests.Session()
 
 class IslandIndexRequest(BaseModel):
   request_type: str
@@ -21,39 +53,31 @@ class IslandIndexRequest(BaseModel):
       raise ValidationError('Invalid request type')
     return request_type
 
-def pull_islands_batch(limit: int, offset: int, order: str = None) -> dict:
-  try:
-    params = {'limit': limit, 'offset': offset}
-    if order:
-      params['order'] = order
-    response = requests.get(ISLANDS_ENDPOINT, params=params)
-    response.raise_for_status()
-    return response.json()
-  except Exception as error:
-    print(f"Error fetching islands with offset {offset}: {error}")
-    return {}
-
-def generate_search_tokens(name: str) -> list[str]:
-  prefixes = []
-  tokens = name.lower().split()
-  adjacent_token_strings = []
-
-  for i in range(len(tokens) - 1):
-    adjacent_token_strings.append(f"{tokens[i]} {tokens[i + 1]}")
-  adjacent_token_strings.append(f"{tokens[-1]}")
-
-  for token_string in adjacent_token_strings:
-    for i in range(len(token_string)):
-      prefixes.append(token_string[:i+1])
-
-  return prefixes
+def pull_islands_batch(
+  limit: int,
+  offset: int,
+  order: str = None,
+  max_retries: int = FETCH_MAX_RETRIES
+) -> dict:
+  params = {'limit': limit, 'offset': offset}
+  if order:
+    params['order'] = order
+  for attempt in range(max_retries + 1):
+    try:
+      response = session.get(ISLANDS_ENDPOINT, params=params, timeout=FETCH_TIMEOUT_SECONDS)
+      response.raise_for_status()
+      return response.json()
+    except Exception as error:
+      print(f"Error fetching islands with offset {offset} (attempt {attempt + 1}): {error}")
+      if attempt < max_retries:
+        time.sleep(FETCH_BACKOFF_SECONDS * 2 ** attempt)
+  return {}
 
 def validate_islands(islands: list[dict]) -> list[dict]:
   return [
     Island(**{
       'id': island['valueId'],
       'name': island['name'],
-      'search_tokens': generate_search_tokens(name=island['name']),
       'url': f"https://niftyis.land/{island['owner']['username']}/{island['deeplinkIndex']}",
       'player_count': island['playerCount'],
       'owner': island['owner'],
@@ -62,39 +86,275 @@ def validate_islands(islands: list[dict]) -> list[dict]:
     for island in islands if island['bloomsPlaced'] >= 25 and island['favoritedCount'] >= 5
   ]
 
-def process_and_write_batch(ref: str, islands: list[dict]):
-  validated_islands = validate_islands(islands=islands)
-  if validated_islands:
-    batch_write_to_firestore(ref, validated_islands)
+class IndexStats:
+  """Item counts and busy time per pipeline stage of a full index run."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started_at = time.monotonic()
+    self.stages = {
+      stage: {'items': 0, 'seconds': 0.0}
+      for stage in ['fetch', 'validate']
+    }
+    self.missing_pages = []
+    self.changes = {'created': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0, 'failed': 0}
+
+  def record_changes(self, change: str, count: int = 1):
+    with self.lock:
+      self.changes[change] += count
+
+  def record(self, stage: str, items: int, started_at: float):
+    with self.lock:
+      self.stages[stage]['items'] += items
+      self.stages[stage]['seconds'] += time.monotonic() - started_at
+
+  def record_missing_page(self, offset: int):
+    with self.lock:
+      self.missing_pages.append(offset)
+
+  def summary(self) -> dict:
+    elapsed_seconds = time.monotonic() - self.started_at
+    summary = {
+      'metric': 'index_all_islands',
+      'elapsed_seconds': round(elapsed_seconds, 1),
+      'missing_pages': sorted(self.missing_pages),
+      **self.changes
+    }
+    for stage, values in self.stages.items():
+      summary[f'{stage}_items'] = values['items']
+      summary[f'{stage}_items_per_second'] = round(values['items'] / elapsed_seconds, 1)
+      summary[f'{stage}_busy_seconds'] = round(values['seconds'], 1)
+    return summary
+
+def fetch_page(offset: int, stats: IndexStats) -> list[dict]:
+  started_at = time.monotonic()
+  islands = pull_islands_batch(ISLANDS_PAGE_SIZE, offset).get('items')
+  if islands is None:
+    stats.record_missing_page(offset)
+    return []
+  stats.record('fetch', len(islands), started_at)
+  return islands
+
+def get_content_hash(content) -> str:
+  return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+
+def get_island_hash(island: dict) -> str:
+  return get_content_hash(
+    {key: value for key, value in island.items() if key not in VOLATILE_ISLAND_FIELDS}
+  )
+
+def read_index_manifest(collection_name: str = MANIFEST_COLLECTION) -> dict:
+  """Returns the content hash of every document written by earlier runs."""
+  hashes = {}
+  for chunk_doc in get_db().collection(collection_name).stream():
+    hashes.update(chunk_doc.to_dict().get('hashes', {}))
+  return hashes
+
+def write_index_manifest(
+  hashes: dict,
+  collection_name: str = MANIFEST_COLLECTION,
+  chunk_size: int = MANIFEST_CHUNK_SIZE
+):
+  collection = get_db().collection(collection_name)
+  existing_ids = {doc.id for doc in collection.stream()}
+  doc_ids = sorted(hashes)
+  chunk_ids = set()
+  for i in range(0, len(doc_ids), chunk_size):
+    chunk_id = str(i // chunk_size)
+    chunk_ids.add(chunk_id)
+    chunk_doc_ids = doc_ids[i:i + chunk_size]
+    collection.document(chunk_id).set({
+      'hashes': {doc_id: hashes[doc_id] for doc_id in chunk_doc_ids}
+    })
+  for chunk_id in existing_ids - chunk_ids:
+    collection.document(chunk_id).delete()
+
+def read_previous_hashes(manifest_collection: str, collection) -> dict:
+  """Returns the manifest's hashes. Without a manifest, every existing
+  document is returned without a hash, so documents written before the
+  manifest existed are rewritten once and the ones that no longer exist are
+  deleted.
+  """
+  previous_hashes = read_index_manifest(manifest_collection)
+  if not previous_hashes:
+    previous_hashes = {doc.id: None for doc in collection.stream()}
+  return previous_hashes
+
+def index_pages(total: int, previous_hashes: dict, stats: IndexStats, bulk_writes) -> tuple:
+  """Fetch every page and queue the new or changed islands on bulk_writes.
+  Returns the indexed islands and their hashes, both keyed by island ID.
+  """
+  islands_collection = get_db().collection('islands')
+  indexed_islands = {}
+  hashes = {}
+  # pages are fetched concurrently and each page's new or changed islands are
+  # queued on the bulk writer while later pages are still being fetched
+  with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as fetch_executor:
+    fetch_futures = [
+      fetch_executor.submit(fetch_page, offset, stats)
+      for offset in range(0, total, ISLANDS_PAGE_SIZE)
+    ]
+    for fetch_future in as_completed(fetch_futures):
+      started_at = time.monotonic()
+      validated_islands = validate_islands(islands=fetch_future.result())
+      for island in validated_islands:
+        if island['id'] in indexed_islands:
+          # pages can overlap when islands are added during the run
+          continue
+        indexed_islands[island['id']] = island
+        hashes[island['id']] = get_island_hash(island)
+        if island['id'] not in previous_hashes:
+          stats.record_changes('created')
+        elif previous_hashes[island['id']] != hashes[island['id']]:
+          stats.record_changes('updated')
+        else:
+          stats.record_changes('unchanged')
+          continue
+        bulk_writes.set(islands_collection.document(island['id']), island)
+      stats.record('validate', len(validated_islands), started_at)
+  return indexed_islands, hashes
+
+def is_complete_run(indexed_islands: dict, previous_hashes: dict, stats: IndexStats) -> bool:
+  if len(indexed_islands) < MIN_INDEXED_SHARE * len(previous_hashes):
+    print(
+      f"Indexed {len(indexed_islands)} of {len(previous_hashes)} known islands, "
+      "treating the run as incomplete"
+    )
+    return False
+  # islands on a missing page were not seen, so nothing can be delisted
+  return not stats.missing_pages
+
+def delist_islands(
+  indexed_islands: dict,
+  previous_hashes: dict,
+  stats: IndexStats,
+  bulk_writes
+) -> list[str]:
+  """Queue the deletion of known islands a complete run did not index.
+  Returns the delisted island IDs.
+  """
+  islands_collection = get_db().collection('islands')
+  delisted_ids = sorted(set(previous_hashes) - set(indexed_islands))
+  for island_id in delisted_ids:
+    bulk_writes.delete(islands_collection.document(island_id))
+  stats.record_changes('deleted', len(delisted_ids))
+  return delisted_ids
+
+def update_index_manifest(
+  hashes: dict,
+  previous_hashes: dict,
+  is_complete: bool,
+  delisted_ids: list[str],
+  failed_paths: list[str]
+):
+  # keep the earlier hashes of unseen islands and of failed deletes, and drop
+  # the hashes of failed writes, so the next run retries both
+  manifest = hashes if is_complete else {**previous_hashes, **hashes}
+  for failed_path in failed_paths:
+    island_id = failed_path.split('/')[-1]
+    if island_id in delisted_ids:
+      manifest[island_id] = previous_hashes[island_id]
+    else:
+      manifest.pop(island_id, None)
+  write_index_manifest(manifest)
 
 def index_all_islands():
   try:
     # Fetch the first batch to get the total count
     initial_response = pull_islands_batch(1, 0)
-    total = initial_response.get('total', 0)
+    total = initial_response.get('total')
     print(f"Total islands: {total}")
+    if not total:
+      # without a total no page is fetched, and an empty run would delist
+      # every island
+      print("Skipping index run, the island total could not be fetched")
+      return
 
-    for offset in range(0, total, 500):
-      batch_response = pull_islands_batch(500, offset)
-      islands = batch_response.get('items', [])
-      print(f"Fetched {offset + len(islands)} / {total} islands so far")
+    previous_hashes = read_previous_hashes(MANIFEST_COLLECTION, get_db().collection('islands'))
+    stats = IndexStats()
+    with BulkWrites('index_all_islands') as bulk_writes:
+      indexed_islands, hashes = index_pages(total, previous_hashes, stats, bulk_writes)
+      is_complete = is_complete_run(indexed_islands, previous_hashes, stats)
+      delisted_ids = []
+      if is_complete:
+        delisted_ids = delist_islands(indexed_islands, previous_hashes, stats, bulk_writes)
+    stats.record_changes('failed', len(bulk_writes.failed_paths))
+    update_index_manifest(
+      hashes,
+      previous_hashes,
+      is_complete,
+      delisted_ids,
+      bulk_writes.failed_paths
+    )
+    print(stats.summary())
 
-      # Process and write the batch
-      process_and_write_batch(ref=collection_ref, islands=islands)
+    if not is_complete:
+      # a partial snapshot would hide the missing islands from autocomplete
+      print("Skipping search snapshot of an incomplete run")
+      return
+
+    version = now_iso_str().replace(':', '-')
+    # snapshot consumed by the in-memory autocomplete search of each instance
+    write_search_snapshot(islands=list(indexed_islands.values()), version=version)
+    # per-prefix results read by instances whose in-memory index is not loaded
+    materialize_prefixes(islands=list(indexed_islands.values()))
 
   except Exception as error:
     print(f"Error during data fetch and processing: {error}")
 
-def batch_write_to_firestore(collection, items):
-  try:
-    batch = db.batch()
-    for item in items:
-      doc_ref = collection.document(item['id'])
-      batch.set(doc_ref, item)
-    batch.commit()
-    print(f"Successfully wrote {len(items)} items to Firestore")
-  except Exception as error:
-    print(f"Error writing to Firestore: {error}")
+def materialize_prefixes(islands: list[dict]):
+  """Write the top islands by favorited count for every search token prefix
+  to island_prefixes, so autocomplete reads one bounded document per query.
+  Like the islands, prefix documents are only written when their content
+  hash changed, and only prefixes that no longer exist are deleted.
+  """
+  top_islands = {}
+  for position, island in enumerate(islands):
+    entry = (island['favorited_count'] or 0, -position)
+    # tokens are only needed here, so they are no longer stored on islands
+    for prefix in generate_search_tokens(island['name']):
+      heap = top_islands.setdefault(prefix, [])
+      if len(heap) < PREFIX_RESULT_LIMIT:
+        heapq.heappush(heap, entry)
+      elif entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+
+  # only the fields format_choices needs are stored
+  compact_islands = [expand_island(compact_island(island)) for island in islands]
+  prefix_docs = {
+    get_prefix_document_id(prefix): {
+      'prefix': prefix,
+      'islands': [
+        compact_islands[-negative_position]
+        for _, negative_position in sorted(heap, reverse=True)
+      ]
+    }
+    for prefix, heap in top_islands.items()
+  }
+  hashes = {doc_id: get_content_hash(prefix_doc) for doc_id, prefix_doc in prefix_docs.items()}
+
+  collection = get_db().collection(PREFIX_COLLECTION)
+  previous_hashes = read_previous_hashes(PREFIX_MANIFEST_COLLECTION, collection)
+  changed_ids = [
+    doc_id for doc_id, doc_hash in hashes.items() if previous_hashes.get(doc_id) != doc_hash
+  ]
+  removed_ids = sorted(set(previous_hashes) - set(hashes))
+  with BulkWrites('island_prefixes') as bulk_writes:
+    for doc_id in changed_ids:
+      bulk_writes.set(collection.document(doc_id), prefix_docs[doc_id])
+    for doc_id in removed_ids:
+      bulk_writes.delete(collection.document(doc_id))
+
+  # failed writes and deletes stay in the manifest without a current hash, so
+  # the next run retries both
+  for failed_path in bulk_writes.failed_paths:
+    doc_id = failed_path.split('/')[-1]
+    hashes[doc_id] = None if doc_id in hashes else previous_hashes[doc_id]
+  write_index_manifest(hashes, PREFIX_MANIFEST_COLLECTION, PREFIX_MANIFEST_CHUNK_SIZE)
+  print(
+    f"Materialized {len(prefix_docs)} island prefixes, wrote {len(changed_ids)} "
+    f"and deleted {len(removed_ids)}"
+  )
 
 def index_top_10_islands():
   try:
@@ -109,7 +369,7 @@ def index_top_10_islands():
     }
 
     # Write the top 10 islands data to a new document with the current timestamp
-    top_10_collection_ref.document('latest').set(top_10_doc)
+    get_db().collection('top_10_islands').document('latest').set(top_10_doc)
     print("Successfully updated top 10 islands document")
   except Exception as error:
     print(f"Error fetching and storing top 10 islands: {error}")
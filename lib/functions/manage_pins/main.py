@@ -1,14 +1,8 @@
-import os
-import yaml
 import functions_framework
-from messages import get_messages, update_message, create_pinned_message
-
-ENV = os.getenv('ENV')
-
-with open('channels.yaml', 'r', encoding='utf-8') as file:
-  channels_config = yaml.safe_load(file)
-
-LOBBY_CHANNELS = channels_config[ENV]['lobby_channels']
+from configs import get_lobby_channels
+from messages import get_pinned_messages, update_message, create_pinned_message
+from reconcile import get_state_hash, get_applied_state, set_applied_state
+from utils import now_iso_str
 
 PINNED_MESSAGE = '''
 How to **create** a new lobby:
@@ -18,23 +12,48 @@ How to **create** a new lobby:
 3. start typing `/lobby create` and you will be prompted with different commands for the different game types
 '''
 
+def reconcile_pinned_message(channel: str, content_hash: str, force: bool) -> str:
+  """Make sure the channel has the bot's pinned help message with the current
+  content. Returns the action taken."""
+  state_key = f'pins-{channel}'
+  applied_state = get_applied_state(state_key) or {}
+  if applied_state.get('hash') == content_hash and not force:
+    return 'unchanged'
+
+  pinned_message = None
+  for message in get_pinned_messages(channel_id=channel):
+    if message['author'].get('bot', False):
+      pinned_message = message
+
+  if not pinned_message:
+    message_id = create_pinned_message(channel_id=channel, content=PINNED_MESSAGE)
+    action = 'created'
+  elif pinned_message.get('content', '').strip() != PINNED_MESSAGE.strip():
+    # Discord trims message content, so compare without surrounding whitespace
+    message_id = pinned_message['id']
+    update_message(channel_id=channel, message_id=message_id, content=PINNED_MESSAGE)
+    action = 'updated'
+  else:
+    message_id = pinned_message['id']
+    action = 'verified'
+
+  set_applied_state(state_key, {
+    'hash': content_hash,
+    'message_id': message_id,
+    'applied_at': now_iso_str()
+  })
+  return action
+
 @functions_framework.http
 def handler(request):
-  # pylint: disable=unused-argument
-  for channel in LOBBY_CHANNELS:
-    pinned_message_id = None
-    messages = get_messages(channel_id=channel)
-    for message in messages:
-      message_id = message.get('id')
-      is_bot = message['author'].get('bot', False)
-      is_pinned = message.get('pinned', False)
-      if is_pinned and is_bot:
-        pinned_message_id = message_id
-
-    if pinned_message_id:
-      update_message(channel_id=channel, message_id=pinned_message_id, content=PINNED_MESSAGE)
-
-    else:
-      create_pinned_message(channel_id=channel, content=PINNED_MESSAGE)
+  request_json = request.get_json(silent=True) or {}
+  content_hash = get_state_hash(PINNED_MESSAGE)
+  for channel in get_lobby_channels():
+    action = reconcile_pinned_message(
+      channel=channel,
+      content_hash=content_hash,
+      force=request_json.get('force', False)
+    )
+    print(f"Pinned message in {channel}: {action}")
 
   return "OK", 200
@@ -0,0 +1,39 @@
+import traceback
+from typing import Optional
+import functions_framework
+from pydantic import BaseModel, ValidationError
+from werkzeug.exceptions import HTTPException
+from interactions import Interaction, RequestType
+from interaction_processing import process_interaction
+
+class ProcessInteractionRequest(BaseModel):
+  data: dict
+  ephemeral: Optional[bool] = False
+
+@functions_framework.http
+def handler(request):
+  request_json = request.get_json(silent=True)
+  try:
+    config = ProcessInteractionRequest(**request_json)
+  except ValidationError as validation_error:
+    return f'Problem parsing input. {validation_error}', 400
+
+  data = config.data
+  interaction = Interaction(**{
+    **data,
+    **{'request_type': RequestType(data['type']), 'acked': True, 'ephemeral': config.ephemeral}
+  })
+
+  try:
+    process_interaction(interaction=interaction, data=data)
+  except HTTPException as http_exception:
+    # rejected interactions have already been answered with a followup, so the
+    # task must not be retried
+    print(f'Interaction {interaction.id} rejected: {http_exception.description}')
+  except Exception as error:
+    # the interaction was already acknowledged, and creating or joining a
+    # lobby is not idempotent, so a retry could post duplicate lobby messages
+    # and followups. Failures are logged instead of retried
+    print(f'Interaction {interaction.id} failed: {error}\n{traceback.format_exc()}')
+    print({'metric': 'process_interaction_failed', 'interaction_id': interaction.id})
+  return "OK", 200
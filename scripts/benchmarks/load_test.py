@@ -0,0 +1,502 @@
+"""Load test the interaction path end to end against local stand-ins.
+
+Signed create, join, leave and autocomplete interactions arrive as an open
+loop Poisson stream at --rate per second, spread over the lobby channels of
+--env, and are handled by the real discord_bot handler. The tasks it creates
+(process_interaction, close_delete_lobby, delete_ephemeral_message) run the
+real functions through an in-process Cloud Tasks queue, Discord is a local
+fake REST server with simulated latency and 429s, and Firestore is an
+in-memory fake or the Firestore emulator.
+
+Reports acknowledgement latency (the discord_bot response, which Discord
+needs within 3 seconds) and completion latency (until the deferred work is
+done) per interaction type, Discord calls and Firestore reads/writes per
+interaction, and the peak concurrency of every function, which is the number
+of instances it needs at one request per instance. Exits non-zero when the
+p95 completion latency exceeds --max-p95-ms, so it can gate a build.
+
+All functions run in one interpreter, so they share their per-instance caches
+(players, islands, open lobbies) like a single warm instance would.
+OPEN_LOBBY_STORE and INLINE_ACK are read from the environment as in a deploy.
+
+Usage:
+  python scripts/benchmarks/load_test.py [--rate N] [--duration SECONDS]
+    [--firestore fake|emulator] [--log-file PATH] [--json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import secrets
+import argparse
+import threading
+import traceback
+import contextlib
+import importlib.util
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+FUNCTIONS_PATH = os.path.join(REPO_ROOT, 'lib', 'functions')
+COMMON_PYTHON_PATH = os.path.join(REPO_ROOT, 'lib', 'common', 'python')
+COMMON_CONFIGS_PATH = os.path.join(REPO_ROOT, 'lib', 'common', 'configs')
+sys.path.insert(0, COMMON_PYTHON_PATH)
+
+# pylint: disable=wrong-import-position,import-outside-toplevel
+from nacl.signing import SigningKey
+from stand_ins import fake_discord, fake_firestore, fake_tasks
+
+BOT_APP_ID = '1100000000000000001'
+FUNCTIONS = ['discord_bot', 'process_interaction', 'close_delete_lobby', 'delete_ephemeral_message']
+INTERACTION_MIX = {'create': 0.15, 'join': 0.45, 'leave': 0.1, 'autocomplete': 0.3}
+GAME_SUBCOMMANDS = ['ctf', 'spy_hunt', 'zombies', 'dm_ffa', 'train']
+ISLAND_WORDS = [
+  'bloom', 'port', 'tango', 'mars', 'cats', 'feather', 'frogs', 'pixel', 'castle',
+  'arena', 'sky', 'lagoon', 'jungle', 'neon', 'harbor', 'summit', 'dungeon', 'reef'
+]
+TOP_ISLANDS_COUNT = 10
+PERCENTILES = [50, 95, 99]
+# interactions join and leave lobbies they saw recently, like people do
+RECENT_JOINS_PER_MESSAGE = 10
+
+def get_snowflake() -> str:
+  milliseconds = int(time.time() * 1000) - fake_discord.DISCORD_EPOCH_MS
+  return str((milliseconds << 22) | random.getrandbits(22))
+
+def configure_environment(args, discord_base_url: str, verify_key_hex: str):
+  os.environ.update({
+    'ENV': args.env,
+    'BOT_APP_ID': BOT_APP_ID,
+    'BOT_TOKEN': 'load-test',
+    'BOT_PUBLIC_KEY': verify_key_hex,
+    'REGION': 'load-test',
+    'PROJECT_ID': os.getenv('GOOGLE_CLOUD_PROJECT', 'load-test'),
+    'SERVICE_ACCOUNT': 'load-test@load-test.iam.gserviceaccount.com',
+    'DISCORD_API_BASE_URL': discord_base_url
+  })
+  # configs are read relative to the working directory, as in a bundle
+  os.chdir(COMMON_CONFIGS_PATH)
+
+def load_functions() -> dict:
+  handlers = {}
+  for function in FUNCTIONS:
+    spec = importlib.util.spec_from_file_location(
+      f'{function}_main',
+      os.path.join(FUNCTIONS_PATH, function, 'main.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    handlers[function] = module.handler
+  return handlers
+
+def percentile(values: list, pct: float):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(int(round(pct / 100 * (len(values) - 1))), len(values) - 1)]
+
+class LoadTest: # pylint: disable=too-many-instance-attributes
+  def __init__(self, args, handlers: dict, discord, db, task_queue, signing_key):
+    import flask
+    self.args = args
+    self.handlers = handlers
+    self.discord = discord
+    self.db = db
+    self.task_queue = task_queue
+    self.signing_key = signing_key
+    self.app = flask.Flask('load_test')
+    self.lock = threading.Lock()
+    self.records = {}
+    self.players = []
+    self.islands = []
+    self.recent_joins = defaultdict(lambda: deque(maxlen=RECENT_JOINS_PER_MESSAGE))
+    self.running = Counter()
+    self.peak_concurrency = Counter()
+    self.errors = Counter()
+
+  # functions
+
+  def call_function(self, function: str, **request_kwargs) -> tuple:
+    """Invoke a function handler the way functions_framework does.
+    Returns the status code and the JSON body, if any."""
+    import flask
+    from werkzeug.exceptions import HTTPException
+    with self.lock:
+      self.running[function] += 1
+      self.peak_concurrency[function] = max(self.peak_concurrency[function], self.running[function])
+    try:
+      with self.app.test_request_context(method='POST', **request_kwargs):
+        try:
+          response = self.app.make_response(self.handlers[function](flask.request))
+        except HTTPException as http_exception:
+          return http_exception.code, None
+        except Exception as error:
+          print(f'{function} raised {error!r}\n{traceback.format_exc()}')
+          with self.lock:
+            self.errors[function] += 1
+          return 500, None
+      return response.status_code, response.get_json(silent=True)
+    finally:
+      with self.lock:
+        self.running[function] -= 1
+
+  def dispatch_task(self, function: str, payload: dict) -> int:
+    status, _ = self.call_function(function, json=payload)
+    return status
+
+  def on_task_done(self, function: str, payload: dict, status: int):
+    if function != 'process_interaction':
+      return
+    with self.lock:
+      record = self.records.get(payload['data']['id'])
+      if record is not None:
+        record['completed_at'] = time.perf_counter()
+        record['status'] = status
+
+  # data
+
+  def seed(self):
+    from database import get_db, player_cache, Player, Island
+    from island_search import write_search_snapshot
+    from configs import get_guild_map
+    for i in range(self.args.islands):
+      words = random.sample(ISLAND_WORDS, random.randint(1, 3))
+      owner = f'owner{i}'
+      self.islands.append({
+        'id': secrets.token_hex(12),
+        'name': f"{' '.join(word.title() for word in words)} {i}",
+        'url': f'https://niftyis.land/{owner}/{i}',
+        'owner': {'id': str(i), 'username': owner, 'nickname': owner},
+        'player_count': random.randint(0, 50),
+        'favorited_count': random.randint(0, 500)
+      })
+    islands_ref = get_db().collection('islands')
+    for island in self.islands:
+      islands_ref.document(island['id']).set(island)
+    write_search_snapshot(self.islands, version='load-test')
+    top_islands = sorted(self.islands, key=lambda island: -island['player_count'])
+    get_db().collection('top_10_islands').document('latest').set({
+      'islands': top_islands[:TOP_ISLANDS_COUNT]
+    })
+
+    guild_ids = list(get_guild_map())
+    for i in range(self.args.players):
+      island = random.choice(self.islands)
+      player = Player(
+        id=get_snowflake(),
+        discord_name=f'Player {i}',
+        guild_id=random.choice(guild_ids),
+        username=f'player{i}',
+        island=Island(id=island['id'], name=island['name'], url=island['url'])
+      )
+      player.create()
+      self.players.append(player)
+    # instances start without cached players
+    player_cache.clear()
+
+  # interactions
+
+  def build_interaction(self, kind: str, channels: list) -> dict:
+    player = random.choice(self.players)
+    targets = self.discord.get_join_targets() if kind in ['join', 'leave'] else []
+    target = random.choice(targets) if targets else None
+    if target:
+      with self.lock:
+        recent_joins = self.recent_joins[target[1]]
+        if kind == 'leave' and recent_joins:
+          player = random.choice(list(recent_joins))
+        elif kind == 'join':
+          recent_joins.append(player)
+    data = {
+      'id': get_snowflake(),
+      'application_id': BOT_APP_ID,
+      'token': f'load-test-{secrets.token_urlsafe(24)}',
+      'version': 1,
+      'guild_id': player.guild_id,
+      'member': {'user': {'id': player.id, 'global_name': player.discord_name}}
+    }
+    if target:
+      channel_id, message_id = target
+      data.update({
+        'type': 3,
+        'channel': {'id': channel_id, 'name': 'lobby'},
+        'message': {'id': message_id},
+        'data': {'custom_id': f'{kind}_lobby', 'component_type': 2}
+      })
+      return data
+
+    # without open lobbies players create one instead
+    subcommand = random.choice(GAME_SUBCOMMANDS)
+    channel_id = random.choice(channels)
+    data['channel'] = {'id': channel_id, 'name': 'lobby'}
+    if kind == 'autocomplete':
+      island_name = random.choice(self.islands)['name'].lower()
+      query = island_name[:random.randint(0, 6)]
+      options = [{'type': 3, 'name': 'island', 'value': query, 'focused': True}]
+      data['type'] = 4
+    else:
+      min_players = {'type': 4, 'name': 'min_players', 'value': random.randint(2, 4)}
+      island_id = random.choice(['my', 'random', random.choice(self.islands)['id']])
+      options = [min_players] if subcommand == 'train' else [
+        {'type': 3, 'name': 'island', 'value': island_id},
+        min_players
+      ]
+      data['type'] = 2
+    data['data'] = {
+      'name': 'lobby',
+      'type': 1,
+      'options': [{
+        'type': 2,
+        'name': 'create',
+        'options': [{'type': 1, 'name': subcommand, 'options': options}]
+      }]
+    }
+    return data
+
+  def sign(self, body: str) -> dict:
+    timestamp = str(int(time.time()))
+    signature = self.signing_key.sign(f'{timestamp}{body}'.encode()).signature.hex()
+    return {'X-Signature-Ed25519': signature, 'X-Signature-Timestamp': timestamp}
+
+  def run_interaction(self, kind: str, arrived_at: float, channels: list):
+    data = self.build_interaction(kind, channels)
+    record = {'kind': kind, 'arrived_at': arrived_at, 'completed_at': None, 'status': None}
+    with self.lock:
+      self.records[data['id']] = record
+    self.discord.register_interaction(
+      token=data['token'],
+      channel_id=data['channel']['id'],
+      message_id=data.get('message', {}).get('id')
+    )
+    body = json.dumps(data)
+    status, response = self.call_function(
+      'discord_bot',
+      data=body,
+      headers=self.sign(body),
+      content_type='application/json'
+    )
+    acked_at = time.perf_counter()
+    with self.lock:
+      record['acked_at'] = acked_at
+      is_deferred = status == 200 and response is not None and response.get('type') in [5, 6]
+      if not is_deferred:
+        # answered inline (autocomplete, or INLINE_ACK disabled) or rejected
+        record['completed_at'] = acked_at
+        record['status'] = status
+
+  def run(self) -> dict:
+    from configs import get_lobby_channels
+    channels = get_lobby_channels()
+    kinds = list(INTERACTION_MIX)
+    weights = list(INTERACTION_MIX.values())
+
+    if self.db:
+      self.db.reset_stats()
+    self.discord.reset_stats()
+    self.task_queue.reset_stats()
+    started = time.perf_counter()
+    arrivals = 0
+    with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+      next_arrival = started
+      while next_arrival < started + self.args.duration:
+        wait_seconds = next_arrival - time.perf_counter()
+        if wait_seconds > 0:
+          time.sleep(wait_seconds)
+        kind = random.choices(kinds, weights)[0]
+        # open loop: the arrival time is fixed even if every worker is busy
+        executor.submit(self.run_interaction, kind, next_arrival, channels)
+        arrivals += 1
+        next_arrival += random.expovariate(self.args.rate)
+    self.task_queue.drain(
+      within_seconds=self.args.drain_seconds,
+      timeout=self.args.drain_seconds + 60
+    )
+    elapsed = time.perf_counter() - started
+    return self.summarize(arrivals, elapsed)
+
+  # report
+
+  def summarize(self, arrivals: int, elapsed: float) -> dict:
+    by_kind = defaultdict(lambda: {'ack': [], 'done': [], 'count': 0, 'incomplete': 0, 'failed': 0})
+    with self.lock:
+      records = list(self.records.values())
+    for record in records:
+      for key in [record['kind'], 'all']:
+        summary = by_kind[key]
+        summary['count'] += 1
+        if record.get('acked_at') is not None:
+          summary['ack'].append((record['acked_at'] - record['arrived_at']) * 1000)
+        if record['completed_at'] is None:
+          summary['incomplete'] += 1
+          continue
+        if record['status'] >= 500:
+          summary['failed'] += 1
+        completed_at = max(record['completed_at'], record.get('acked_at') or 0)
+        summary['done'].append((completed_at - record['arrived_at']) * 1000)
+
+    latency = {}
+    for kind, summary in by_kind.items():
+      latency[kind] = {
+        'count': summary['count'],
+        'incomplete': summary['incomplete'],
+        'failed': summary['failed'],
+        'ack_ms': {f'p{pct}': percentile(summary['ack'], pct) for pct in PERCENTILES},
+        'done_ms': {f'p{pct}': percentile(summary['done'], pct) for pct in PERCENTILES}
+      }
+
+    interactions = max(len(records), 1)
+    discord_stats = self.discord.get_stats()
+    discord_calls = sum(discord_stats['calls'].values())
+    firestore = None
+    if self.db:
+      db_stats = self.db.get_stats()
+      firestore = {
+        stat: db_stats.get(stat, 0) / interactions
+        for stat in ['reads', 'writes', 'deletes', 'transaction_retries']
+      }
+      firestore['by_collection'] = {
+        stat: count for stat, count in sorted(db_stats.items()) if ':' in stat
+      }
+    task_stats = self.task_queue.get_stats()
+    return {
+      'rate': self.args.rate,
+      'duration_seconds': self.args.duration,
+      'elapsed_seconds': elapsed,
+      'interactions': arrivals,
+      'errors': dict(self.errors),
+      'latency': latency,
+      'discord': {
+        'calls_per_interaction': discord_calls / interactions,
+        'calls': discord_calls,
+        'rate_limited': sum(discord_stats['rate_limited'].values()),
+        'routes': dict(Counter(discord_stats['calls']).most_common())
+      },
+      'firestore_per_interaction': firestore,
+      'tasks': task_stats['stats'],
+      'peak_concurrency': {
+        **task_stats['peak_concurrency'],
+        'discord_bot': self.peak_concurrency['discord_bot']
+      }
+    }
+
+def format_ms(value) -> str:
+  return f'{value:7.0f}' if value is not None else '      -'
+
+def print_report(result: dict, top_routes: int):
+  print(
+    f"{result['interactions']} interactions at {result['rate']}/s over "
+    f"{result['duration_seconds']}s, errors: {result['errors'] or 'none'}"
+  )
+  print(
+    f"{'type':13}{'count':>6}{'ack p50':>9}{'p95':>8}{'p99':>8}"
+    f"{'done p50':>10}{'p95':>8}{'p99':>8}{'failed':>8}{'pending':>8}"
+  )
+  for kind in [*INTERACTION_MIX, 'all']:
+    summary = result['latency'].get(kind)
+    if not summary:
+      continue
+    ack = summary['ack_ms']
+    done = summary['done_ms']
+    print(
+      f"{kind:13}{summary['count']:6}  {format_ms(ack['p50'])} {format_ms(ack['p95'])} "
+      f"{format_ms(ack['p99'])}   {format_ms(done['p50'])} {format_ms(done['p95'])} "
+      f"{format_ms(done['p99'])}{summary['failed']:8}{summary['incomplete']:8}"
+    )
+  discord = result['discord']
+  print(
+    f"discord: {discord['calls_per_interaction']:.2f} calls/interaction "
+    f"({discord['calls']} calls, {discord['rate_limited']} rate limited)"
+  )
+  firestore = result['firestore_per_interaction']
+  if firestore:
+    print(
+      f"firestore: {firestore['reads']:.2f} reads, {firestore['writes']:.2f} writes, "
+      f"{firestore['deletes']:.2f} deletes per interaction, "
+      f"{firestore['transaction_retries']:.2f} transaction retries"
+    )
+  else:
+    print('firestore: not measured against the emulator')
+  print('peak concurrency (instances at 1 request each): ' + ', '.join(
+    f'{function} {count}' for function, count in sorted(result['peak_concurrency'].items())
+  ))
+  print('tasks: ' + ', '.join(f'{stat} {count}' for stat, count in sorted(result['tasks'].items())))
+  print('top discord routes:')
+  for route, count in list(discord['routes'].items())[:top_routes]:
+    print(f'  {count:7}  {route}')
+
+def main(): # pylint: disable=too-many-locals
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--rate', type=float, default=10, help='interactions per second')
+  parser.add_argument('--duration', type=float, default=30, help='seconds of traffic')
+  parser.add_argument('--concurrency', type=int, default=32, help='interactions handled at once')
+  parser.add_argument('--env', default='prod', help='channels and guilds of this environment')
+  parser.add_argument('--players', type=int, default=200)
+  parser.add_argument('--islands', type=int, default=1000)
+  parser.add_argument('--firestore', choices=['fake', 'emulator'], default='fake')
+  parser.add_argument('--firestore-latency-ms', type=float, default=10)
+  parser.add_argument('--discord-latency-ms', type=float, default=60)
+  parser.add_argument('--discord-429-share', type=float, default=0.01,
+    help='share of Discord requests answered with a 429')
+  parser.add_argument('--task-workers', type=int, default=32)
+  parser.add_argument('--task-time-scale', type=float, default=1.0,
+    help='multiplies task delays, e.g. 0.01 to let lobbies expire during the run')
+  parser.add_argument('--drain-seconds', type=float, default=30,
+    help='also wait for tasks due this long after the traffic ends')
+  parser.add_argument('--seed', type=int, help='random seed for a repeatable traffic mix')
+  parser.add_argument('--log-file', help='where the functions print, discarded by default')
+  parser.add_argument('--json', action='store_true', help='print the result as JSON')
+  parser.add_argument('--top-routes', type=int, default=10)
+  parser.add_argument('--max-p95-ms', type=float, help='fail when p95 completion exceeds this')
+  args = parser.parse_args()
+  if args.seed is not None:
+    random.seed(args.seed)
+
+  discord = fake_discord.FakeDiscord(
+    latency_seconds=args.discord_latency_ms / 1000,
+    rate_limit_share=args.discord_429_share
+  ).start()
+  signing_key = SigningKey.generate()
+  configure_environment(args, discord.base_url, signing_key.verify_key.encode().hex())
+
+  db = None
+  if args.firestore == 'fake':
+    db = fake_firestore.FakeFirestore(latency_seconds=args.firestore_latency_ms / 1000)
+    fake_firestore.install(db)
+  elif not os.getenv('FIRESTORE_EMULATOR_HOST'):
+    parser.error('--firestore emulator needs FIRESTORE_EMULATOR_HOST')
+
+  load_test = None
+  task_queue = fake_tasks.TaskQueue(
+    dispatch=lambda function, payload: load_test.dispatch_task(function, payload),
+    workers=args.task_workers,
+    time_scale=args.task_time_scale,
+    on_done=lambda function, payload, status: load_test.on_task_done(function, payload, status)
+  )
+  fake_tasks.install(task_queue)
+
+  with open(args.log_file or os.devnull, 'w', encoding='utf-8') as log_file:
+    with contextlib.redirect_stdout(log_file):
+      handlers = load_functions()
+      from discord_api import discord_client
+      # the local server is plain HTTP, pool its connections like https ones
+      discord_client.session.mount('http://', discord_client.session.get_adapter('https://'))
+      load_test = LoadTest(args, handlers, discord, db, task_queue, signing_key)
+      load_test.seed()
+      result = load_test.run()
+  task_queue.stop()
+  discord.stop()
+
+  if args.json:
+    print(json.dumps(result, indent=2))
+  else:
+    print_report(result, args.top_routes)
+
+  p95 = result['latency'].get('all', {}).get('done_ms', {}).get('p95')
+  if args.max_p95_ms is not None and (p95 is None or p95 > args.max_p95_ms):
+    measured = f'{p95:.0f} ms' if p95 is not None else 'missing'
+    print(f'p95 completion latency {measured} exceeds the budget of {args.max_p95_ms:.0f} ms')
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
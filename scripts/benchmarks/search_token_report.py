@@ -0,0 +1,97 @@
+"""Compare the size of the legacy and the current island search tokens.
+
+Prints the average token count and token bytes per island for both schemes,
+and the share of legacy tokens (up to MAX_TOKEN_LENGTH characters) that the
+current scheme still matches, which must stay at 100% to keep recall.
+Island names are read from --names-file (one per line) or pulled from the
+Nifty Island API.
+
+Usage:
+  python scripts/benchmarks/search_token_report.py [--names-file PATH] [--limit N]
+"""
+import os
+import sys
+import argparse
+import requests
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lib', 'common', 'python'))
+
+# pylint: disable=wrong-import-position
+from island_search import generate_search_tokens, MAX_TOKEN_LENGTH
+
+ISLANDS_ENDPOINT = 'https://api.niftyisland.com/api/v2/islands'
+PAGE_SIZE = 500
+
+def generate_legacy_search_tokens(name: str) -> list[str]:
+  # the tokenization index_islands stored on every island before
+  prefixes = []
+  tokens = name.lower().split()
+  adjacent_token_strings = []
+
+  for i in range(len(tokens) - 1):
+    adjacent_token_strings.append(f"{tokens[i]} {tokens[i + 1]}")
+  adjacent_token_strings.append(f"{tokens[-1]}")
+
+  for token_string in adjacent_token_strings:
+    for i in range(len(token_string)):
+      prefixes.append(token_string[:i+1])
+
+  return prefixes
+
+def pull_island_names(limit: int) -> list[str]:
+  names = []
+  for offset in range(0, limit, PAGE_SIZE):
+    params = {'limit': min(PAGE_SIZE, limit - offset), 'offset': offset}
+    response = requests.get(ISLANDS_ENDPOINT, params=params, timeout=30)
+    response.raise_for_status()
+    items = response.json().get('items', [])
+    names.extend(item['name'] for item in items)
+    if len(items) < params['limit']:
+      break
+  return names
+
+def summarize(token_lists: list[list[str]]) -> dict:
+  island_count = max(len(token_lists), 1)
+  token_count = sum(len(tokens) for tokens in token_lists)
+  token_bytes = sum(len(token.encode('utf-8')) for tokens in token_lists for token in tokens)
+  return {
+    'tokens_per_island': token_count / island_count,
+    'bytes_per_island': token_bytes / island_count
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--names-file', help='file with one island name per line')
+  parser.add_argument('--limit', type=int, default=5000)
+  args = parser.parse_args()
+
+  if args.names_file:
+    with open(args.names_file, 'r', encoding='utf-8') as file:
+      names = [line.strip() for line in file if line.strip()][:args.limit]
+  else:
+    names = pull_island_names(args.limit)
+
+  legacy_tokens = [generate_legacy_search_tokens(name) for name in names if name.split()]
+  compact_tokens = [generate_search_tokens(name) for name in names if name.split()]
+
+  matched = 0
+  comparable = 0
+  for legacy, compact in zip(legacy_tokens, compact_tokens):
+    compact_set = set(compact)
+    for token in legacy:
+      if len(token) <= MAX_TOKEN_LENGTH and token == token.rstrip():
+        comparable += 1
+        matched += token in compact_set
+
+  print(f'islands: {len(legacy_tokens)}')
+  for label, token_lists in [('legacy', legacy_tokens), ('compact', compact_tokens)]:
+    summary = summarize(token_lists)
+    print(
+      f"{label:8} {summary['tokens_per_island']:8.1f} tokens/island "
+      f"{summary['bytes_per_island']:9.1f} bytes/island"
+    )
+  print(f'legacy tokens still matched: {matched / max(comparable, 1):.2%}')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,401 @@
+"""Local stand-in for the Discord REST API routes the functions call.
+
+Serves the API over HTTP on 127.0.0.1 so requests go through the real
+discord_api client, connection pool and rate limit handling. Channel messages,
+interaction responses and followups are kept in memory with snowflake IDs, so
+message ages and bulk delete limits behave like on Discord. Every response is
+delayed by a simulated latency, carries X-RateLimit-* headers for its bucket,
+and a share of requests is rejected with 429 to exercise the retry path.
+Calls are counted per route with the same route keys as discord_api.get_route.
+"""
+import re
+import json
+import time
+import random
+import threading
+import itertools
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DISCORD_EPOCH_MS = 1420070400000
+API_PREFIX = '/api/v10'
+BUCKET_LIMIT = 50
+BUCKET_WINDOW_SECONDS = 1.0
+
+# (method, path pattern, route key, handler name)
+ROUTES = [
+  ('POST', r'/interactions/(?P<id>\d+)/(?P<token>[^/]+)/callback',
+    'POST /interactions/:id/:token/callback', 'interaction_callback'),
+  ('GET', r'/webhooks/(?P<app>\d+)/(?P<token>[^/]+)/messages/@original',
+    'GET /webhooks/:webhooks/:token/messages/@original', 'get_original'),
+  ('PATCH', r'/webhooks/(?P<app>\d+)/(?P<token>[^/]+)/messages/@original',
+    'PATCH /webhooks/:webhooks/:token/messages/@original', 'edit_original'),
+  ('DELETE', r'/webhooks/(?P<app>\d+)/(?P<token>[^/]+)/messages/@original',
+    'DELETE /webhooks/:webhooks/:token/messages/@original', 'delete_original'),
+  ('POST', r'/webhooks/(?P<app>\d+)/(?P<token>[^/]+)',
+    'POST /webhooks/:webhooks/:token', 'create_followup'),
+  ('DELETE', r'/webhooks/(?P<app>\d+)/(?P<token>[^/]+)/messages/(?P<message>\d+)',
+    'DELETE /webhooks/:webhooks/:token/messages/:id', 'delete_followup'),
+  ('GET', r'/channels/(?P<channel>\d+)/messages',
+    'GET /channels/:channels/messages', 'get_messages'),
+  ('POST', r'/channels/(?P<channel>\d+)/messages',
+    'POST /channels/:channels/messages', 'create_message'),
+  ('POST', r'/channels/(?P<channel>\d+)/messages/bulk-delete',
+    'POST /channels/:channels/messages/bulk-delete', 'bulk_delete'),
+  ('PATCH', r'/channels/(?P<channel>\d+)/messages/(?P<message>\d+)',
+    'PATCH /channels/:channels/messages/:id', 'edit_message'),
+  ('DELETE', r'/channels/(?P<channel>\d+)/messages/(?P<message>\d+)',
+    'DELETE /channels/:channels/messages/:id', 'delete_message'),
+  ('GET', r'/channels/(?P<channel>\d+)/pins',
+    'GET /channels/:channels/pins', 'get_pins'),
+  ('PUT', r'/channels/(?P<channel>\d+)/pins/(?P<message>\d+)',
+    'PUT /channels/:channels/pins/:id', 'pin_message'),
+  ('PUT', r'/applications/(?P<app>\d+)/commands',
+    'PUT /applications/:id/commands', 'overwrite_commands')
+]
+COMPILED_ROUTES = [
+  (method, re.compile(f'^{pattern}$'), route, handler) for method, pattern, route, handler in ROUTES
+]
+
+class ApiError(Exception):
+  def __init__(self, status: int, message: str):
+    super().__init__(message)
+    self.status = status
+
+class FakeDiscord: # pylint: disable=too-many-instance-attributes,too-many-public-methods
+  """In-memory Discord state behind a local HTTP server.
+  Args:
+    latency_seconds: Mean simulated latency of a request, varied by +-50%.
+    rate_limit_share: Share of requests rejected with a 429 before they are
+      handled, as Discord does under load or for shared buckets.
+    bucket_limit: Requests allowed per bucket (route and major parameter)
+      within bucket_window_seconds before requests get a 429.
+  """
+
+  def __init__(
+    self,
+    latency_seconds: float = 0.05,
+    rate_limit_share: float = 0.0,
+    bucket_limit: int = BUCKET_LIMIT,
+    bucket_window_seconds: float = BUCKET_WINDOW_SECONDS
+  ):
+    self.latency_seconds = latency_seconds
+    self.rate_limit_share = rate_limit_share
+    self.bucket_limit = bucket_limit
+    self.bucket_window_seconds = bucket_window_seconds
+    self.lock = threading.Lock()
+    self.sequence = itertools.count()
+    self.messages = {}
+    self.channels = {}
+    self.interactions = {}
+    self.followups = {}
+    self.buckets = {}
+    self.calls = Counter()
+    self.rate_limited = Counter()
+    fake = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def handle_method(self):
+        fake.handle(self)
+
+      do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = handle_method
+
+      def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.server.daemon_threads = True
+    self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}{API_PREFIX}'
+    self.thread = threading.Thread(
+      target=self.server.serve_forever,
+      name='fake-discord',
+      daemon=True
+    )
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  # state
+
+  def next_snowflake(self) -> str:
+    milliseconds = int(time.time() * 1000) - DISCORD_EPOCH_MS
+    return str((milliseconds << 22) | (next(self.sequence) & 0x3FFFFF))
+
+  def add_message(self, channel_id: str, payload: dict) -> dict:
+    message = {
+      'id': self.next_snowflake(),
+      'channel_id': channel_id,
+      'author': {'id': '0', 'bot': True},
+      'content': payload.get('content', ''),
+      'components': payload.get('components', []),
+      'flags': payload.get('flags', 0),
+      'pinned': False
+    }
+    self.messages[message['id']] = message
+    self.channels.setdefault(channel_id, []).append(message['id'])
+    return message
+
+  def remove_message(self, message_id: str) -> bool:
+    message = self.messages.pop(message_id, None)
+    if message is None:
+      return False
+    self.channels[message['channel_id']].remove(message_id)
+    return True
+
+  def register_interaction(self, token: str, channel_id: str, message_id: str = None):
+    """Make an interaction token known before its request is handled.
+    message_id is the message a component interaction is attached to; for
+    commands the original response message is created on the first callback
+    or @original request, like Discord does for a deferred response.
+    """
+    with self.lock:
+      self.interactions[token] = {'channel_id': channel_id, 'message_id': message_id}
+
+  def get_original_message(self, token: str) -> dict:
+    interaction = self.interactions.get(token)
+    if interaction is None:
+      raise ApiError(404, 'Unknown Webhook')
+    if interaction['message_id'] is None:
+      interaction['message_id'] = self.add_message(interaction['channel_id'], {})['id']
+    message = self.messages.get(interaction['message_id'])
+    if message is None:
+      raise ApiError(404, 'Unknown Message')
+    return message
+
+  def get_join_targets(self) -> list:
+    """(channel_id, message_id) of every lobby message with a join button."""
+    with self.lock:
+      return [
+        (message['channel_id'], message['id'])
+        for message in self.messages.values()
+        if any(
+          component.get('custom_id') == 'join_lobby'
+          for row in message['components']
+          for component in row.get('components', [])
+        )
+      ]
+
+  def get_channel_message_count(self) -> int:
+    with self.lock:
+      return len(self.messages)
+
+  def get_followup_count(self) -> int:
+    with self.lock:
+      return len(self.followups)
+
+  def reset_stats(self):
+    with self.lock:
+      self.calls = Counter()
+      self.rate_limited = Counter()
+
+  def get_stats(self) -> dict:
+    with self.lock:
+      return {'calls': dict(self.calls), 'rate_limited': dict(self.rate_limited)}
+
+  # rate limits
+
+  def take_bucket(self, route: str, major_parameter: str) -> dict:
+    """Count a request against its bucket. Returns the rate limit headers,
+    with a retry_after entry if the request must be rejected."""
+    key = f'{route}:{major_parameter}'
+    now = time.monotonic()
+    bucket = self.buckets.get(key)
+    if bucket is None or bucket['reset_at'] <= now:
+      bucket = {'remaining': self.bucket_limit, 'reset_at': now + self.bucket_window_seconds}
+      self.buckets[key] = bucket
+    reset_after = max(bucket['reset_at'] - now, 0.001)
+    headers = {
+      'X-RateLimit-Limit': str(self.bucket_limit),
+      'X-RateLimit-Bucket': f'{abs(hash(route)):x}',
+      'X-RateLimit-Reset-After': f'{reset_after:.3f}'
+    }
+    if bucket['remaining'] <= 0:
+      headers['X-RateLimit-Remaining'] = '0'
+      headers['retry_after'] = reset_after
+      return headers
+    bucket['remaining'] -= 1
+    headers['X-RateLimit-Remaining'] = str(bucket['remaining'])
+    if random.random() < self.rate_limit_share:
+      # a shared resource limit, which does not consume the bucket
+      headers['X-RateLimit-Scope'] = 'shared'
+      headers['retry_after'] = random.uniform(0.05, 0.2)
+    return headers
+
+  # HTTP
+
+  def handle(self, request: BaseHTTPRequestHandler):
+    url = urlparse(request.path)
+    path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+    length = int(request.headers.get('Content-Length') or 0)
+    body = json.loads(request.rfile.read(length) or b'null') if length else None
+
+    matched = next(
+      (
+        (route, handler, pattern.match(path).groupdict())
+        for method, pattern, route, handler in COMPILED_ROUTES
+        if method == request.command and pattern.match(path)
+      ),
+      None
+    )
+    if self.latency_seconds:
+      time.sleep(self.latency_seconds * random.uniform(0.5, 1.5))
+    if matched is None:
+      self.respond(request, 404, {'message': '404: Not Found', 'code': 0})
+      return
+    route, handler, params = matched
+    major_parameter = params.get('channel') or (
+      f"{params['app']}/{params['token']}" if 'token' in params and 'app' in params else ''
+    )
+
+    with self.lock:
+      self.calls[route] += 1
+      headers = self.take_bucket(route, major_parameter)
+      retry_after = headers.pop('retry_after', None)
+      if retry_after is not None:
+        self.rate_limited[route] += 1
+    if retry_after is not None:
+      headers['Retry-After'] = str(max(int(retry_after), 1))
+      self.respond(request, 429, {
+        'message': 'You are being rate limited.',
+        'retry_after': retry_after,
+        'global': False
+      }, headers)
+      return
+
+    is_bot_route = route.startswith(('GET /channels', 'POST /channels', 'PATCH /channels',
+      'DELETE /channels', 'PUT /channels', 'PUT /applications'))
+    if is_bot_route and not (request.headers.get('Authorization') or '').startswith('Bot '):
+      self.respond(request, 401, {'message': '401: Unauthorized', 'code': 0}, headers)
+      return
+
+    try:
+      with self.lock:
+        status, payload = getattr(self, handler)(params, parse_qs(url.query), body)
+    except ApiError as error:
+      status, payload = error.status, {'message': str(error), 'code': 10008}
+    self.respond(request, status, payload, headers)
+
+  def respond(self, request, status: int, payload=None, headers: dict = None):
+    data = json.dumps(payload).encode() if payload is not None else b''
+    request.send_response(status)
+    for name, value in (headers or {}).items():
+      request.send_header(name, value)
+    if data:
+      request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Length', str(len(data)))
+    request.end_headers()
+    request.wfile.write(data)
+
+  # route handlers, called with self.lock held
+
+  def interaction_callback(self, params, query, body):
+    response_type = body['type']
+    message = None
+    if response_type in (4, 5):
+      message = self.get_original_message(params['token'])
+      if response_type == 4:
+        message.update({key: value for key, value in body.get('data', {}).items() if key != 'tts'})
+    if query.get('with_response') != ['true']:
+      return 204, None
+    return 200, {
+      'interaction': {
+        'id': params['id'],
+        'type': response_type,
+        'response_message_id': message['id'] if message else None
+      },
+      'resource': {'type': response_type, 'message': message}
+    }
+
+  def get_original(self, params, query, body):
+    return 200, self.get_original_message(params['token'])
+
+  def edit_original(self, params, query, body):
+    message = self.get_original_message(params['token'])
+    message.update({key: value for key, value in body.items() if key in message})
+    return 200, message
+
+  def delete_original(self, params, query, body):
+    self.remove_message(self.get_original_message(params['token'])['id'])
+    return 204, None
+
+  def create_followup(self, params, query, body):
+    if params['token'] not in self.interactions:
+      raise ApiError(404, 'Unknown Webhook')
+    message = {
+      'id': self.next_snowflake(),
+      'content': body.get('content', ''),
+      'flags': body.get('flags', 0)
+    }
+    self.followups[message['id']] = params['token']
+    return 200, message
+
+  def delete_followup(self, params, query, body):
+    if self.followups.get(params['message']) != params['token']:
+      raise ApiError(404, 'Unknown Message')
+    del self.followups[params['message']]
+    return 204, None
+
+  def get_messages(self, params, query, body):
+    message_ids = sorted(self.channels.get(params['channel'], []), key=int, reverse=True)
+    limit = int(query.get('limit', ['50'])[0])
+    if 'after' in query:
+      after = int(query['after'][0])
+      # Discord returns the oldest messages after the ID, newest first
+      message_ids = [message_id for message_id in message_ids if int(message_id) > after][-limit:]
+    elif 'before' in query:
+      before = int(query['before'][0])
+      message_ids = [message_id for message_id in message_ids if int(message_id) < before][:limit]
+    else:
+      message_ids = message_ids[:limit]
+    return 200, [self.messages[message_id] for message_id in message_ids]
+
+  def create_message(self, params, query, body):
+    return 200, self.add_message(params['channel'], body or {})
+
+  def bulk_delete(self, params, query, body):
+    message_ids = body.get('messages', [])
+    if not 2 <= len(message_ids) <= 100:
+      raise ApiError(400, 'Bulk delete takes between 2 and 100 messages')
+    for message_id in message_ids:
+      message = self.messages.get(message_id)
+      if message and message['channel_id'] == params['channel']:
+        self.remove_message(message_id)
+    return 204, None
+
+  def edit_message(self, params, query, body):
+    message = self.messages.get(params['message'])
+    if message is None or message['channel_id'] != params['channel']:
+      raise ApiError(404, 'Unknown Message')
+    message.update({key: value for key, value in body.items() if key in message})
+    return 200, message
+
+  def delete_message(self, params, query, body):
+    message = self.messages.get(params['message'])
+    if message is None or message['channel_id'] != params['channel']:
+      raise ApiError(404, 'Unknown Message')
+    self.remove_message(params['message'])
+    return 204, None
+
+  def get_pins(self, params, query, body):
+    return 200, [
+      self.messages[message_id] for message_id in self.channels.get(params['channel'], [])
+      if self.messages[message_id]['pinned']
+    ]
+
+  def pin_message(self, params, query, body):
+    message = self.messages.get(params['message'])
+    if message is None:
+      raise ApiError(404, 'Unknown Message')
+    message['pinned'] = True
+    return 204, None
+
+  def overwrite_commands(self, params, query, body):
+    return 200, body
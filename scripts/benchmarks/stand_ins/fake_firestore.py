@@ -0,0 +1,419 @@
+"""In-memory stand-in for the parts of firebase_admin.firestore the functions use.
+
+Documents, queries, batches, transactions and query listeners behave like
+Firestore closely enough for load testing: transactions are optimistic and
+retried when a document they read changed before commit, query listeners
+deliver ADDED/MODIFIED/REMOVED changes from a background thread, and every
+RPC can be given a simulated latency. Reads, writes and deletes are counted
+per collection the way Firestore bills them.
+"""
+import sys
+import copy
+import time
+import queue
+import random
+import threading
+import itertools
+from enum import Enum
+from types import ModuleType, SimpleNamespace
+from collections import Counter
+
+class ArrayUnion:
+  def __init__(self, values):
+    self.values = list(values)
+
+class ArrayRemove:
+  def __init__(self, values):
+    self.values = list(values)
+
+class FailedPrecondition(Exception):
+  pass
+
+class NotFound(Exception):
+  pass
+
+class ChangeType(Enum):
+  ADDED = 1
+  MODIFIED = 2
+  REMOVED = 3
+
+def get_field(data: dict, field_path: str):
+  value = data
+  for key in field_path.split('.'):
+    if not isinstance(value, dict) or key not in value:
+      return None
+    value = value[key]
+  return value
+
+def matches(value, op_string: str, target) -> bool:
+  if op_string == 'array_contains':
+    return isinstance(value, list) and target in value
+  if op_string == 'in':
+    return value in target
+  if op_string == '==':
+    return value == target
+  if value is None or target is None:
+    # range filters only match values of the same type
+    return False
+  try:
+    return {
+      '<': value < target,
+      '<=': value <= target,
+      '>': value > target,
+      '>=': value >= target
+    }[op_string]
+  except TypeError:
+    return False
+
+def apply_transform(existing, value):
+  if isinstance(value, ArrayUnion):
+    existing = list(existing) if isinstance(existing, list) else []
+    return existing + [item for item in value.values if item not in existing]
+  if isinstance(value, ArrayRemove):
+    existing = list(existing) if isinstance(existing, list) else []
+    return [item for item in existing if item not in value.values]
+  return copy.deepcopy(value)
+
+def merge_data(existing: dict, data: dict) -> dict:
+  merged = dict(existing)
+  for key, value in data.items():
+    if isinstance(value, dict) and isinstance(merged.get(key), dict):
+      merged[key] = merge_data(merged[key], value)
+    else:
+      merged[key] = apply_transform(merged.get(key), value)
+  return merged
+
+def update_data(existing: dict, data: dict) -> dict:
+  updated = copy.deepcopy(existing)
+  for field_path, value in data.items():
+    target = updated
+    keys = field_path.split('.')
+    for key in keys[:-1]:
+      target = target.setdefault(key, {})
+    target[keys[-1]] = apply_transform(target.get(keys[-1]), value)
+  return updated
+
+class DocumentSnapshot:
+  def __init__(self, reference, data, update_time):
+    self.reference = reference
+    self.id = reference.id
+    self.exists = data is not None
+    self.update_time = update_time
+    self._data = data
+
+  def to_dict(self):
+    return copy.deepcopy(self._data) if self._data is not None else None
+
+  def get(self, field_path: str):
+    return get_field(self._data or {}, field_path)
+
+class DocumentReference:
+  def __init__(self, db, path: str):
+    self.db = db
+    self.path = path
+    self.id = path.rsplit('/', 1)[-1]
+    self.parent_path = path.rsplit('/', 1)[0]
+
+  def collection(self, name: str):
+    return CollectionReference(self.db, f'{self.path}/{name}')
+
+  def get(self, transaction=None):
+    return self.db.get_document(self, transaction=transaction)
+
+  def set(self, document_data: dict, merge: bool = False):
+    self.db.commit([('set', self, document_data, merge)])
+
+  def update(self, field_updates: dict):
+    self.db.commit([('update', self, field_updates, None)])
+
+  def delete(self, option=None):
+    self.db.commit([('delete', self, None, option)])
+
+class Query:
+  def __init__(self, db, collection_path: str, filters=None, limit_count=None):
+    self.db = db
+    self.collection_path = collection_path
+    self.filters = filters or []
+    self.limit_count = limit_count
+
+  def where(self, field_path: str = None, op_string: str = None, value=None, **kwargs):
+    field_path = field_path or kwargs.get('field_path')
+    return Query(
+      self.db,
+      self.collection_path,
+      self.filters + [(field_path, op_string, value)],
+      self.limit_count
+    )
+
+  def limit(self, count: int):
+    return Query(self.db, self.collection_path, self.filters, count)
+
+  def matches(self, data) -> bool:
+    if data is None:
+      return False
+    return all(
+      matches(get_field(data, field_path), op_string, value)
+      for field_path, op_string, value in self.filters
+    )
+
+  def stream(self, transaction=None):
+    return iter(self.db.run_query(self, transaction=transaction))
+
+  def get(self, transaction=None):
+    return self.db.run_query(self, transaction=transaction)
+
+  def on_snapshot(self, callback):
+    return self.db.watch(self, callback)
+
+class CollectionReference(Query):
+  def __init__(self, db, path: str):
+    super().__init__(db, path)
+    self.id = path.rsplit('/', 1)[-1]
+
+  def document(self, document_id: str = None):
+    document_id = document_id or f'{random.getrandbits(64):016x}'
+    return DocumentReference(self.db, f'{self.collection_path}/{document_id}')
+
+class WriteBatch:
+  def __init__(self, db):
+    self.db = db
+    self.writes = []
+
+  def set(self, reference, document_data: dict, merge: bool = False):
+    self.writes.append(('set', reference, document_data, merge))
+
+  def update(self, reference, field_updates: dict):
+    self.writes.append(('update', reference, field_updates, None))
+
+  def delete(self, reference, option=None):
+    self.writes.append(('delete', reference, None, option))
+
+  def commit(self):
+    self.db.commit(self.writes)
+    self.writes = []
+
+class Transaction(WriteBatch):
+  def __init__(self, db, max_attempts: int = 5):
+    super().__init__(db)
+    self.max_attempts = max_attempts
+    self.read_versions = {}
+
+def transactional(transaction_function):
+  def run(transaction, *args, **kwargs):
+    for _ in range(transaction.max_attempts):
+      transaction.writes = []
+      transaction.read_versions = {}
+      result = transaction_function(transaction, *args, **kwargs)
+      if transaction.db.commit(transaction.writes, read_versions=transaction.read_versions):
+        return result
+      transaction.db.record('transaction_retries')
+    # the real client raises ValueError once max_attempts are exhausted
+    raise ValueError(f'Failed to commit transaction in {transaction.max_attempts} attempts.')
+  return run
+
+class Watch:
+  def __init__(self, db, query, callback):
+    self.db = db
+    self.query = query
+    self.callback = callback
+    self.is_active = True
+    self.changes = queue.Queue()
+    self.thread = threading.Thread(target=self.deliver, name='fake-firestore-watch', daemon=True)
+    self.thread.start()
+
+  def deliver(self):
+    while self.is_active:
+      changes = self.changes.get()
+      if changes is None:
+        return
+      try:
+        self.callback([], changes, time.time())
+      except Exception as error:
+        print(f'Fake Firestore listener failed: {error}')
+
+  def unsubscribe(self):
+    self.is_active = False
+    self.changes.put(None)
+    with self.db.lock:
+      if self in self.db.watches:
+        self.db.watches.remove(self)
+
+class FakeFirestore:
+  def __init__(self, latency_seconds: float = 0.0):
+    self.latency_seconds = latency_seconds
+    self.lock = threading.RLock()
+    self.documents = {}
+    self.versions = {}
+    self.clock = itertools.count(1)
+    self.watches = []
+    self.stats = Counter()
+
+  # client API used by the functions
+
+  def collection(self, name: str):
+    return CollectionReference(self, name)
+
+  def batch(self):
+    return WriteBatch(self)
+
+  def transaction(self, max_attempts: int = 5):
+    return Transaction(self, max_attempts=max_attempts)
+
+  def write_option(self, last_update_time=None):
+    return SimpleNamespace(last_update_time=last_update_time)
+
+  # bookkeeping
+
+  def wait(self):
+    if self.latency_seconds:
+      time.sleep(self.latency_seconds * random.uniform(0.5, 1.5))
+
+  def record(self, stat: str, collection_path: str = None, count: int = 1):
+    with self.lock:
+      self.stats[stat] += count
+      if collection_path is not None:
+        self.stats[f'{stat}:{collection_path.split("/")[-1]}'] += count
+
+  def reset_stats(self):
+    with self.lock:
+      self.stats = Counter()
+
+  def get_stats(self) -> dict:
+    with self.lock:
+      return dict(self.stats)
+
+  def get_document(self, reference, transaction=None) -> DocumentSnapshot:
+    self.wait()
+    with self.lock:
+      data = self.documents.get(reference.path)
+      version = self.versions.get(reference.path, 0)
+      if transaction is not None:
+        transaction.read_versions[reference.path] = version
+    self.record('reads', reference.parent_path)
+    return DocumentSnapshot(reference, copy.deepcopy(data), version)
+
+  def run_query(self, query: Query, transaction=None) -> list:
+    self.wait()
+    with self.lock:
+      results = []
+      for path, data in self.documents.items():
+        if path.rsplit('/', 1)[0] != query.collection_path or not query.matches(data):
+          continue
+        reference = DocumentReference(self, path)
+        version = self.versions[path]
+        results.append(DocumentSnapshot(reference, copy.deepcopy(data), version))
+        if transaction is not None:
+          transaction.read_versions[path] = version
+        if query.limit_count is not None and len(results) >= query.limit_count:
+          break
+    # a query is billed at least one read even when it matches nothing
+    self.record('reads', query.collection_path, max(len(results), 1))
+    return results
+
+  def commit(self, writes: list, read_versions: dict = None) -> bool:
+    """Apply writes atomically. Returns False without writing anything when a
+    document read by the transaction changed since it was read."""
+    self.wait()
+    with self.lock:
+      for path, version in (read_versions or {}).items():
+        if self.versions.get(path, 0) != version:
+          return False
+      # stage every write first so a failing one leaves no partial commit
+      staged = {}
+      previous = {}
+      for kind, reference, data, option in writes:
+        path = reference.path
+        existing = staged[path] if path in staged else self.documents.get(path)
+        previous.setdefault(path, self.documents.get(path))
+        if kind == 'set':
+          staged[path] = merge_data(existing or {}, data) if option else merge_data({}, data)
+        elif kind == 'update':
+          if existing is None:
+            raise NotFound(f'No document to update: {path}')
+          staged[path] = update_data(existing, data)
+        else:
+          if option is not None and option.last_update_time != self.versions.get(path, 0):
+            raise FailedPrecondition(f'Document was updated since it was read: {path}')
+          staged[path] = None
+      for path, new_data in staged.items():
+        if new_data is None:
+          self.documents.pop(path, None)
+        else:
+          self.documents[path] = new_data
+        self.versions[path] = next(self.clock)
+      for kind, reference, _, _ in writes:
+        self.record('deletes' if kind == 'delete' else 'writes', reference.parent_path)
+      self.notify(previous)
+    return True
+
+  def watch(self, query: Query, callback) -> Watch:
+    watch = Watch(self, query, callback)
+    with self.lock:
+      self.watches.append(watch)
+      initial = [
+        SimpleNamespace(
+          type=ChangeType.ADDED,
+          document=DocumentSnapshot(DocumentReference(self, path), copy.deepcopy(data), 0)
+        )
+        for path, data in self.documents.items()
+        if path.rsplit('/', 1)[0] == query.collection_path and query.matches(data)
+      ]
+    self.record('reads', query.collection_path, max(len(initial), 1))
+    watch.changes.put(initial)
+    return watch
+
+  def notify(self, previous: dict):
+    for watch in self.watches:
+      changes = []
+      for path, old_data in previous.items():
+        if path.rsplit('/', 1)[0] != watch.query.collection_path:
+          continue
+        new_data = self.documents.get(path)
+        was_match = watch.query.matches(old_data)
+        is_match = watch.query.matches(new_data)
+        if not was_match and not is_match:
+          continue
+        if is_match:
+          change_type = ChangeType.MODIFIED if was_match else ChangeType.ADDED
+        else:
+          change_type = ChangeType.REMOVED
+        snapshot = DocumentSnapshot(
+          DocumentReference(self, path),
+          copy.deepcopy(new_data if is_match else old_data),
+          self.versions[path]
+        )
+        changes.append(SimpleNamespace(type=change_type, document=snapshot))
+      if changes:
+        self.stats['reads'] += len(changes)
+        self.stats[f'reads:{watch.query.collection_path.split("/")[-1]}'] += len(changes)
+        watch.changes.put(changes)
+
+def install(db: FakeFirestore):
+  """Make firebase_admin resolve to this stand-in, with firestore.client()
+  returning db."""
+  firebase_admin = ModuleType('firebase_admin')
+  firestore = ModuleType('firebase_admin.firestore')
+  apps = {}
+
+  def initialize_app(*args, **kwargs): # pylint: disable=unused-argument
+    # like firebase_admin, initializing the default app twice is an error
+    if '[DEFAULT]' in apps:
+      raise ValueError('The default Firebase app already exists.')
+    apps['[DEFAULT]'] = object()
+    return apps['[DEFAULT]']
+
+  def get_app(name='[DEFAULT]'):
+    if name not in apps:
+      raise ValueError(f'The {name} app does not exist.')
+    return apps[name]
+
+  firebase_admin.initialize_app = initialize_app
+  firebase_admin.get_app = get_app
+  firebase_admin.firestore = firestore
+  firestore.client = lambda *args, **kwargs: db
+  firestore.ArrayUnion = ArrayUnion
+  firestore.ArrayRemove = ArrayRemove
+  firestore.transactional = transactional
+  firestore.Transaction = Transaction
+  sys.modules['firebase_admin'] = firebase_admin
+  sys.modules['firebase_admin.firestore'] = firestore
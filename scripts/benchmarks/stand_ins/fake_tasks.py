@@ -0,0 +1,283 @@
+"""In-process stand-in for Cloud Tasks.
+
+install() makes google.cloud.tasks_v2 resolve to a client backed by a
+TaskQueue, which dispatches each task to a local function once its schedule
+time is reached. Like Cloud Tasks it deduplicates named tasks (names stay
+reserved after the task ran or was deleted), lets pending tasks be deleted and
+retries tasks that fail with an exception or a 5xx status.
+"""
+import sys
+import json
+import time
+import heapq
+import importlib
+import datetime
+import itertools
+import threading
+from types import ModuleType
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+TASK_MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.1
+
+class AlreadyExists(Exception):
+  pass
+
+class NotFound(Exception):
+  pass
+
+class Timestamp:
+  def __init__(self):
+    self.seconds = 0.0
+
+  def FromDatetime(self, dt: datetime.datetime): # pylint: disable=invalid-name
+    self.seconds = dt.timestamp()
+
+  def ToDatetime(self) -> datetime.datetime: # pylint: disable=invalid-name
+    return datetime.datetime.fromtimestamp(self.seconds, tz=datetime.timezone.utc)
+
+class HttpMethod:
+  POST = 'POST'
+
+class OidcToken:
+  def __init__(self, service_account_email: str = None, audience: str = None):
+    self.service_account_email = service_account_email
+    self.audience = audience
+
+class HttpRequest:
+  def __init__(self, http_method=None, url: str = None, body: bytes = b'', headers: dict = None):
+    self.http_method = http_method
+    self.url = url
+    self.body = body
+    self.headers = dict(headers or {})
+    self.oidc_token = None
+
+class Task:
+  def __init__(self, http_request: HttpRequest = None, name: str = '', schedule_time=None):
+    self.http_request = http_request
+    self.name = name
+    self.schedule_time = schedule_time
+
+class CreateTaskRequest:
+  def __init__(self, parent: str = None, task: Task = None):
+    self.parent = parent
+    self.task = task
+
+class TaskQueue: # pylint: disable=too-many-instance-attributes
+  """Runs tasks on a worker pool once they are due.
+  Args:
+    dispatch: Called with the target function name (the last segment of the
+      task URL) and the JSON payload, returns an HTTP status code.
+    workers: Tasks run concurrently on this many threads.
+    time_scale: Multiplies every schedule delay, e.g. 0.01 fires a 20 minute
+      delayed task after 12 seconds.
+    on_done: Optional callback with the function name, payload and final
+      status of every task once it stops being retried.
+  """
+
+  def __init__(
+    self,
+    dispatch: Callable[[str, Dict], int],
+    workers: int = 16,
+    time_scale: float = 1.0,
+    on_done: Optional[Callable[[str, Dict, int], None]] = None
+  ):
+    self.dispatch = dispatch
+    self.time_scale = time_scale
+    self.on_done = on_done
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fake-tasks')
+    self.condition = threading.Condition()
+    self.heap = []
+    self.sequence = itertools.count()
+    self.pending = {}
+    self.reserved_names = set()
+    self.in_flight = 0
+    self.running_by_function = Counter()
+    self.peak_concurrency = Counter()
+    self.stats = Counter()
+    self.latencies = {}
+    self.running = True
+    self.thread = threading.Thread(target=self.schedule, name='fake-tasks-scheduler', daemon=True)
+    self.thread.start()
+
+  def create(self, parent: str, task: Task) -> Task:
+    function = task.http_request.url.rstrip('/').rsplit('/', 1)[-1]
+    delay_seconds = 0.0
+    if task.schedule_time is not None:
+      delay_seconds = max(task.schedule_time.seconds - time.time(), 0.0)
+    with self.condition:
+      if task.name in self.reserved_names:
+        self.stats[f'deduplicated:{function}'] += 1
+        raise AlreadyExists(f'Task {task.name} already exists')
+      if not task.name:
+        task.name = f'{parent}/tasks/{next(self.sequence)}'
+      self.reserved_names.add(task.name)
+      entry = {
+        'name': task.name,
+        'function': function,
+        'payload': json.loads(task.http_request.body),
+        'attempt': 0
+      }
+      self.pending[task.name] = entry
+      due_at = time.monotonic() + delay_seconds * self.time_scale
+      heapq.heappush(self.heap, (due_at, next(self.sequence), entry))
+      self.stats[f'created:{function}'] += 1
+      self.condition.notify()
+    return task
+
+  def delete(self, name: str):
+    with self.condition:
+      entry = self.pending.pop(name, None)
+      if entry is None:
+        raise NotFound(f'Task {name} does not exist')
+      entry['deleted'] = True
+      self.stats[f"deleted:{entry['function']}"] += 1
+
+  def schedule(self):
+    while True:
+      with self.condition:
+        while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+          timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+          self.condition.wait(timeout)
+        if not self.running:
+          return
+        _, _, entry = heapq.heappop(self.heap)
+        if entry.get('deleted'):
+          continue
+        self.in_flight += 1
+        function = entry['function']
+        self.running_by_function[function] += 1
+        self.peak_concurrency[function] = max(
+          self.peak_concurrency[function],
+          self.running_by_function[function]
+        )
+      self.executor.submit(self.run, entry)
+
+  def run(self, entry: dict):
+    function = entry['function']
+    entry['attempt'] += 1
+    started = time.perf_counter()
+    try:
+      status = self.dispatch(function, entry['payload'])
+    except Exception as error:
+      print(f"Task {entry['name']} failed: {error}")
+      status = 500
+    elapsed = time.perf_counter() - started
+    with self.condition:
+      self.in_flight -= 1
+      self.running_by_function[function] -= 1
+      self.stats[f'dispatched:{function}'] += 1
+      self.latencies.setdefault(function, []).append(elapsed)
+      if status >= 500 and entry['attempt'] < TASK_MAX_ATTEMPTS:
+        self.stats[f'retried:{function}'] += 1
+        due_at = time.monotonic() + RETRY_BACKOFF_SECONDS * 2 ** entry['attempt']
+        heapq.heappush(self.heap, (due_at, next(self.sequence), entry))
+        self.condition.notify()
+        return
+      if status >= 500:
+        self.stats[f'failed:{function}'] += 1
+      self.pending.pop(entry['name'], None)
+      self.condition.notify_all()
+    if self.on_done:
+      self.on_done(function, entry['payload'], status)
+
+  def drain(self, within_seconds: float, timeout: float) -> int:
+    """Wait until no task is running or due within within_seconds (already
+    scaled). Returns the number of tasks still pending after that."""
+    deadline = time.monotonic() + timeout
+    with self.condition:
+      while time.monotonic() < deadline:
+        horizon = time.monotonic() + within_seconds
+        is_due = any(
+          due_at <= horizon and not entry.get('deleted') for due_at, _, entry in self.heap
+        )
+        if not is_due and not self.in_flight:
+          break
+        self.condition.wait(0.1)
+      return len(self.pending)
+
+  def reset_stats(self):
+    with self.condition:
+      self.stats = Counter()
+      self.latencies = {}
+      self.peak_concurrency = Counter(self.running_by_function)
+
+  def get_stats(self) -> dict:
+    with self.condition:
+      return {
+        'stats': dict(self.stats),
+        'peak_concurrency': dict(self.peak_concurrency),
+        'latencies': {
+          function: list(latencies) for function, latencies in self.latencies.items()
+        }
+      }
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify_all()
+    self.executor.shutdown(wait=False)
+
+def install_module(name: str, module: ModuleType):
+  """Register a module and any missing parent packages."""
+  parent_name, _, child_name = name.rpartition('.')
+  if parent_name:
+    try:
+      parent = importlib.import_module(parent_name)
+    except ImportError:
+      parent = ModuleType(parent_name)
+      parent.__path__ = []
+      install_module(parent_name, parent)
+    setattr(parent, child_name, module)
+  sys.modules[name] = module
+
+def install(task_queue: TaskQueue):
+  """Make google.cloud.tasks_v2 resolve to a client backed by task_queue.
+  google.api_core.exceptions and google.protobuf.timestamp_pb2 are only
+  replaced when they are not installed.
+  """
+  class CloudTasksClient:
+    def queue_path(self, project: str, location: str, queue: str) -> str:
+      return f'projects/{project}/locations/{location}/queues/{queue}'
+
+    def task_path(self, project: str, location: str, queue: str, task: str) -> str:
+      return f'{self.queue_path(project, location, queue)}/tasks/{task}'
+
+    def create_task(self, request: CreateTaskRequest) -> Task:
+      try:
+        return task_queue.create(request.parent, request.task)
+      except AlreadyExists as error:
+        raise exceptions.AlreadyExists(str(error)) from error
+
+    def delete_task(self, name: str):
+      try:
+        task_queue.delete(name)
+      except NotFound as error:
+        raise exceptions.NotFound(str(error)) from error
+
+  try:
+    from google.api_core import exceptions # pylint: disable=import-outside-toplevel
+  except ImportError:
+    exceptions = ModuleType('google.api_core.exceptions')
+    exceptions.AlreadyExists = AlreadyExists
+    exceptions.NotFound = NotFound
+    install_module('google.api_core.exceptions', exceptions)
+
+  try:
+    # pylint: disable=import-outside-toplevel,unused-import
+    from google.protobuf import timestamp_pb2
+  except ImportError:
+    timestamp_pb2 = ModuleType('google.protobuf.timestamp_pb2')
+    timestamp_pb2.Timestamp = Timestamp
+    install_module('google.protobuf.timestamp_pb2', timestamp_pb2)
+
+  tasks_v2 = ModuleType('google.cloud.tasks_v2')
+  tasks_v2.HttpMethod = HttpMethod
+  tasks_v2.OidcToken = OidcToken
+  tasks_v2.HttpRequest = HttpRequest
+  tasks_v2.Task = Task
+  tasks_v2.CreateTaskRequest = CreateTaskRequest
+  tasks_v2.CloudTasksClient = CloudTasksClient
+  install_module('google.cloud.tasks_v2', tasks_v2)
@@ -0,0 +1,279 @@
+"""Measure cold start cost of every function in lib/functions.
+
+Each function is bundled the same way cloudbuild.yaml bundles it and started in
+a fresh interpreter per run, so the numbers include every module level import
+and initialization. For functions listed in SAMPLE_REQUESTS the first request
+is also timed, with a valid (for discord_bot, signed) payload that reaches the
+clients created on first use. Those clients are replaced by the load test
+stand-ins, but the real client libraries they would load are imported in the
+timed window, so cost moved from import time to the first request is still
+measured. The script exits non-zero when the median of a function exceeds
+the budget, so it can gate a build.
+
+Usage:
+  python scripts/benchmarks/startup_benchmark.py [--bundle-path PATH] [--runs N]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import yaml
+from nacl.signing import SigningKey
+
+BENCHMARKS_PATH = os.path.abspath(os.path.dirname(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(BENCHMARKS_PATH, '..', '..'))
+FUNCTIONS_PATH = os.path.join(REPO_ROOT, 'lib', 'functions')
+COMMON_PATHS = [
+  os.path.join(REPO_ROOT, 'lib', 'common', 'python'),
+  os.path.join(REPO_ROOT, 'lib', 'common', 'configs')
+]
+IMPORT_BUDGET_MS = 1500
+FIRST_REQUEST_BUDGET_MS = 500
+
+BENCHMARK_TOKEN = 'startup-benchmark'
+BENCHMARK_APP_ID = '1100000000000000001'
+
+def build_set_username_interaction(channel_id: str) -> dict:
+  """A "/lobby set username" command, which reads and writes the player and
+  answers with a followup. channel_id must be a lobby channel of the
+  benchmarked environment, commands from other channels are rejected."""
+  return {
+    'id': '1100000000000000002',
+    'application_id': BENCHMARK_APP_ID,
+    'type': 2,
+    'token': BENCHMARK_TOKEN,
+    'version': 1,
+    'guild_id': '1100000000000000003',
+    'channel': {'id': channel_id, 'name': 'lobby'},
+    'member': {'user': {'id': '1100000000000000005', 'global_name': 'benchmark'}},
+    'data': {
+      'name': 'lobby',
+      'type': 1,
+      'options': [{
+        'type': 2,
+        'name': 'set',
+        'options': [{
+          'type': 1,
+          'name': 'username',
+          'options': [{'type': 3, 'name': 'username', 'value': 'benchmark'}]
+        }]
+      }]
+    }
+  }
+
+# real libraries each lazily created client loads on first use
+CLIENT_LIBRARIES = {
+  'firestore': ['firebase_admin', 'firebase_admin.firestore'],
+  'tasks': ['google.cloud.tasks_v2', 'google.api_core.exceptions', 'google.protobuf.timestamp_pb2']
+}
+
+# requests that get past validation to the clients created on first use.
+# body builds the payload from a lobby channel ID, clients are replaced by
+# stand-ins and reaches lists what the request must have called for its
+# timing to count (player_write: the player document was written)
+SAMPLE_REQUESTS = {
+  'discord_bot': {
+    'body': build_set_username_interaction,
+    'signed': True,
+    'clients': ['tasks'],
+    'reaches': ['tasks']
+  },
+  'process_interaction': {
+    'body': lambda channel_id: {
+      'data': build_set_username_interaction(channel_id),
+      'ephemeral': True
+    },
+    # the followup schedules its ephemeral deletion as a task
+    'clients': ['firestore', 'tasks'],
+    'reaches': ['player_write', 'discord', 'tasks']
+  },
+  'delete_ephemeral_message': {
+    'body': lambda channel_id: {'bucket': 0},
+    'clients': ['firestore'],
+    'reaches': ['firestore']
+  },
+  'close_delete_lobby': {
+    'body': lambda channel_id: {'channel_id': channel_id, 'lobby_id': '1100000000000000006'},
+    'clients': ['firestore'],
+    'reaches': ['firestore']
+  },
+  'close_open_lobbies': {
+    'body': lambda channel_id: {},
+    'clients': ['firestore'],
+    'reaches': ['firestore']
+  }
+}
+
+CHILD_SCRIPT = '''
+import os
+import json
+import sys
+import time
+import importlib
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+result = {'import_ms': (imported - started) * 1000}
+sample = json.loads(sys.argv[1])
+if sample is not None:
+  import flask
+  sys.path.insert(0, sys.argv[2])
+  from stand_ins import fake_discord, fake_firestore, fake_tasks
+  discord = fake_discord.FakeDiscord(latency_seconds=0).start()
+  discord.register_interaction(token=sample['token'], channel_id=sample['channel_id'])
+  os.environ['DISCORD_API_BASE_URL'] = discord.base_url
+  if 'discord_api' in sys.modules:
+    sys.modules['discord_api'].discord_client.base_url = discord.base_url
+  db = fake_firestore.FakeFirestore()
+  task_queue = fake_tasks.TaskQueue(dispatch=lambda function, payload: 200)
+  install_stand_in = {
+    'firestore': lambda: fake_firestore.install(db),
+    'tasks': lambda: fake_tasks.install(task_queue)
+  }
+  app = flask.Flask('startup_benchmark')
+  with app.test_request_context('/', method='POST', **sample['request']):
+    request_started = time.perf_counter()
+    # first use imports the real client library, which is charged to the
+    # request before the stand-in takes the place of its client
+    for client, libraries in sample['clients'].items():
+      for library in libraries:
+        try:
+          importlib.import_module(library)
+        except ImportError:
+          pass
+      install_stand_in[client]()
+    main.handler(flask.request)
+    result['first_request_ms'] = (time.perf_counter() - request_started) * 1000
+  firestore_stats = db.get_stats()
+  reached = {
+    'firestore': any(firestore_stats.values()),
+    'player_write': firestore_stats.get('writes:players', 0) > 0,
+    'tasks': any(stat.startswith('created:') for stat in task_queue.get_stats()['stats']),
+    'discord': any(discord.get_stats()['calls'].values())
+  }
+  result['unreached'] = [stand_in for stand_in in sample['reaches'] if not reached[stand_in]]
+  task_queue.stop()
+  discord.stop()
+print(json.dumps(result))
+'''
+
+def bundle_functions(bundle_path: str):
+  for function in sorted(os.listdir(FUNCTIONS_PATH)):
+    function_path = os.path.join(FUNCTIONS_PATH, function)
+    if not os.path.isdir(function_path):
+      continue
+    target_path = os.path.join(bundle_path, function)
+    shutil.copytree(function_path, target_path, dirs_exist_ok=True)
+    for common_path in COMMON_PATHS:
+      shutil.copytree(common_path, target_path, dirs_exist_ok=True)
+
+def get_child_env(signing_key: SigningKey) -> dict:
+  env = dict(os.environ)
+  env.setdefault('ENV', 'dev')
+  env['BOT_PUBLIC_KEY'] = signing_key.verify_key.encode().hex()
+  env['BOT_APP_ID'] = BENCHMARK_APP_ID
+  env.setdefault('REGION', 'benchmark')
+  env.setdefault('PROJECT_ID', 'benchmark')
+  # tasks carry an OIDC token minted by Cloud Tasks, so none is fetched here
+  env['SERVICE_ACCOUNT'] = 'benchmark@benchmark.iam.gserviceaccount.com'
+  env['PYTHONDONTWRITEBYTECODE'] = '1'
+  return env
+
+def get_lobby_channel_id(function_path: str) -> str:
+  with open(os.path.join(function_path, 'channels.yaml'), 'r', encoding='utf-8') as file:
+    return yaml.safe_load(file)[os.getenv('ENV', 'dev')]['lobby_channels'][0]
+
+def build_child_sample(sample: dict, signing_key: SigningKey, channel_id: str) -> dict:
+  body = json.dumps(sample['body'](channel_id))
+  headers = {}
+  if sample.get('signed'):
+    timestamp = '0'
+    signature = signing_key.sign(f'{timestamp}{body}'.encode()).signature.hex()
+    headers = {'X-Signature-Ed25519': signature, 'X-Signature-Timestamp': timestamp}
+  return {
+    'request': {'data': body, 'headers': headers, 'content_type': 'application/json'},
+    'token': BENCHMARK_TOKEN,
+    'channel_id': channel_id,
+    'clients': {client: CLIENT_LIBRARIES[client] for client in sample['clients']},
+    'reaches': sample['reaches']
+  }
+
+def run_once(function_path: str, sample, signing_key: SigningKey) -> dict:
+  child_sample = None
+  if sample:
+    child_sample = build_child_sample(sample, signing_key, get_lobby_channel_id(function_path))
+  completed = subprocess.run(
+    [sys.executable, '-c', CHILD_SCRIPT, json.dumps(child_sample), BENCHMARKS_PATH],
+    cwd=function_path,
+    env=get_child_env(signing_key),
+    capture_output=True,
+    text=True,
+    check=False
+  )
+  if completed.returncode != 0:
+    raise RuntimeError(completed.stderr.strip())
+  result = json.loads(completed.stdout.strip().splitlines()[-1])
+  if result.get('unreached'):
+    # the request was rejected early, so its timing would not cover first use
+    raise RuntimeError(
+      f"sample request never reached {', '.join(result['unreached'])}\n{completed.stdout.strip()}"
+    )
+  return result
+
+def benchmark_function(function_path: str, runs: int, signing_key: SigningKey) -> dict:
+  function = os.path.basename(function_path)
+  samples = [
+    run_once(function_path, SAMPLE_REQUESTS.get(function), signing_key) for _ in range(runs)
+  ]
+  result = {'import_ms': statistics.median(sample['import_ms'] for sample in samples)}
+  if function in SAMPLE_REQUESTS:
+    result['first_request_ms'] = statistics.median(
+      sample['first_request_ms'] for sample in samples
+    )
+  return result
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--bundle-path', help='existing bundle directory, e.g. from cloudbuild')
+  parser.add_argument('--runs', type=int, default=3)
+  parser.add_argument('--import-budget-ms', type=float, default=IMPORT_BUDGET_MS)
+  parser.add_argument('--first-request-budget-ms', type=float, default=FIRST_REQUEST_BUDGET_MS)
+  args = parser.parse_args()
+
+  signing_key = SigningKey.generate()
+  with tempfile.TemporaryDirectory() as temp_path:
+    bundle_path = args.bundle_path
+    if not bundle_path:
+      bundle_path = temp_path
+      bundle_functions(bundle_path)
+
+    failures = []
+    for function in sorted(os.listdir(bundle_path)):
+      function_path = os.path.join(bundle_path, function)
+      if not os.path.isfile(os.path.join(function_path, 'main.py')):
+        continue
+      try:
+        result = benchmark_function(function_path, args.runs, signing_key)
+      except RuntimeError as error:
+        failures.append(f'{function}: failed to start\n{error}')
+        continue
+      first_request_ms = result.get('first_request_ms')
+      first_request = f'{first_request_ms:8.1f}' if first_request_ms is not None else '       -'
+      print(f"{function:28} import {result['import_ms']:8.1f} ms  first request {first_request} ms")
+      if result['import_ms'] > args.import_budget_ms:
+        failures.append(f"{function}: import took {result['import_ms']:.1f} ms")
+      if first_request_ms is not None and first_request_ms > args.first_request_budget_ms:
+        failures.append(f'{function}: first request took {first_request_ms:.1f} ms')
+
+  if failures:
+    print('\nStartup budget exceeded:')
+    for failure in failures:
+      print(f'  {failure}')
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()